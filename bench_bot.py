@@ -0,0 +1,1956 @@
+# bench_bot.py
+"""离线基准测试，不需要连接 Telegram。
+
+用法：
+    python bench_bot.py storage [--sizes 1000,100000,1000000] [--repeat 5]
+    python bench_bot.py messagemap [--entries 200000] [--lookups 2000]
+    python bench_bot.py locks [--users 1000000] [--stripes 1024]
+    python bench_bot.py dispatch [--workers 1,4,16,64] [--users 200]
+    python bench_bot.py logging [--updates 5000] [--users 100]
+    python bench_bot.py webhook [--updates 2000] [--users 200] [--concurrency 8]
+    python bench_bot.py simulate [--scenarios users,newusers,burst,storm,faults]
+    python bench_bot.py replicas [--replicas 1,2,4] [--users 400] [--workers 4]
+    python bench_bot.py tenants [--tenants 1,4,16] [--users 50000]
+    python bench_bot.py httppool [--burst 200] [--latency 0.05] [--gap 6]
+    python bench_bot.py startup [--sizes 100000,1000000]
+    python bench_bot.py topicpool [--sizes 0,5] [--users 50] [--interval 0.3]
+    python bench_bot.py expiry [--entries 10000,100000]
+    python bench_bot.py ingress [--flooders 20] [--messages 100] [--users 200]
+    python bench_bot.py editsync [--windows 0,2] [--users 100] [--edits 5]
+    python bench_bot.py checks                      # 故障注入回归检查，失败时退出码非 0
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from collections import Counter, defaultdict
+from pathlib import Path
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+# bot.py 在导入时校验必填环境变量，基准测试使用占位值即可
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("GROUP_ID", "-1000000000000")
+
+import bot  # noqa: E402
+import httpx  # noqa: E402
+from telegram import Bot, Update  # noqa: E402
+from telegram.ext import Application, ApplicationBuilder  # noqa: E402
+from telegram.request import BaseRequest, HTTPXRequest, RequestData  # noqa: E402
+
+BENCH_GROUP_ID = int(os.environ["GROUP_ID"])
+
+
+# ---------- 假的 Telegram Bot API ----------
+class FakeBotApi(BaseRequest):
+    """进程内模拟的 Bot API，作为 PTB 的请求对象注入，不发起任何网络请求。
+
+    维护论坛话题状态；向不存在的话题发消息时返回 "message thread not found"
+    （删除话题即可模拟话题被删）。latency 为每次调用的模拟延迟（秒）。
+    copy_times 记录每条源消息被复制时的 perf_counter 时间，用于计算端到端延迟；
+    edits 记录每条目标消息最后一次被编辑成的文本。
+
+    故障注入（按 seed 可复现）：
+    - retry_rate：以该概率返回 429，retry_after 秒后可重试；
+    - redirect_rate：以该概率让 sendMessage 落到另一个话题（message_thread_id 不符）。
+    - fail_next[endpoint]：按顺序弹出 (错误码, 描述)，让该接口的下一次调用失败。
+    injected 统计实际注入的次数。
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        retry_rate: float = 0.0,
+        retry_after: int = 1,
+        redirect_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.retry_rate = retry_rate
+        self.retry_after = retry_after
+        self.redirect_rate = redirect_rate
+        self.calls: Counter = Counter()
+        self.injected: Counter = Counter()
+        self.topics: set = set()
+        self.copy_times: Dict[Tuple[int, int], float] = {}
+        self.edits: Dict[Tuple[int, int], str] = {}
+        self.fail_next: Dict[str, List[Tuple[int, str]]] = defaultdict(list)
+        self._ids = itertools.count(1)
+        self._rng = random.Random(seed)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def _error(code: int, description: str, **parameters: Any) -> Tuple[int, bytes]:
+        body: Dict[str, Any] = {
+            "ok": False,
+            "error_code": code,
+            "description": description,
+        }
+        if parameters:
+            body["parameters"] = parameters
+        return code, json.dumps(body).encode()
+
+    def _message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = params["chat_id"]
+        message: Dict[str, Any] = {
+            "message_id": next(self._ids),
+            "date": 0,
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+        }
+        if params.get("message_thread_id"):
+            thread_id = params["message_thread_id"]
+            if self.redirect_rate and self._rng.random() < self.redirect_rate:
+                self.injected["redirect"] += 1
+                thread_id = next(self._ids)
+            message["message_thread_id"] = thread_id
+            message["is_topic_message"] = True
+        if "text" in params:
+            message["text"] = params["text"]
+        return message
+
+    def _result(self, endpoint: str, params: Dict[str, Any]) -> Any:
+        if endpoint == "getMe":
+            return {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "bench",
+                "username": "bench_bot",
+                "can_join_groups": True,
+                "can_read_all_group_messages": True,
+                "supports_inline_queries": False,
+            }
+        if endpoint == "createForumTopic":
+            thread_id = next(self._ids)
+            self.topics.add(thread_id)
+            return {
+                "message_thread_id": thread_id,
+                "name": params["name"],
+                "icon_color": 0,
+            }
+        if endpoint == "copyMessage":
+            self.copy_times[(params["from_chat_id"], params["message_id"])] = (
+                perf_counter()
+            )
+            return {"message_id": next(self._ids)}
+        if endpoint == "copyMessages":
+            now = perf_counter()
+            for message_id in params["message_ids"]:
+                self.copy_times[(params["from_chat_id"], message_id)] = now
+            return [{"message_id": next(self._ids)} for _ in params["message_ids"]]
+        if endpoint == "editMessageText":
+            self.edits[(params["chat_id"], params["message_id"])] = params["text"]
+        if endpoint.startswith(("send", "edit")) and "chat_id" in params:
+            return self._message(params)
+        return True
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        **timeouts: Any,
+    ) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if (
+            self.retry_rate
+            and endpoint != "getMe"
+            and self._rng.random() < self.retry_rate
+        ):
+            self.injected["retry_after"] += 1
+            return self._error(
+                429,
+                f"Too Many Requests: retry after {self.retry_after}",
+                retry_after=self.retry_after,
+            )
+
+        if self.fail_next.get(endpoint):
+            self.injected[endpoint] += 1
+            return self._error(*self.fail_next[endpoint].pop(0))
+
+        thread_id = params.get("message_thread_id")
+        if thread_id and thread_id not in self.topics:
+            return self._error(400, "Bad Request: message thread not found")
+
+        return (
+            200,
+            json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode(),
+        )
+
+
+def private_update(
+    update_id: int, user_id: int, message_id: int, text: str
+) -> Dict[str, Any]:
+    """构造一条私聊文本消息的 Update JSON。"""
+    user = {
+        "id": user_id,
+        "is_bot": False,
+        "first_name": f"user{user_id}",
+        "username": f"user{user_id}",
+    }
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": 0,
+            "chat": {
+                "id": user_id,
+                "type": "private",
+                "first_name": user["first_name"],
+            },
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+def group_update(
+    update_id: int, thread_id: int, message_id: int, text: str
+) -> Dict[str, Any]:
+    """构造一条管理员在话题中发送的文本消息的 Update JSON。"""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": 0,
+            "chat": {
+                "id": BENCH_GROUP_ID,
+                "type": "supergroup",
+                "title": "bench",
+                "is_forum": True,
+            },
+            "from": {"id": 42, "is_bot": False, "first_name": "admin"},
+            "message_thread_id": thread_id,
+            "is_topic_message": True,
+            "text": text,
+        },
+    }
+
+
+def edited_update(
+    update_id: int, original: Dict[str, Any], text: str
+) -> Dict[str, Any]:
+    """把 private_update / group_update 构造的消息改写为一次编辑。"""
+    message = dict(original["message"], text=text, edit_date=1)
+    return {"update_id": update_id, "edited_message": message}
+
+
+def prepare_bot_state(tmp: str, users: int, api: Optional[FakeBotApi] = None) -> None:
+    """把 bot.py 的全局状态替换为适合压测的实例：不限流、临时存储、用户已验证。
+
+    传入 api 时为每个用户预先建好话题，只测稳定状态下的转发路径。
+    """
+    bot.outbound = bot.OutboundScheduler(1e9, 1e9, 10**6, 1e9, 10**6, 10**6)
+    bot.ingress = bot.IngressGuard(0, 1, 0, 1, bot.BANNED_NOTICE_SECONDS)
+    bot.storage = bot.JsonFileStorage(Path(tmp) / "topic_mapping.json")
+    bot.persister = bot.MappingPersister(bot.storage, 60)
+    bot.message_map = bot.MessageMapStore(
+        bot.MESSAGE_MAP_MAX_ENTRIES, bot.MESSAGE_MAP_TTL_SECONDS, None, 0
+    )
+    bot.user_sessions.clear()
+    bot.thread_to_user.clear()
+    bot.thread_health_cache = bot.ThreadHealthCache(
+        bot.THREAD_HEALTH_CACHE_MAX_ENTRIES,
+        bot.THREAD_HEALTH_CACHE_SECONDS,
+        bot.THREAD_HEALTH_CACHE_MAX_SECONDS,
+        bot.THREAD_HEALTH_NEGATIVE_SECONDS,
+        bot.THREAD_HEALTH_TRANSIENT_SECONDS,
+    )
+    add_bench_users(range(1, users + 1), api)
+
+
+def add_bench_users(
+    uids: Any, api: Optional[FakeBotApi] = None, banned: bool = False
+) -> None:
+    """添加已验证的用户；传入 api 时同时为其建好话题。"""
+    for uid in uids:
+        session = bot.get_session(uid)
+        session.verified = True
+        session.banned = banned
+        if api is not None:
+            session.thread_id = 10**9 + uid
+            bot.thread_to_user[session.thread_id] = uid
+            api.topics.add(session.thread_id)
+
+
+def build_bench_app(api: FakeBotApi) -> Application:
+    """用 bot.build_application() 创建连接到假 Bot API 的 Application。"""
+    return bot.build_application(
+        ApplicationBuilder()
+        .token(os.environ["BOT_TOKEN"])
+        .request(api)
+        .get_updates_request(api)
+    )
+
+
+def _default_ingress(rate: Optional[float] = None) -> Any:
+    """按 bot.py 的默认配置创建入站准入检查（prepare_bot_state 会关闭限速）。
+
+    rate 覆盖已验证用户的限速（默认配置中关闭）。
+    """
+    return bot.IngressGuard(
+        bot.INGRESS_RATE if rate is None else rate,
+        bot.INGRESS_BURST,
+        bot.CAPTCHA_ATTEMPTS_PER_MINUTE / 60,
+        bot.CAPTCHA_ATTEMPT_BURST,
+        bot.BANNED_NOTICE_SECONDS,
+    )
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:9.2f} ms"
+
+
+def _parse_sizes(raw: str) -> list:
+    return [int(x) for x in raw.split(",") if x.strip()]
+
+
+def bench_storage(args: argparse.Namespace) -> None:
+    """比较各存储后端在不同会话规模下写入单个会话变更（如一次封禁）的延迟。"""
+    print(f"{'backend':<8}{'sessions':>10}{'p50':>13}{'max':>13}")
+    for size in _parse_sizes(args.sizes):
+        rows = {
+            uid: (uid + 1 if uid % 2 else None, True, uid % 50 == 0)
+            for uid in range(1, size + 1)
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, storage in (
+                ("json", bot.JsonFileStorage(Path(tmp) / "topic_mapping.json")),
+                ("sqlite", bot.SqliteStorage(Path(tmp) / "bot.db")),
+            ):
+                storage.write(rows)
+                samples = []
+                for i in range(args.repeat):
+                    uid = 1 + (i * 7919) % size
+                    started = perf_counter()
+                    storage.write({uid: (None, True, True)})
+                    samples.append(perf_counter() - started)
+                storage.close()
+                print(
+                    f"{name:<8}{size:>10}"
+                    f"{_ms(statistics.median(samples)):>13}{_ms(max(samples)):>13}"
+                )
+
+
+def bench_message_map(args: argparse.Namespace) -> None:
+    """对比旧的 dict-of-tuples 与 MessageMapStore 的内存占用和查询延迟。"""
+    n = args.entries
+    group_id = int(os.environ["GROUP_ID"])
+
+    tracemalloc.start()
+    legacy = {}
+    for i in range(n):
+        legacy[(group_id, i)] = (100000 + i, i, bot.time())
+    legacy_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del legacy
+    print(f"dict of tuples : {n} 条，约 {legacy_bytes / 1024 / 1024:.1f} MB")
+
+    async def run(db_path: Path) -> None:
+        tracemalloc.start()
+        store = bot.MessageMapStore(n, bot.MESSAGE_MAP_TTL_SECONDS, db_path, 86400)
+        for i in range(n):
+            store.put(group_id, i, 100000 + i, i)
+        # 待写队列落盘后才是常驻内存
+        await store.flush()
+        store_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"MessageMapStore: {n} 条，约 {store_bytes / 1024 / 1024:.1f} MB")
+
+        # 内存命中
+        keys = [random.randrange(n) for _ in range(args.lookups)]
+        started = perf_counter()
+        for k in keys:
+            await store.get(group_id, k)
+        mem_us = (perf_counter() - started) / len(keys) * 1e6
+
+        # 模拟重启：新实例只能从磁盘索引回查
+        await store.close()
+        cold = bot.MessageMapStore(n, bot.MESSAGE_MAP_TTL_SECONDS, db_path, 86400)
+        started = perf_counter()
+        for k in keys:
+            await cold.get(group_id, k + n if k % 10 == 0 else k)
+        disk_us = (perf_counter() - started) / len(keys) * 1e6
+        stats = cold.stats()
+        await cold.close()
+        print(f"查询延迟：内存命中 {mem_us:.1f} µs，重启后磁盘回查 {disk_us:.1f} µs")
+        print(f"重启后统计：磁盘命中 {stats['disk_hits']}，未命中 {stats['misses']}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(Path(tmp) / "message_map.db"))
+
+
+def bench_locks(args: argparse.Namespace) -> None:
+    """比较旧的 defaultdict(asyncio.Lock) 与 KeyedLocks 的加锁开销和常驻内存。"""
+    users = args.users
+
+    async def legacy() -> dict:
+        locks = defaultdict(asyncio.Lock)
+        for uid in range(users):
+            async with locks[uid]:
+                pass
+        return locks
+
+    async def keyed(stripes: int) -> bot.KeyedLocks:
+        locks = bot.KeyedLocks(stripes)
+        for uid in range(users):
+            async with locks.hold(uid):
+                pass
+        return locks
+
+    print(f"{'registry':<22}{'per acquire':>14}{'retained':>12}{'locks':>10}")
+    for name, factory in (
+        ("defaultdict (旧)", legacy),
+        ("KeyedLocks", lambda: keyed(0)),
+        (f"KeyedLocks/{args.stripes}", lambda: keyed(args.stripes)),
+    ):
+        tracemalloc.start()
+        started = perf_counter()
+        registry = asyncio.run(factory())
+        elapsed = perf_counter() - started
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(
+            f"{name:<22}{elapsed / users * 1e6:>11.2f} µs"
+            f"{retained / 1024 / 1024:>9.1f} MB{len(registry):>10}"
+        )
+        del registry
+
+
+async def drive_private_updates(
+    app: Application, api: FakeBotApi, users: int, per_user: int
+) -> Tuple[float, Dict[Tuple[int, int], float]]:
+    """按轮次向每个用户各投递一条私聊消息，等待全部转发完成。
+
+    返回 (总耗时, {(uid, message_id): 入队时间})。
+    """
+    enqueued: Dict[Tuple[int, int], float] = {}
+    async with app:
+        await app.start()
+        started = perf_counter()
+        update_id = 0
+        for seq in range(per_user):
+            for uid in range(1, users + 1):
+                update_id += 1
+                message_id = 1000 + seq
+                enqueued[(uid, message_id)] = perf_counter()
+                await app.update_queue.put(
+                    Update.de_json(
+                        private_update(update_id, uid, message_id, f"m{seq}"),
+                        app.bot,
+                    )
+                )
+        while len(api.copy_times) < len(enqueued):
+            await asyncio.sleep(0.005)
+        elapsed = perf_counter() - started
+        await app.stop()
+    return elapsed, enqueued
+
+
+def bench_dispatch(args: argparse.Namespace) -> None:
+    """更新分发压测：不同工作协程数下的端到端延迟，并校验同一用户内的顺序。"""
+    per_user = args.updates // args.users
+
+    async def run(tmp: str, workers: int) -> Tuple[float, List[float], int]:
+        api = FakeBotApi(latency=args.latency)
+        prepare_bot_state(tmp, args.users)
+        bot.CONCURRENT_UPDATES = workers
+        elapsed, enqueued = await drive_private_updates(
+            build_bench_app(api), api, args.users, per_user
+        )
+
+        latencies = [api.copy_times[key] - t for key, t in enqueued.items()]
+        # 同一用户的消息必须按 message_id 顺序到达管理群
+        disordered = 0
+        for uid in range(1, args.users + 1):
+            times = [api.copy_times[(uid, 1000 + seq)] for seq in range(per_user)]
+            disordered += sum(1 for a, b in zip(times, times[1:]) if b < a)
+        return elapsed, latencies, disordered
+
+    print(
+        f"{args.users} 个用户 × {per_user} 条消息，模拟 API 延迟 "
+        f"{args.latency * 1000:.0f} ms"
+    )
+    print(f"{'workers':>8} {'updates/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'乱序':>5}")
+    for workers in _parse_sizes(args.workers):
+        with tempfile.TemporaryDirectory() as tmp:
+            elapsed, latencies, disordered = asyncio.run(run(tmp, workers))
+        print(
+            f"{workers:>8} {len(latencies) / elapsed:>10.0f} "
+            f"{percentile(latencies, 50) * 1000:>9.1f} "
+            f"{percentile(latencies, 99) * 1000:>9.1f} {disordered:>5}"
+        )
+
+
+class _PrintHandler(logging.Handler):
+    """模拟改造前的行为：每条日志在调用处立即 print 并刷新（相当于 python -u）。"""
+
+    def __init__(self, stream: Any) -> None:
+        super().__init__()
+        self.stream = stream
+
+    def emit(self, record: logging.LogRecord) -> None:
+        print(record.getMessage(), file=self.stream, flush=True)
+
+
+def bench_logging(args: argparse.Namespace) -> None:
+    """日志开销：原先的同步 print（含 DEBUG） vs 队列日志的 DEBUG / 默认 INFO。"""
+    per_user = args.updates // args.users
+    root = logging.getLogger()
+
+    async def run(tmp: str) -> float:
+        api = FakeBotApi()
+        prepare_bot_state(tmp, args.users, api)
+        bot.CONCURRENT_UPDATES = args.workers
+        elapsed, enqueued = await drive_private_updates(
+            build_bench_app(api), api, args.users, per_user
+        )
+        return len(enqueued) / elapsed
+
+    print(f"{args.users} 个用户 × {per_user} 条消息（话题已存在，模拟 API 无延迟）")
+    print(f"{'mode':<22}{'updates/s':>10}{'log lines':>11}")
+    modes = (
+        ("print (改造前, DEBUG)", None, "DEBUG"),
+        ("queue json, DEBUG", "json", "DEBUG"),
+        ("queue json, INFO", "json", "INFO"),
+    )
+    for label, fmt, level in modes:
+        with tempfile.TemporaryDirectory() as tmp:
+            log_path = Path(tmp) / "bot.log"
+            with open(log_path, "w", encoding="utf-8") as log_file:
+                if fmt is None:
+                    for old in root.handlers[:]:
+                        root.removeHandler(old)
+                    root.addHandler(_PrintHandler(log_file))
+                    # 改造前只有 bot.py 自己的 print，第三方库日志未开启
+                    root.setLevel(logging.WARNING)
+                    bot.logger.setLevel(level)
+                    rate = asyncio.run(run(tmp))
+                else:
+                    listener = bot.setup_logging(level, fmt, log_file)
+                    rate = asyncio.run(run(tmp))
+                    listener.stop()
+            with open(log_path, encoding="utf-8") as log_file:
+                lines = sum(1 for _ in log_file)
+        print(f"{label:<22}{rate:>10.0f}{lines:>11}")
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+
+
+def bench_webhook(args: argparse.Namespace) -> None:
+    """本地 webhook 压测：向内置服务器 POST 合成更新，测量端到端延迟与吞吐。"""
+    port = _free_port()
+    secret = "bench-secret"
+    url = f"http://127.0.0.1:{port}/{bot.WEBHOOK_PATH}"
+
+    async def run(tmp: str) -> None:
+        api = FakeBotApi(latency=args.latency)
+        prepare_bot_state(tmp, args.users)
+        bot.CONCURRENT_UPDATES = args.concurrency
+
+        app = build_bench_app(api)
+        async with app:
+            await app.updater.start_webhook(
+                listen="127.0.0.1",
+                port=port,
+                url_path=bot.WEBHOOK_PATH,
+                webhook_url=url,
+                secret_token=secret,
+            )
+            await app.start()
+
+            posted: Dict[Tuple[int, int], float] = {}
+            senders = asyncio.Semaphore(64)
+            async with httpx.AsyncClient() as client:
+                rejected = await client.post(
+                    url,
+                    json=private_update(0, 1, 1, "x"),
+                    headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"},
+                )
+
+                async def post(i: int) -> None:
+                    uid = 1 + i % args.users
+                    message_id = 1000 + i
+                    async with senders:
+                        posted[(uid, message_id)] = perf_counter()
+                        await client.post(
+                            url,
+                            json=private_update(i + 1, uid, message_id, f"m{i}"),
+                            headers={"X-Telegram-Bot-Api-Secret-Token": secret},
+                        )
+
+                started = perf_counter()
+                await asyncio.gather(*(post(i) for i in range(args.updates)))
+                while len(api.copy_times) < args.updates:
+                    await asyncio.sleep(0.01)
+                elapsed = perf_counter() - started
+
+            await app.updater.stop()
+            await app.stop()
+
+        latencies = [api.copy_times[key] - t for key, t in posted.items()]
+        results.update(
+            rejected=rejected.status_code,
+            elapsed=elapsed,
+            latencies=latencies,
+            calls=sum(api.calls.values()),
+        )
+
+    results: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(tmp))
+
+    latencies = results["latencies"]
+    print(f"错误 secret 的请求返回: {results['rejected']}")
+    print(
+        f"{args.updates} 条更新 / {args.users} 个用户 / 并发 {args.concurrency}："
+        f"{args.updates / results['elapsed']:.0f} updates/s，"
+        f"端到端 p50 {percentile(latencies, 50) * 1000:.1f} ms，"
+        f"p99 {percentile(latencies, 99) * 1000:.1f} ms，"
+        f"API 调用 {results['calls']} 次"
+    )
+
+
+# ---------- 负载模拟 ----------
+# 每个阶段：(阶段开始前对假 API 执行的操作, 该阶段投递的更新)
+Phase = Tuple[Optional[Any], List[Dict[str, Any]]]
+
+
+class _UpdateFactory:
+    """为场景生成不重复的 update_id 与 message_id。"""
+
+    def __init__(self) -> None:
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+
+    def private(self, uid: int) -> Dict[str, Any]:
+        mid = next(self._message_ids)
+        return private_update(next(self._update_ids), uid, mid, f"hello {mid}")
+
+    def group(self, uid: int) -> Dict[str, Any]:
+        mid = next(self._message_ids)
+        return group_update(next(self._update_ids), 10**9 + uid, mid, f"reply {mid}")
+
+    def edit(self, original: Dict[str, Any]) -> Dict[str, Any]:
+        return edited_update(next(self._update_ids), original, "edited")
+
+
+def _plan_users(args: argparse.Namespace, api: FakeBotApi) -> List[Phase]:
+    """大量老用户：每人一条消息，10% 收到管理员回复，5% 编辑自己的消息。"""
+    make = _UpdateFactory()
+    uids = range(1, args.users + 1)
+    add_bench_users(uids, api)
+    first = [make.private(uid) for uid in uids]
+    second = [make.group(uid) for uid in uids[::10]]
+    second += [make.edit(update) for update in first[::20]]
+    return [(None, first), (None, second)]
+
+
+def _plan_newusers(args: argparse.Namespace, api: FakeBotApi) -> List[Phase]:
+    """新用户首次发消息：每人都要创建话题、发名片。"""
+    make = _UpdateFactory()
+    uids = range(1, args.new_users + 1)
+    add_bench_users(uids)
+    return [(None, [make.private(uid) for uid in uids])]
+
+
+def _plan_burst(args: argparse.Namespace, api: FakeBotApi) -> List[Phase]:
+    """刷屏：少量用户连续发送大量消息，其中四分之一已被封禁。"""
+    make = _UpdateFactory()
+    spammers = args.burst_users
+    add_bench_users(range(1, spammers + 1), api)
+    add_bench_users(range(1, spammers + 1, 4), banned=True)
+    updates = [
+        make.private(uid)
+        for _ in range(args.burst_messages)
+        for uid in range(1, spammers + 1)
+    ]
+    return [(None, updates)]
+
+
+def _plan_storm(args: argparse.Namespace, api: FakeBotApi) -> List[Phase]:
+    """话题删除风暴：第一轮之后删除一半话题，第二轮触发批量重建。"""
+    make = _UpdateFactory()
+    uids = range(1, args.storm_users + 1)
+    add_bench_users(uids, api)
+
+    def delete_half(fake: FakeBotApi) -> None:
+        for uid in uids[::2]:
+            fake.topics.discard(10**9 + uid)
+
+    return [
+        (None, [make.private(uid) for uid in uids]),
+        (delete_half, [make.private(uid) for uid in uids]),
+    ]
+
+
+def _plan_faults(args: argparse.Namespace, api: FakeBotApi) -> List[Phase]:
+    """故障注入：429 与话题重定向，老用户与新用户混合。"""
+    make = _UpdateFactory()
+    api.retry_rate = args.retry_rate
+    api.redirect_rate = args.redirect_rate
+    existing = range(1, args.storm_users + 1)
+    fresh = range(args.storm_users + 1, args.storm_users + args.new_users // 2 + 1)
+    add_bench_users(existing, api)
+    add_bench_users(fresh)
+    updates = [make.private(uid) for uid in list(existing) + list(fresh)]
+    return [(None, updates), (None, [make.private(uid) for uid in existing])]
+
+
+SCENARIOS = {
+    "users": _plan_users,
+    "newusers": _plan_newusers,
+    "burst": _plan_burst,
+    "storm": _plan_storm,
+    "faults": _plan_faults,
+}
+
+
+def _source_key(update: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    message = update.get("message")
+    if message is None:
+        return None
+    return message["chat"]["id"], message["message_id"]
+
+
+async def run_scenario(name: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """运行一个场景，返回吞吐、API 调用数、转发延迟与内存峰值等指标。"""
+    api = FakeBotApi(latency=args.latency, seed=args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        prepare_bot_state(tmp, 0)
+        bot.ingress = _default_ingress()
+        bot.CONCURRENT_UPDATES = args.workers
+        bot.media_groups = bot.MediaGroupBuffer(bot.MEDIA_GROUP_WINDOW_SECONDS)
+        bot.forward_coalescer = bot.ForwardCoalescer(
+            bot.FORWARD_COALESCE_WINDOW_SECONDS, bot.FORWARD_COALESCE_MAX_BATCH
+        )
+        bot.edit_sync = bot.EditDebouncer(bot.EDIT_SYNC_WINDOW_SECONDS)
+        phases = SCENARIOS[name](args, api)
+        app = build_bench_app(api)
+
+        enqueued: Dict[Tuple[int, int], float] = {}
+        total = 0
+        async with app:
+            await app.start()
+            started = perf_counter()
+            for before, updates in phases:
+                if before is not None:
+                    before(api)
+                for raw in updates:
+                    key = _source_key(raw)
+                    if key is not None:
+                        enqueued[key] = perf_counter()
+                    await app.update_queue.put(Update.de_json(raw, app.bot))
+                total += len(updates)
+                await app.update_queue.join()
+                await bot.media_groups.close()
+                await bot.forward_coalescer.close()
+                await bot.edit_sync.close()
+            elapsed = perf_counter() - started
+
+            # 定时任务：增量过期与磁盘清理（含统计日志）
+            job_context = SimpleNamespace(bot=app.bot)
+            cleanup_started = perf_counter()
+            await bot.expire_message_map(job_context)
+            await bot.cleanup_message_map(job_context)
+            cleanup_seconds = perf_counter() - cleanup_started
+            await app.stop()
+        await bot.persister.close()
+
+    latencies = [
+        api.copy_times[key] - t for key, t in enqueued.items() if key in api.copy_times
+    ]
+    return {
+        "scenario": name,
+        "updates": total,
+        "rate": total / elapsed,
+        "api_per_update": (sum(api.calls.values()) - api.calls["getMe"]) / total,
+        "p50_ms": percentile(latencies, 50) * 1000 if latencies else 0.0,
+        "p99_ms": percentile(latencies, 99) * 1000 if latencies else 0.0,
+        "forwarded": len(latencies),
+        "topics_created": api.calls["createForumTopic"],
+        "injected": dict(api.injected),
+        "cleanup_ms": cleanup_seconds * 1000,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def bench_simulate(args: argparse.Namespace) -> None:
+    """负载模拟：各场景分别在独立子进程中运行，内存峰值互不影响。"""
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(
+            f"未知场景: {', '.join(unknown)}（可选 {', '.join(SCENARIOS)}）"
+        )
+
+    if args.child:
+        print(json.dumps(asyncio.run(run_scenario(names[0], args))))
+        return
+
+    print(
+        f"workers {args.workers}，模拟 API 延迟 {args.latency * 1000:.0f} ms，"
+        f"seed {args.seed}"
+    )
+    print(
+        f"{'scenario':<10}{'updates':>8}{'upd/s':>8}{'API/upd':>9}{'p50 ms':>9}"
+        f"{'p99 ms':>9}{'topics':>8}{'cleanup':>9}{'RSS MB':>8}  注入"
+    )
+    options = ("workers", "latency", "seed", "users", "new_users", "burst_users")
+    options += ("burst_messages", "storm_users", "retry_rate", "redirect_rate")
+    passthrough = []
+    for option in options:
+        passthrough += ["--" + option.replace("_", "-"), str(getattr(args, option))]
+    for name in names:
+        child = subprocess.run(
+            [sys.executable, __file__, "simulate", "--child", "--scenarios", name]
+            + passthrough,
+            capture_output=True,
+            text=True,
+        )
+        if child.returncode != 0:
+            print(f"{name:<10} 失败：\n{child.stderr}")
+            continue
+        r = json.loads(child.stdout.strip().splitlines()[-1])
+        injected = ", ".join(f"{k}={v}" for k, v in r["injected"].items()) or "-"
+        print(
+            f"{r['scenario']:<10}{r['updates']:>8}{r['rate']:>8.0f}"
+            f"{r['api_per_update']:>9.2f}{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+            f"{r['topics_created']:>8}{r['cleanup_ms']:>8.1f}ms"
+            f"{r['peak_rss_mb']:>8.0f}  {injected}"
+        )
+
+
+# ---------- 多副本 ----------
+def _replica_worker_child(args: argparse.Namespace) -> None:
+    """子进程：以 REPLICA_ROLE=worker 运行 bot（环境变量由父进程设置），连接假 API。"""
+    api = FakeBotApi(latency=args.latency)
+    api.topics.update(10**9 + uid for uid in range(1, args.users + 1))
+    bot.load_persisted_mapping()
+    asyncio.run(bot._run_replica_worker(build_bench_app(api)))
+
+
+async def _scrape_handled(client: httpx.AsyncClient, port: int) -> int:
+    """从 worker 的指标端点读取已处理完的更新数。"""
+    try:
+        text = (await client.get(f"http://127.0.0.1:{port}/metrics")).text
+    except httpx.HTTPError:
+        return -1
+    for line in text.splitlines():
+        if line.startswith("tgbot_update_handle_seconds_count"):
+            return int(float(line.split()[-1]))
+    return 0
+
+
+def bench_replicas(args: argparse.Namespace) -> None:
+    """多副本压测：本进程充当 router，按用户分区转发给 N 个 worker 子进程。
+
+    每个 worker 的并发与 API 延迟固定，单副本吞吐受 I/O 限制，
+    吞吐随副本数的变化即为分区带来的扩展。worker 共享同一个 SQLite 数据库。
+    """
+    if args.child:
+        _replica_worker_child(args)
+        return
+
+    secret = "bench-replica-secret"
+    per_user = args.updates // args.users
+
+    async def run(nodes: List[str], metric_ports: List[int]) -> float:
+        router = bot.ReplicaRouter(nodes, secret)
+        await router.start()
+        async with httpx.AsyncClient(timeout=1) as client:
+            while min([await _scrape_handled(client, p) for p in metric_ports]) < 0:
+                await asyncio.sleep(0.1)
+            factory = _UpdateFactory()
+            started = perf_counter()
+            for _ in range(per_user):
+                for uid in range(1, args.users + 1):
+                    router.submit(Update.de_json(factory.private(uid), None))
+            total = per_user * args.users
+            while sum([await _scrape_handled(client, p) for p in metric_ports]) < total:
+                await asyncio.sleep(0.02)
+            elapsed = perf_counter() - started
+        await router.stop()
+        return elapsed
+
+    print(
+        f"{args.users} 个用户 × {per_user} 条消息，每个 worker 并发 {args.workers}，"
+        f"模拟 API 延迟 {args.latency * 1000:.0f} ms"
+    )
+    print(f"{'replicas':>8} {'updates/s':>10} {'分区用户数':>16}")
+    for count in _parse_sizes(args.replicas):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Path(tmp) / "bot.db"
+            shared = bot.SqliteStorage(db)
+            shared.write(
+                {uid: (10**9 + uid, True, False) for uid in range(1, args.users + 1)}
+            )
+            shared.close()
+
+            ports = [_free_port() for _ in range(count)]
+            metric_ports = [_free_port() for _ in range(count)]
+            nodes = [f"http://127.0.0.1:{port}" for port in ports]
+            children = []
+            for node, port, metric_port in zip(nodes, ports, metric_ports):
+                env = dict(
+                    os.environ,
+                    REPLICA_ROLE="worker",
+                    REPLICA_NODES=",".join(nodes),
+                    REPLICA_SELF=node,
+                    REPLICA_PORT=str(port),
+                    REPLICA_LISTEN="127.0.0.1",
+                    REPLICA_SECRET=secret,
+                    STORAGE_BACKEND="sqlite",
+                    SQLITE_PATH=str(db),
+                    MESSAGE_MAP_DB="",
+                    METRICS_PORT=str(metric_port),
+                    CONCURRENT_UPDATES=str(args.workers),
+                    SEND_GLOBAL_RATE="1e9",
+                    SEND_CHAT_RATE="1e9",
+                    SEND_CHAT_BURST="1000000",
+                    SEND_GROUP_RATE_PER_MINUTE="1e12",
+                    SEND_GROUP_BURST="1000000",
+                    LOG_LEVEL="WARNING",
+                )
+                children.append(
+                    subprocess.Popen(
+                        [sys.executable, __file__, "replicas", "--child"]
+                        + ["--users", str(args.users)]
+                        + ["--latency", str(args.latency)],
+                        env=env,
+                    )
+                )
+            try:
+                elapsed = asyncio.run(run(nodes, metric_ports))
+            finally:
+                for child in children:
+                    child.terminate()
+                for child in children:
+                    child.wait(timeout=30)
+
+        ring = bot.HashRing(nodes)
+        spread = Counter(ring.node_for(uid) for uid in range(1, args.users + 1))
+        shares = "/".join(str(spread[node]) for node in nodes)
+        print(f"{count:>8} {per_user * args.users / elapsed:>10.0f} {shares:>16}")
+
+
+# ---------- 多租户 ----------
+def _current_rss_mb() -> float:
+    with open("/proc/self/statm") as fp:
+        return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+async def _run_tenant_host(args: argparse.Namespace, tmp: str) -> Dict[str, Any]:
+    """子进程：加载 N 个租户并各自处理一轮消息，再同时写全量 JSON 快照，
+    期间用定时协程测量事件循环的最大停顿。"""
+    config = {
+        f"t{i}": {"BOT_TOKEN": f"{i + 1}:BENCH", "GROUP_ID": str(BENCH_GROUP_ID)}
+        for i in range(args.count)
+    }
+    path = Path(tmp) / "tenants.json"
+    path.write_text(json.dumps(config))
+    bot.TENANT_DATA_DIR = Path(tmp)
+    tenants = bot.load_tenants(str(path))
+
+    writer = bot.ThreadPoolExecutor(max_workers=1)
+    pool = bot.new_cpu_pool()
+    apps = []
+    for tenant in tenants.values():
+        tenant.persist_executor = writer
+        tenant.cpu_pool = pool if args.pool else None
+        tenant.snapshot_encoder = bot._encode_snapshot
+        tenant.outbound = tenant.OutboundScheduler(1e9, 1e9, 10**6, 1e9, 10**6, 10**6)
+        api = FakeBotApi()
+        for uid in range(1, args.users + 1):
+            session = tenant.get_session(uid)
+            session.verified = True
+            session.thread_id = 10**9 + uid
+            tenant.thread_to_user[session.thread_id] = uid
+            api.topics.add(session.thread_id)
+        app = tenant.build_application(
+            ApplicationBuilder().token(tenant.BOT_TOKEN).request(api)
+        )
+        await app.initialize()
+        await app.start()
+        for uid in range(1, 101):
+            raw = private_update(uid, uid, 1000 + uid, "hello")
+            await app.update_queue.put(Update.de_json(raw, app.bot))
+        await app.update_queue.join()
+        apps.append((tenant, app))
+
+    rss = _current_rss_mb()
+    state = sum(sum(t.state_memory_bytes().values()) for t in tenants.values())
+
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def ticker() -> None:
+        nonlocal lag
+        while not done.is_set():
+            started = perf_counter()
+            await asyncio.sleep(0.005)
+            lag = max(lag, perf_counter() - started - 0.005)
+
+    tick = asyncio.create_task(ticker())
+    started = perf_counter()
+    for tenant in tenants.values():
+        tenant.persist_mapping()
+    await asyncio.gather(*(tenant.persister.flush() for tenant in tenants.values()))
+    snapshot = perf_counter() - started
+    done.set()
+    await tick
+
+    for tenant, app in apps:
+        await app.stop()
+        await app.shutdown()
+        await tenant.on_shutdown(app)
+    writer.shutdown()
+    pool.shutdown()
+    return {
+        "rss_mb": rss,
+        "state_mb": state / 2**20,
+        "snapshot_s": snapshot,
+        "lag_ms": lag * 1000,
+    }
+
+
+def bench_tenants(args: argparse.Namespace) -> None:
+    """多租户：同一进程托管 N 个机器人的内存占用，以及大快照编码放进进程池
+    前后的事件循环停顿。每种配置在独立子进程中运行。"""
+    if args.child:
+        with tempfile.TemporaryDirectory() as tmp:
+            print(json.dumps(asyncio.run(_run_tenant_host(args, tmp))))
+        return
+
+    def child(count: int, pool: bool) -> Dict[str, Any]:
+        result = subprocess.run(
+            [sys.executable, __file__, "tenants", "--child"]
+            + ["--count", str(count), "--users", str(args.users)]
+            + (["--pool"] if pool else []),
+            capture_output=True,
+            text=True,
+            env=dict(os.environ, LOG_LEVEL="WARNING"),
+        )
+        if result.returncode != 0:
+            raise SystemExit(result.stderr)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    print(f"每个租户 {args.users} 个用户（JSON 存储），写全量快照时测量事件循环停顿")
+    print(
+        f"{'tenants':>7} {'RSS MB':>8} {'N 个独立进程':>12} {'状态 MB':>8}"
+        f" {'快照 s':>7} {'停顿 ms':>8} {'进程池快照 s':>12} {'停顿 ms':>8}"
+    )
+    single = None
+    for count in _parse_sizes(args.tenants):
+        inline = child(count, pool=False)
+        pooled = child(count, pool=True)
+        if single is None:
+            single = child(1, pool=False)["rss_mb"]
+        print(
+            f"{count:>7} {pooled['rss_mb']:>8.0f} {single * count:>12.0f}"
+            f" {pooled['state_mb']:>8.1f} {inline['snapshot_s']:>7.2f}"
+            f" {inline['lag_ms']:>8.0f} {pooled['snapshot_s']:>12.2f}"
+            f" {pooled['lag_ms']:>8.0f}"
+        )
+
+
+# ---------- 定时过期 ----------
+def bench_expiry(args: argparse.Namespace) -> None:
+    """短期状态过期：每个条目一个 sleep 任务（改造前）vs 共享时间轮。
+
+    登记 N 个 300 秒后过期的条目（模拟 /start 刷屏），测量登记耗时、常驻内存、
+    重新计时（答错换题）与取消（验证成功）的开销；再用短过期时间测量全部条目
+    到期清理所需的时间。
+    """
+
+    async def run_tasks(n: int, delay: float) -> Dict[str, float]:
+        answers: Dict[int, int] = {}
+        tasks: Dict[int, asyncio.Task] = {}
+
+        async def expire(uid: int) -> None:
+            await asyncio.sleep(delay)
+            answers.pop(uid, None)
+
+        def schedule_all() -> None:
+            for uid in range(n):
+                answers[uid] = uid
+                tasks[uid] = asyncio.create_task(expire(uid))
+
+        started = perf_counter()
+        schedule_all()
+        await asyncio.sleep(0)  # 让任务运行到 sleep，计入其协程帧与定时器
+        schedule = perf_counter() - started
+
+        started = perf_counter()
+        for uid in range(0, n, 2):
+            # 改造前答错换题不会重新计时；要重新计时只能取消旧任务再建新任务
+            tasks[uid].cancel()
+            tasks[uid] = asyncio.create_task(expire(uid))
+        reschedule = perf_counter() - started
+
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.sleep(0)
+        tasks.clear()
+        answers.clear()
+        tracemalloc.start()
+        schedule_all()
+        await asyncio.sleep(0)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return {"schedule": schedule, "memory": memory, "reschedule": reschedule}
+
+    async def run_wheel(n: int, delay: float) -> Dict[str, float]:
+        answers: Dict[int, int] = {}
+
+        def schedule_all() -> Any:
+            wheel = bot.ExpiryWheel(tick=args.tick)
+            wheel.register("math_answer", lambda uid: answers.pop(uid, None))
+            for uid in range(n):
+                answers[uid] = uid
+                wheel.schedule("math_answer", uid, delay)
+            return wheel
+
+        started = perf_counter()
+        wheel = schedule_all()
+        schedule = perf_counter() - started
+
+        started = perf_counter()
+        for uid in range(0, n, 2):
+            wheel.schedule("math_answer", uid, delay)
+        reschedule = perf_counter() - started
+        await wheel.close()
+
+        answers.clear()
+        tracemalloc.start()
+        wheel = schedule_all()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        await wheel.close()
+        return {"schedule": schedule, "memory": memory, "reschedule": reschedule}
+
+    async def drain(kind: str, n: int, delay: float) -> float:
+        """全部条目 delay 秒后过期，测量从登记完到全部清理完的时间。"""
+        answers = dict.fromkeys(range(n), 1)
+        if kind == "tasks":
+
+            async def expire(uid: int) -> None:
+                await asyncio.sleep(delay)
+                answers.pop(uid, None)
+
+            for uid in range(n):
+                asyncio.create_task(expire(uid))
+        else:
+            wheel = bot.ExpiryWheel(tick=args.tick)
+            wheel.register("x", lambda uid: answers.pop(uid, None))
+            for uid in range(n):
+                wheel.schedule("x", uid, delay)
+        started = perf_counter()
+        while answers:
+            await asyncio.sleep(0.01)
+        return perf_counter() - started
+
+    print(f"过期时间 300 s，时间轮刻度 {args.tick} s；重新计时为一半条目")
+    print(
+        f"{'entries':>8} {'方式':<6} {'登记 µs/条':>10} {'内存 B/条':>10}"
+        f" {'重新计时 µs/条':>14} {'1 s 过期清理 s':>14}"
+    )
+    for n in _parse_sizes(args.entries):
+        for kind, run in (("tasks", run_tasks), ("wheel", run_wheel)):
+            r = asyncio.run(_bench_expiry_once(run, n))
+            cleanup = asyncio.run(drain(kind, n, 1.0))
+            print(
+                f"{n:>8} {kind:<6} {r['schedule'] / n * 1e6:>10.2f}"
+                f" {r['memory'] / n:>10.0f} {r['reschedule'] / (n / 2) * 1e6:>14.2f}"
+                f" {cleanup:>14.2f}"
+            )
+
+
+async def _bench_expiry_once(run: Any, n: int) -> Dict[str, float]:
+    # 只测登记与重新计时：过期时间足够长，测完直接结束事件循环
+    result = await run(n, 300.0)
+    for task in asyncio.all_tasks() - {asyncio.current_task()}:
+        task.cancel()
+    return result
+
+
+# ---------- 预建话题池 ----------
+def bench_topicpool(args: argparse.Namespace) -> None:
+    """新用户首条消息的端到端延迟：现建话题 vs 从预建话题池取用。
+
+    新用户按 --interval 间隔陆续到达（池有时间在后台补充），
+    统计从收到更新到消息复制进话题的延迟，以及平均每个新用户的 API 调用数
+    （含期间后台补充话题池的调用）。
+    """
+
+    async def run(tmp: str, size: int) -> Dict[str, Any]:
+        api = FakeBotApi(latency=args.latency)
+        prepare_bot_state(tmp, 0)
+        uids = range(1, args.users + 1)
+        add_bench_users(uids)
+        bot.topic_pool = bot.TopicPool(size)
+        app = build_bench_app(api)
+        factory = _UpdateFactory()
+        enqueued: Dict[Tuple[int, int], float] = {}
+        async with app:
+            await app.start()
+            bot.topic_pool.start(app.bot)
+            started = perf_counter()
+            while len(bot.storage.pooled_topics()) < size:
+                await asyncio.sleep(0.01)
+            prefill = perf_counter() - started
+            background = sum(api.calls.values())
+            for uid in uids:
+                raw = factory.private(uid)
+                enqueued[_source_key(raw)] = perf_counter()
+                await app.update_queue.put(Update.de_json(raw, app.bot))
+                await asyncio.sleep(args.interval)
+            await app.update_queue.join()
+            await bot.topic_pool.close()
+            await app.stop()
+        await bot.persister.close()
+        latencies = [api.copy_times[key] - t for key, t in enqueued.items()]
+        return {
+            "prefill_s": prefill,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "api": sum(api.calls.values()) - background,
+            "hits": bot.TOPIC_POOL_TAKES.value("hit"),
+        }
+
+    print(
+        f"{args.users} 个新用户，每 {args.interval * 1000:.0f} ms 到达一个，"
+        f"模拟 API 延迟 {args.latency * 1000:.0f} ms"
+    )
+    print(
+        f"{'pool':>5} {'预热 s':>7} {'p50 ms':>8} {'p99 ms':>8}"
+        f" {'API/新用户':>10} {'命中':>6}"
+    )
+    for size in _parse_sizes(args.sizes):
+        bot.TOPIC_POOL_TAKES._values.clear()
+        with tempfile.TemporaryDirectory() as tmp:
+            r = asyncio.run(run(tmp, size))
+        print(
+            f"{size:>5} {r['prefill_s']:>7.2f} {r['p50_ms']:>8.0f} {r['p99_ms']:>8.0f}"
+            f" {r['api'] / args.users:>10.2f} {r['hits']:>6.0f}"
+        )
+
+
+# ---------- 编辑同步 ----------
+def bench_editsync(args: argparse.Namespace) -> None:
+    """连续编辑的同步开销：每次编辑一个 API 调用（窗口 0）vs 按消息防抖合并。
+
+    --users 个用户各发一条消息，随后每隔 --interval 秒把它编辑一次，共 --edits 次。
+    统计 editMessageText 调用数、合并掉的编辑数、目标消息最终是否为最后一次的内容，
+    以及从最后一次编辑到全部同步完成的时间。
+    """
+
+    async def run(tmp: str, window: float) -> Dict[str, Any]:
+        api = FakeBotApi(latency=args.latency)
+        uids = range(1, args.users + 1)
+        prepare_bot_state(tmp, args.users, api)
+        bot.edit_sync = bot.EditDebouncer(window)
+        factory = _UpdateFactory()
+        originals = [factory.private(uid) for uid in uids]
+        app = build_bench_app(api)
+        async with app:
+            await app.start()
+            for raw in originals:
+                await app.update_queue.put(Update.de_json(raw, app.bot))
+            await app.update_queue.join()
+            for n in range(args.edits):
+                if n:
+                    await asyncio.sleep(args.interval)
+                for raw in originals:
+                    edit = edited_update(next(factory._update_ids), raw, f"v{n}")
+                    await app.update_queue.put(Update.de_json(edit, app.bot))
+            await app.update_queue.join()
+            last_edit = perf_counter()
+            while bot.edit_sync._timers or bot.edit_sync._running:
+                await asyncio.sleep(0.005)
+            settle = perf_counter() - last_edit
+            await app.stop()
+        await bot.persister.close()
+        final = f"v{args.edits - 1}"
+        return {
+            "calls": api.calls["editMessageText"],
+            "sent": bot.edit_sync.sent,
+            "coalesced": bot.edit_sync.coalesced,
+            "latest": sum(text == final for text in api.edits.values()),
+            "settle": settle,
+        }
+
+    print(
+        f"{args.users} 个用户各编辑 {args.edits} 次，间隔 {args.interval} s，"
+        f"模拟 API 延迟 {args.latency * 1000:.0f} ms"
+    )
+    print(
+        f"{'window s':>8} {'edit 调用':>9} {'sent':>6} {'coalesced':>9}"
+        f" {'最终内容正确':>12} {'同步完成 s':>10}"
+    )
+    for window in [float(w) for w in args.windows.split(",") if w.strip()]:
+        with tempfile.TemporaryDirectory() as tmp:
+            r = asyncio.run(run(tmp, window))
+        print(
+            f"{window:>8.1f} {r['calls']:>9} {r['sent']:>6} {r['coalesced']:>9}"
+            f" {r['latest']:>8}/{args.users:<4} {r['settle']:>10.2f}"
+        )
+
+
+# ---------- 入站防刷 ----------
+def bench_ingress(args: argparse.Namespace) -> None:
+    """刷屏流量下的准入检查：无检查（改造前）vs 排队前的令牌桶准入。
+
+    --flooders 个已验证用户、同样数量的已封禁用户和未验证用户（连续答错数学题）
+    各发送 --messages 条消息，期间 --users 个普通用户各发一条。统计总耗时、
+    API 调用数（其中回复给刷屏者的 sendMessage）、各原因的丢弃数，
+    以及普通用户消息从入队到复制进话题的延迟。
+    """
+
+    async def run(tmp: str, guarded: bool) -> Dict[str, Any]:
+        api = FakeBotApi(latency=args.latency)
+        prepare_bot_state(tmp, 0)
+        bot.USE_MATH_CAPTCHA = True
+        bot.ingress = _default_ingress(args.rate) if guarded else None
+        bot.CONCURRENT_UPDATES = args.workers
+        n = args.flooders
+        normal = range(1, args.users + 1)
+        flooders = range(10**6, 10**6 + n)
+        banned = range(2 * 10**6, 2 * 10**6 + n)
+        unverified = range(3 * 10**6, 3 * 10**6 + n)
+        add_bench_users(normal, api)
+        add_bench_users(flooders, api)
+        add_bench_users(banned, api, banned=True)
+        for uid in unverified:
+            bot._set_math_answer(uid, -1)
+
+        factory = _UpdateFactory()
+        spam = [
+            factory.private(uid)
+            for _ in range(args.messages)
+            for group in (flooders, banned, unverified)
+            for uid in group
+        ]
+        step = max(1, len(spam) // len(normal))
+        updates: List[Dict[str, Any]] = []
+        for i, uid in enumerate(normal):
+            updates += spam[i * step : (i + 1) * step] + [factory.private(uid)]
+        updates += spam[len(normal) * step :]
+
+        app = build_bench_app(api)
+        enqueued: Dict[Tuple[int, int], float] = {}
+        async with app:
+            await app.start()
+            started = perf_counter()
+            for raw in updates:
+                key = _source_key(raw)
+                if key[0] in normal:
+                    enqueued[key] = perf_counter()
+                await app.update_queue.put(Update.de_json(raw, app.bot))
+            await app.update_queue.join()
+            elapsed = perf_counter() - started
+            await app.stop()
+        await bot.persister.close()
+        latencies = [api.copy_times[key] - t for key, t in enqueued.items()]
+        return {
+            "updates": len(updates),
+            "elapsed": elapsed,
+            "api": sum(api.calls.values()) - api.calls["getMe"],
+            "replies": api.calls["sendMessage"],
+            "dropped": {
+                reason: bot.INGRESS_DROPPED.value(reason)
+                for reason in ("banned", "flood", "captcha")
+            },
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+        }
+
+    print(
+        f"刷屏用户每类 {args.flooders} 个 × {args.messages} 条，"
+        f"普通用户 {args.users} 个，已验证用户限速 {args.rate:g}/s，"
+        f"模拟 API 延迟 {args.latency * 1000:.0f} ms"
+    )
+    print(
+        f"{'准入':<6}{'updates':>8}{'耗时 s':>8}{'API':>7}{'回复':>7}"
+        f"{'丢弃 banned/flood/captcha':>27}{'普通 p50 ms':>12}{'p99 ms':>8}"
+    )
+    for guarded in (False, True):
+        bot.INGRESS_DROPPED._values.clear()
+        with tempfile.TemporaryDirectory() as tmp:
+            r = asyncio.run(run(tmp, guarded))
+        dropped = "/".join(f"{v:.0f}" for v in r["dropped"].values())
+        print(
+            f"{'令牌桶' if guarded else '无':<6}{r['updates']:>8}{r['elapsed']:>8.2f}"
+            f"{r['api']:>7}{r['replies']:>7}{dropped:>27}"
+            f"{r['p50_ms']:>12.1f}{r['p99_ms']:>8.1f}"
+        )
+
+
+# ---------- 启动加载 ----------
+def _write_legacy_mapping(path: Path, users: int) -> None:
+    """生成旧格式的 topic_mapping.json：半数用户有话题，2% 已封禁。"""
+    rows = {
+        uid: (10**9 + uid if uid % 2 else None, True, uid % 50 == 0)
+        for uid in range(10**8, 10**8 + users)
+    }
+    path.write_text(
+        bot._encode_snapshot(bot.SessionTable.from_rows(rows).columns(), {})
+    )
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss 在 exec 后仍保留父进程 fork 时的峰值，这里读取本进程自己的 VmHWM
+    with open("/proc/self/status") as fp:
+        for line in fp:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _startup_child(args: argparse.Namespace) -> Dict[str, Any]:
+    """子进程：按 --mode 加载 --path 指向的数据，测量启动耗时与首次查询延迟。"""
+    path = Path(args.path)
+    started = perf_counter()
+    if args.mode == "eager":
+        # 旧版行为：整个文件 json.loads 后为每个用户建立 UserSession
+        data = json.loads(path.read_text(encoding="utf-8"))
+        verified = {int(k): v for k, v in data["user_verified"].items()}
+        threads = {int(k): int(v) for k, v in data["user_to_thread"].items()}
+        banned = set(data["banned_users"])
+        del data
+        bot.user_sessions = {
+            uid: bot._session_from_row(
+                uid, (threads.get(uid), bool(verified.get(uid)), uid in banned)
+            )
+            for uid in set(threads) | set(verified) | banned
+        }
+        bot.thread_to_user = {tid: uid for uid, tid in threads.items()}
+        bot.storage = bot.JsonFileStorage(path)
+    else:
+        if args.mode == "sqlite":
+            bot.storage = bot.SqliteStorage(path.with_suffix(".db"), path)
+        else:
+            bot.storage = bot.JsonFileStorage(path)
+        bot.load_persisted_mapping()
+    startup = perf_counter() - started
+
+    uid = 10**8 + args.users // 2 + 1
+    started = perf_counter()
+    session = bot.get_session(uid)
+    lookup = perf_counter() - started
+    assert session.thread_id == 10**9 + uid and session.verified
+    assert bot.user_for_thread(session.thread_id) == uid
+    bot.storage.close()
+    return {
+        "startup_s": startup,
+        "lookup_ms": lookup * 1000,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def bench_startup(args: argparse.Namespace) -> None:
+    """启动加载：旧版全量 json.loads 与按需加载（JSON 流式解析 / 二进制快照 /
+    SQLite）的启动耗时、峰值内存与首次会话查询延迟。每次启动在独立子进程中运行。"""
+    if args.child:
+        print(json.dumps(_startup_child(args)))
+        return
+
+    def child(mode: str, path: Path, users: int) -> Dict[str, Any]:
+        result = subprocess.run(
+            [sys.executable, __file__, "startup", "--child"]
+            + ["--mode", mode, "--path", str(path), "--users", str(users)],
+            capture_output=True,
+            text=True,
+            env=dict(os.environ, LOG_LEVEL="WARNING"),
+        )
+        if result.returncode != 0:
+            raise SystemExit(result.stderr)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    print(
+        f"{'users':>9} {'JSON MB':>8}  {'加载方式':<22}{'启动 s':>8}{'峰值 RSS MB':>12}{'首次查询 ms':>12}"
+    )
+    for users in _parse_sizes(args.sizes):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "topic_mapping.json"
+            _write_legacy_mapping(path, users)
+            size_mb = path.stat().st_size / 1e6
+            for label, mode in (
+                ("旧版全量 json.loads", "eager"),
+                ("JSON 首次（流式解析）", "json"),
+                ("JSON 再次（二进制快照）", "json"),
+                ("SQLite 首次（迁移）", "sqlite"),
+                ("SQLite 再次", "sqlite"),
+            ):
+                r = child(mode, path, users)
+                print(
+                    f"{users:>9} {size_mb:>8.1f}  {label:<22}{r['startup_s']:>8.2f}"
+                    f"{r['peak_rss_mb']:>12.0f}{r['lookup_ms']:>12.3f}"
+                )
+
+
+# ---------- HTTP 连接池 ----------
+def bench_httppool(args: argparse.Namespace) -> None:
+    """HTTP 连接池：本地 HTTP 服务模拟 Bot API（固定延迟），两轮突发的 copy_message
+    之间空闲 gap 秒，比较 PTB 默认请求对象与不同大小的调优连接池。"""
+
+    async def run(name: str, request: Optional[BaseRequest]) -> str:
+        connections = 0
+
+        async def handle(
+            method: str, path: str, headers: Dict[str, str], body: bytes
+        ) -> Tuple[str, bytes]:
+            await asyncio.sleep(args.latency)
+            endpoint = path.rsplit("/", 1)[-1]
+            if endpoint == "getMe":
+                result: Any = {"id": 1, "is_bot": True, "first_name": "bench"}
+            else:
+                result = {"message_id": 1}
+            return "200 OK", json.dumps({"ok": True, "result": result}).encode()
+
+        serve = bot._serve_http(handle)
+
+        async def on_connection(
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            nonlocal connections
+            connections += 1
+            await serve(reader, writer)
+
+        server = await asyncio.start_server(on_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        api_bot = Bot(
+            os.environ["BOT_TOKEN"],
+            base_url=f"http://127.0.0.1:{port}/bot",
+            request=request,
+        )
+        waits_before = bot.HTTP_POOL_WAITS.value("api")
+        bursts = []
+        async with api_bot:
+            for round_no in range(2):
+                if round_no:
+                    await asyncio.sleep(args.gap)
+                opened = connections
+                latencies: List[float] = []
+
+                async def copy(i: int) -> None:
+                    started = perf_counter()
+                    await api_bot.copy_message(BENCH_GROUP_ID, i + 1, 1)
+                    latencies.append(perf_counter() - started)
+
+                started = perf_counter()
+                await asyncio.gather(*(copy(i) for i in range(args.burst)))
+                bursts.append(
+                    f"{perf_counter() - started:>7.2f}s"
+                    f"{percentile(latencies, 99) * 1000:>8.0f}"
+                    f"{connections - opened:>6}"
+                )
+        server.close()
+        await server.wait_closed()
+        waits = bot.HTTP_POOL_WAITS.value("api") - waits_before
+        return f"{name:<16}" + "".join(bursts) + f"{waits:>8.0f}"
+
+    print(
+        f"每轮 {args.burst} 个并发 copy_message，模拟 API 延迟 "
+        f"{args.latency * 1000:.0f} ms，两轮间隔 {args.gap:.0f} s"
+    )
+    print(
+        f"{'pool':<16}{'第1轮':>7}{'p99 ms':>8}{'新连接':>5}"
+        f"{'第2轮':>7}{'p99 ms':>8}{'新连接':>5}{'排队':>7}"
+    )
+    configs: List[Tuple[str, Any]] = [("PTB 默认", lambda: HTTPXRequest())]
+    for size in _parse_sizes(args.sizes):
+        configs.append(
+            (
+                f"BotApiRequest {size}",
+                lambda size=size: bot.BotApiRequest("api", size, False),
+            )
+        )
+    for name, factory in configs:
+        print(asyncio.run(run(name, factory())))
+
+
+# ---------- 回归检查 ----------
+async def _deliver(app: Application, *updates: Dict[str, Any]) -> None:
+    for raw in updates:
+        await app.update_queue.put(Update.de_json(raw, app.bot))
+    await app.update_queue.join()
+
+
+async def check_copy_failure_keeps_topic(tmp: str) -> None:
+    """与话题无关的复制失败（消息无法复制）不应清除话题映射、不应新建话题。"""
+    api = FakeBotApi()
+    prepare_bot_state(tmp, 1, api)
+    make = _UpdateFactory()
+    app = build_bench_app(api)
+    async with app:
+        await app.start()
+        api.fail_next["copyMessage"].append(
+            (400, "Bad Request: message can't be copied")
+        )
+        await _deliver(app, make.private(1))
+        await _deliver(app, make.private(1))
+        await app.stop()
+    await bot.persister.close()
+    assert api.calls["createForumTopic"] == 0, api.calls
+    assert bot.get_session(1).thread_id == 10**9 + 1
+    assert len(api.copy_times) == 1, api.copy_times
+
+
+async def check_pool_rename_failure_returns_topic(tmp: str) -> None:
+    """预建话题改名失败（与话题无关）时应放回池中，用户改用现建话题。"""
+    api = FakeBotApi()
+    prepare_bot_state(tmp, 0)
+    add_bench_users([1])
+    bot.topic_pool = bot.TopicPool(1)
+    make = _UpdateFactory()
+    app = build_bench_app(api)
+    async with app:
+        await app.start()
+        bot.topic_pool.start(app.bot)
+        while not bot.storage.pooled_topics():
+            await asyncio.sleep(0.01)
+        pooled = bot.storage.pooled_topics()
+        api.fail_next["editForumTopic"].append((400, "Bad Request: not enough rights"))
+        await _deliver(app, make.private(1))
+        await bot.topic_pool.close()
+        await app.stop()
+    await bot.persister.close()
+    assert bot.storage.pooled_topics() == pooled, bot.storage.pooled_topics()
+    assert api.calls["createForumTopic"] == 2, api.calls
+    assert bot.get_session(1).thread_id not in pooled
+
+
+async def check_album_locks_once(tmp: str) -> None:
+    """已验证用户的相册各条直接缓冲，整组只获取一次用户锁、一次 copyMessages。"""
+    api = FakeBotApi()
+    prepare_bot_state(tmp, 1, api)
+    make = _UpdateFactory()
+    album = [make.private(1) for _ in range(5)]
+    for update in album:
+        update["message"]["media_group_id"] = "album-1"
+    holds = []
+    hold = bot.user_locks.hold
+    bot.user_locks.hold = lambda key: holds.append(key) or hold(key)
+    app = build_bench_app(api)
+    async with app:
+        await app.start()
+        await _deliver(app, *album)
+        buffered = len(holds)
+        await bot.media_groups.close()
+        await app.stop()
+    await bot.persister.close()
+    del bot.user_locks.hold
+    assert buffered == 0, holds
+    assert holds == [1], holds
+    assert api.calls["copyMessages"] == 1, api.calls
+
+
+async def check_replica_ingress_rejects_malformed(tmp: str) -> None:
+    """worker 收到格式错误的批次时返回 400，且不放入任何更新。"""
+    prepare_bot_state(tmp, 0)
+    app = build_bench_app(FakeBotApi())
+    ingress = bot.ReplicaIngress(app, "secret")
+    headers = {"x-replica-secret": "secret"}
+    good = private_update(1, 1, 1000, "hello")
+    for body in (
+        b"not json",
+        b'{"update_id": 1}',
+        b"[1, 2]",
+        json.dumps([good, {"message": {}}]).encode(),
+        json.dumps([{"update_id": 2, "message": {"message_id": 1}}]).encode(),
+    ):
+        status, _ = await ingress.handle("POST", "/updates", headers, body)
+        assert status.startswith("400"), (body, status)
+    assert app.update_queue.empty()
+    status, _ = await ingress.handle(
+        "POST", "/updates", headers, json.dumps([good]).encode()
+    )
+    assert status.startswith("200"), status
+    assert app.update_queue.qsize() == 1
+
+
+async def check_router_drops_rejected_batch(tmp: str) -> None:
+    """worker 以 4xx 拒绝的批次被丢弃并计数，后续批次照常送达，不会堵住分区。"""
+    prepare_bot_state(tmp, 0)
+    app = build_bench_app(FakeBotApi())
+    ingress = bot.ReplicaIngress(app, "secret")
+    port = _free_port()
+    server = await asyncio.start_server(
+        bot._serve_http(ingress.handle), "127.0.0.1", port
+    )
+    node = f"http://127.0.0.1:{port}"
+    router = bot.ReplicaRouter([node], "secret")
+    await router.start()
+    try:
+        router._queues[node].put_nowait({"update_id": "not-an-int"})
+        await asyncio.wait_for(router._queues[node].join(), 5)
+        router.submit(Update.de_json(private_update(1, 1, 1000, "hello"), None))
+        await asyncio.wait_for(router._queues[node].join(), 5)
+    finally:
+        await router.stop()
+        server.close()
+        await server.wait_closed()
+    assert bot.REPLICA_FORWARD_REJECTED.value(node, 400) == 1
+    assert bot.REPLICA_FORWARD_FAILURES.value(node) == 0
+    assert app.update_queue.qsize() == 1
+
+
+async def check_message_map_retries_disk_writes(tmp: str) -> None:
+    """消息映射写盘连续失败时保留待写条目并退避重试，恢复后全部落盘、退出降级。"""
+    flush_seconds, bot.MESSAGE_MAP_FLUSH_SECONDS = bot.MESSAGE_MAP_FLUSH_SECONDS, 0.01
+    db = Path(tmp) / "message_map.db"
+    store = bot.MessageMapStore(10, 3600, db, 86400)
+    write = store._disk_write
+    failures = bot.MESSAGE_MAP_DEGRADE_FAILURES
+    seen_degraded = []
+
+    def flaky_write(rows: List[Tuple[int, int, int, int, float]]) -> None:
+        if store.disk_write_failures < failures:
+            raise sqlite3.OperationalError("database is locked")
+        seen_degraded.append(store.disk_degraded)
+        write(rows)
+
+    store._disk_write = flaky_write
+    store.put(1, 1, 2, 2)
+    store.put(1, 2, 2, 3)
+    for _ in range(500):
+        if not store.disk_pending:
+            break
+        await asyncio.sleep(0.05)
+    await store.close()
+    bot.MESSAGE_MAP_FLUSH_SECONDS = flush_seconds
+    assert store.disk_write_failures == failures, store.disk_write_failures
+    assert seen_degraded[:1] == [True], seen_degraded
+    assert not store.disk_degraded and not store.disk_pending
+
+    reopened = bot.MessageMapStore(10, 3600, db, 86400)
+    assert await reopened.get(1, 1) == (2, 2)
+    assert await reopened.get(1, 2) == (2, 3)
+    await reopened.close()
+
+
+async def _new_user_card_failures(tmp: str, failures: int) -> FakeBotApi:
+    api = FakeBotApi()
+    prepare_bot_state(tmp, 0)
+    add_bench_users([1])
+    make = _UpdateFactory()
+    app = build_bench_app(api)
+    async with app:
+        await app.start()
+        api.fail_next["sendMessage"].extend(
+            [(400, "Bad Request: can't parse entities")] * failures
+        )
+        await _deliver(app, make.private(1))
+        await app.stop()
+    await bot.persister.close()
+    return api
+
+
+async def check_card_failure_keeps_topic(tmp: str) -> None:
+    """名片因与话题无关的原因发送失败时保留新话题重试名片，不重新创建。"""
+    api = await _new_user_card_failures(tmp, 1)
+    assert api.calls["createForumTopic"] == 1, api.calls
+    assert api.calls["deleteForumTopic"] == 0, api.calls
+    assert bot.get_session(1).thread_id in api.topics
+    assert len(api.copy_times) == 1, api.copy_times
+
+
+async def check_card_exhausted_discards_topic(tmp: str) -> None:
+    """名片重试用尽时删除新话题，不留下未映射的孤立话题。"""
+    api = await _new_user_card_failures(tmp, bot.TOPIC_CREATE_RETRIES)
+    assert api.calls["createForumTopic"] == 1, api.calls
+    assert api.calls["deleteForumTopic"] == 1, api.calls
+    assert bot.get_session(1).thread_id is None
+    assert not api.copy_times, api.copy_times
+
+
+CHECKS = [
+    check_copy_failure_keeps_topic,
+    check_pool_rename_failure_returns_topic,
+    check_album_locks_once,
+    check_replica_ingress_rejects_malformed,
+    check_router_drops_rejected_batch,
+    check_message_map_retries_disk_writes,
+    check_card_failure_keeps_topic,
+    check_card_exhausted_discards_topic,
+]
+
+
+def run_checks(args: argparse.Namespace) -> None:
+    """逐个运行回归检查（各自使用全新的 bot 状态），有失败时以非 0 退出。"""
+    failed = 0
+    for check in CHECKS:
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                asyncio.run(check(tmp))
+            except AssertionError as exc:
+                failed += 1
+                print(f"FAIL {check.__name__}: {exc}")
+            else:
+                print(f"ok   {check.__name__}")
+    if failed:
+        raise SystemExit(1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="PM bot 离线基准测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_storage = sub.add_parser("storage", help="存储后端写入延迟")
+    p_storage.add_argument("--sizes", default="1000,100000,1000000")
+    p_storage.add_argument("--repeat", type=int, default=5)
+    p_storage.set_defaults(func=bench_storage)
+
+    p_mm = sub.add_parser("messagemap", help="消息映射内存占用与查询延迟")
+    p_mm.add_argument("--entries", type=int, default=200000)
+    p_mm.add_argument("--lookups", type=int, default=2000)
+    p_mm.set_defaults(func=bench_message_map)
+
+    p_locks = sub.add_parser("locks", help="用户锁注册表开销与内存")
+    p_locks.add_argument("--users", type=int, default=1000000)
+    p_locks.add_argument("--stripes", type=int, default=1024)
+    p_locks.set_defaults(func=bench_locks)
+
+    p_dispatch = sub.add_parser("dispatch", help="更新分发：延迟随工作协程数的变化")
+    p_dispatch.add_argument("--workers", default="1,4,16,64")
+    p_dispatch.add_argument("--updates", type=int, default=2000)
+    p_dispatch.add_argument("--users", type=int, default=200)
+    p_dispatch.add_argument("--latency", type=float, default=0.02)
+    p_dispatch.set_defaults(func=bench_dispatch)
+
+    p_logging = sub.add_parser("logging", help="日志开销：print vs 队列日志")
+    p_logging.add_argument("--updates", type=int, default=5000)
+    p_logging.add_argument("--users", type=int, default=100)
+    p_logging.add_argument("--workers", type=int, default=8)
+    p_logging.set_defaults(func=bench_logging)
+
+    p_webhook = sub.add_parser("webhook", help="本地 webhook 端到端压测")
+    p_webhook.add_argument("--updates", type=int, default=2000)
+    p_webhook.add_argument("--users", type=int, default=200)
+    p_webhook.add_argument("--concurrency", type=int, default=8)
+    p_webhook.add_argument("--latency", type=float, default=0.02)
+    p_webhook.set_defaults(func=bench_webhook)
+
+    p_sim = sub.add_parser("simulate", help="负载模拟：多场景吞吐、延迟与内存")
+    p_sim.add_argument("--scenarios", default=",".join(SCENARIOS))
+    p_sim.add_argument("--workers", type=int, default=16)
+    p_sim.add_argument("--latency", type=float, default=0.01)
+    p_sim.add_argument("--seed", type=int, default=1)
+    p_sim.add_argument("--users", type=int, default=10000)
+    p_sim.add_argument("--new-users", type=int, default=300)
+    p_sim.add_argument("--burst-users", type=int, default=20)
+    p_sim.add_argument("--burst-messages", type=int, default=50)
+    p_sim.add_argument("--storm-users", type=int, default=1000)
+    p_sim.add_argument("--retry-rate", type=float, default=0.002)
+    p_sim.add_argument("--redirect-rate", type=float, default=0.1)
+    p_sim.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    p_sim.set_defaults(func=bench_simulate)
+
+    p_rep = sub.add_parser("replicas", help="多副本：吞吐随 worker 进程数的变化")
+    p_rep.add_argument("--replicas", default="1,2,4")
+    p_rep.add_argument("--updates", type=int, default=4000)
+    p_rep.add_argument("--users", type=int, default=400)
+    p_rep.add_argument("--workers", type=int, default=4)
+    p_rep.add_argument("--latency", type=float, default=0.05)
+    p_rep.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    p_rep.set_defaults(func=bench_replicas)
+
+    p_ten = sub.add_parser("tenants", help="多租户：内存占用与快照编码的事件循环停顿")
+    p_ten.add_argument("--tenants", default="1,4,16")
+    p_ten.add_argument("--users", type=int, default=50000)
+    p_ten.add_argument("--count", type=int, default=1, help=argparse.SUPPRESS)
+    p_ten.add_argument("--pool", action="store_true", help=argparse.SUPPRESS)
+    p_ten.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    p_ten.set_defaults(func=bench_tenants)
+
+    p_exp = sub.add_parser("expiry", help="短期状态过期：每条一个任务 vs 时间轮")
+    p_exp.add_argument("--entries", default="10000,100000")
+    p_exp.add_argument("--tick", type=float, default=bot.EXPIRY_TICK_SECONDS)
+    p_exp.set_defaults(func=bench_expiry)
+
+    p_ing = sub.add_parser("ingress", help="入站防刷：刷屏流量下的准入检查")
+    p_ing.add_argument("--flooders", type=int, default=20)
+    p_ing.add_argument("--messages", type=int, default=100)
+    p_ing.add_argument("--users", type=int, default=200)
+    p_ing.add_argument("--rate", type=float, default=1.0)
+    p_ing.add_argument("--workers", type=int, default=8)
+    p_ing.add_argument("--latency", type=float, default=0.02)
+    p_ing.set_defaults(func=bench_ingress)
+
+    p_edit = sub.add_parser("editsync", help="编辑同步：逐条同步 vs 按消息防抖合并")
+    p_edit.add_argument("--windows", default=f"0,{bot.EDIT_SYNC_WINDOW_SECONDS:g}")
+    p_edit.add_argument("--users", type=int, default=100)
+    p_edit.add_argument("--edits", type=int, default=5)
+    p_edit.add_argument("--interval", type=float, default=0.2)
+    p_edit.add_argument("--latency", type=float, default=0.02)
+    p_edit.set_defaults(func=bench_editsync)
+
+    p_pool = sub.add_parser("topicpool", help="预建话题池：新用户首条消息的延迟")
+    p_pool.add_argument("--sizes", default="0,5")
+    p_pool.add_argument("--users", type=int, default=50)
+    p_pool.add_argument("--interval", type=float, default=0.3)
+    p_pool.add_argument("--latency", type=float, default=0.05)
+    p_pool.set_defaults(func=bench_topicpool)
+
+    p_start = sub.add_parser("startup", help="启动加载：全量解析与按需加载的耗时和内存")
+    p_start.add_argument("--sizes", default="100000,1000000")
+    p_start.add_argument("--users", type=int, default=0, help=argparse.SUPPRESS)
+    p_start.add_argument("--mode", default="json", help=argparse.SUPPRESS)
+    p_start.add_argument("--path", default="", help=argparse.SUPPRESS)
+    p_start.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    p_start.set_defaults(func=bench_startup)
+
+    p_http = sub.add_parser("httppool", help="HTTP 连接池：突发请求的排队与连接复用")
+    p_http.add_argument("--sizes", default="4,32")
+    p_http.add_argument("--burst", type=int, default=200)
+    p_http.add_argument("--latency", type=float, default=0.05)
+    p_http.add_argument("--gap", type=float, default=6)
+    p_http.set_defaults(func=bench_httppool)
+
+    p_checks = sub.add_parser("checks", help="故障注入回归检查")
+    p_checks.set_defaults(func=run_checks)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
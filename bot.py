@@ -1,38 +1,211 @@
 import os
 import json
 import asyncio
+import sqlite3
+import sys
+import threading
 import html
+import importlib.util
+import logging
+import logging.handlers
+import math
+import multiprocessing
+import queue
+import re
+import secrets
+import signal
+import struct
+from hashlib import blake2b
+from array import array
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
+from datetime import timedelta
 from pathlib import Path
-from time import time
-from collections import defaultdict
-from typing import Any, Dict, Optional, Tuple
+from time import monotonic, perf_counter, time
+from types import ModuleType
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+    TypeVar,
+)
 
-from telegram import Update
+import httpx
+from telegram import Message, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, TimedOut
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
 from telegram.helpers import mention_html
+from telegram.request import BaseRequest, HTTPXRequest, RequestData
 
-# ---------- 全局锁：避免同一用户并发处理导致状态错乱 ----------
-user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+T = TypeVar("T")
 
 # ---------- 配置（必填环境变量） ----------
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-GROUP_ID = int(os.getenv("GROUP_ID", "0"))
+# 多租户宿主在执行模块前注入 _TENANT_CONFIG；普通启动时读取进程环境变量。
+# 配置只从这里读取，加载租户时无需改动 os.environ
+_CONFIG: Mapping[str, str] = globals().get("_TENANT_CONFIG", os.environ)
+
+
+def _env(name: str, default: Optional[str] = None) -> Optional[str]:
+    return _CONFIG.get(name, default)
+
+
+BOT_TOKEN = _env("BOT_TOKEN")
+GROUP_ID = int(_env("GROUP_ID", "0"))
 
 # 持久化文件路径
-PERSIST_FILE = Path("/data/topic_mapping.json")
+PERSIST_FILE = Path(_env("PERSIST_FILE", "/data/topic_mapping.json"))
+
+# 存储后端：json（默认，单文件）或 sqlite（WAL 模式，按行 upsert）
+STORAGE_BACKEND = _env("STORAGE_BACKEND", "json").lower()
+SQLITE_PATH = Path(_env("SQLITE_PATH", "/data/bot.db"))
+
+# Webhook 模式：设置 WEBHOOK_URL（公网可访问的 https 地址）后启用，否则使用长轮询。
+# 未设置 WEBHOOK_SECRET 时每次启动随机生成（setWebhook 会同步给 Telegram）
+WEBHOOK_URL = _env("WEBHOOK_URL")
+WEBHOOK_LISTEN = _env("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(_env("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = _env("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = _env("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(_env("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# 更新分发：同一会话（私聊用户 / 群组话题）内按到达顺序处理，不同会话之间并发。
+# CONCURRENT_UPDATES 为同时执行处理器的工作协程数（1 即全局逐条处理），
+# UPDATE_QUEUE_MAX 为已接收但未处理完的更新上限（超过后暂停拉取，形成背压）
+CONCURRENT_UPDATES = int(_env("CONCURRENT_UPDATES", "8"))
+UPDATE_QUEUE_MAX = int(_env("UPDATE_QUEUE_MAX", "10000"))
+
+# 出站限流（对应 Telegram 的洪水限制）：全局每秒请求数、单个私聊每秒消息数与突发量、
+# 单个群组每分钟消息数与突发量，以及排队中的请求上限（超过后处理器等待，形成背压）
+SEND_GLOBAL_RATE = float(_env("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(_env("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(_env("SEND_CHAT_BURST", "3"))
+SEND_GROUP_RATE_PER_MINUTE = float(_env("SEND_GROUP_RATE_PER_MINUTE", "20"))
+SEND_GROUP_BURST = int(_env("SEND_GROUP_BURST", "20"))
+SEND_QUEUE_MAX = int(_env("SEND_QUEUE_MAX", "1000"))
+
+# 私聊消息合并转发（默认关闭）：开启后用户的消息进入各自的发件队列，
+# 转发进行中到达的消息会在下一次用一个 copy_messages 批量转发。
+# WINDOW 为首条消息入队后额外等待的秒数（0 为不等待），MAX_BATCH 为单批上限（≤100）
+FORWARD_COALESCE = _env("FORWARD_COALESCE", "false").lower() == "true"
+FORWARD_COALESCE_WINDOW_SECONDS = float(_env("FORWARD_COALESCE_WINDOW_SECONDS", "0"))
+FORWARD_COALESCE_MAX_BATCH = min(
+    100, max(1, int(_env("FORWARD_COALESCE_MAX_BATCH", "20")))
+)
+
+# 编辑同步防抖：同一条消息在窗口内的多次编辑只同步最后一次（秒，0 为不等待）
+EDIT_SYNC_WINDOW_SECONDS = float(_env("EDIT_SYNC_WINDOW_SECONDS", "2"))
+
+# 日志：LOG_LEVEL 默认 INFO（DEBUG 会逐条记录消息处理过程，仅排查问题时开启，
+# 只影响本项目日志，第三方库最多输出到 INFO）；
+# LOG_FORMAT 为 json（默认，每行一个 JSON 对象）或 text
+LOG_LEVEL = _env("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = _env("LOG_FORMAT", "json").lower()
+
+# 指标端点（Prometheus 文本格式）：METRICS_PORT 为 0（默认）时不开启；
+# 默认只监听本机，需要被外部抓取时再改 METRICS_LISTEN
+METRICS_PORT = int(_env("METRICS_PORT", "0"))
+METRICS_LISTEN = _env("METRICS_LISTEN", "127.0.0.1")
+
+# Bot API 连接池：出站调用与 getUpdates 长轮询各用一个连接池，互不争抢。
+# API_HTTP2 为 auto（默认，安装了 h2 时启用）、true 或 false；
+# 超时（秒）：CONNECT 建连、READ 普通调用的响应、SLOW_READ 批量复制与创建话题等
+# 较慢调用的响应、MEDIA_WRITE 上传文件、POOL 等待空闲连接；
+# KEEPALIVE 为空闲连接保留时间（过短会在突发流量时反复握手）
+API_POOL_SIZE = int(_env("API_POOL_SIZE", "32"))
+API_UPDATES_POOL_SIZE = int(_env("API_UPDATES_POOL_SIZE", "2"))
+API_HTTP2 = _env("API_HTTP2", "auto").lower()
+API_CONNECT_TIMEOUT = float(_env("API_CONNECT_TIMEOUT", "5"))
+API_READ_TIMEOUT = float(_env("API_READ_TIMEOUT", "10"))
+API_SLOW_READ_TIMEOUT = float(_env("API_SLOW_READ_TIMEOUT", "30"))
+API_MEDIA_WRITE_TIMEOUT = float(_env("API_MEDIA_WRITE_TIMEOUT", "60"))
+API_POOL_TIMEOUT = float(_env("API_POOL_TIMEOUT", "10"))
+API_KEEPALIVE_SECONDS = float(_env("API_KEEPALIVE_SECONDS", "30"))
+
+# 多副本横向扩展（默认关闭）：REPLICA_ROLE=router 的进程唯一接收 Telegram 更新，
+# 按用户一致性哈希转发给 REPLICA_NODES 中的 worker；REPLICA_ROLE=worker 的进程
+# 在 REPLICA_LISTEN:REPLICA_PORT 接收转发并处理，REPLICA_SELF 为本节点在列表中的地址。
+# 各副本共享同一个 SQLite 数据库（STORAGE_BACKEND=sqlite，放在共享卷上）
+REPLICA_ROLE = _env("REPLICA_ROLE", "").lower()
+REPLICA_NODES = [
+    n.strip().rstrip("/") for n in _env("REPLICA_NODES", "").split(",") if n.strip()
+]
+REPLICA_SELF = _env("REPLICA_SELF", "").strip().rstrip("/")
+REPLICA_LISTEN = _env("REPLICA_LISTEN", "0.0.0.0")
+REPLICA_PORT = int(_env("REPLICA_PORT", "8080"))
+REPLICA_SECRET = _env("REPLICA_SECRET", "")
+
+# 多租户：设置 TENANTS_FILE 后，一个进程托管多个机器人。文件为 JSON 对象，
+# 键为租户名，值为该租户的环境变量覆盖（至少 BOT_TOKEN、GROUP_ID）；
+# 未指定的数据路径默认放在 TENANT_DATA_DIR/<租户名>/ 下。
+# CPU_POOL_WORKERS 为大快照 JSON 编码等 CPU 密集型工作的进程池大小
+TENANTS_FILE = _env("TENANTS_FILE")
+TENANT_DATA_DIR = Path(_env("TENANT_DATA_DIR", "/data/tenants"))
+TENANT_NAME = _env("TENANT_NAME", "")
+CPU_POOL_WORKERS = int(_env("CPU_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# 用户锁条带数：0（默认）为每个用户一把锁、空闲即回收；
+# 大于 0 时使用固定数量的锁按用户 ID 取模，内存恒定但不同用户可能互相等待
+USER_LOCK_STRIPES = int(_env("USER_LOCK_STRIPES", "0"))
+
+# 话题健康缓存最多保存的话题数（超出后按最近使用淘汰）
+THREAD_HEALTH_CACHE_MAX_ENTRIES = int(_env("THREAD_HEALTH_CACHE_MAX_ENTRIES", "10000"))
+
+# 消息映射（编辑同步）：内存条目上限与磁盘索引路径（留空则仅保存在内存中）
+MESSAGE_MAP_MAX_ENTRIES = int(_env("MESSAGE_MAP_MAX_ENTRIES", "200000"))
+_RAW_MESSAGE_MAP_DB = _env("MESSAGE_MAP_DB", "/data/message_map.db")
+MESSAGE_MAP_DB = Path(_RAW_MESSAGE_MAP_DB) if _RAW_MESSAGE_MAP_DB else None
+MESSAGE_MAP_DISK_TTL_SECONDS = int(_env("MESSAGE_MAP_DISK_TTL_SECONDS", str(7 * 86400)))
+
+# 话题健康检查模式：
+# optimistic（默认）直接转发，仅在转发报“话题不存在”时重建；
+# probe 每次转发前按缓存周期发送并删除探测消息
+TOPIC_HEALTH_MODE = _env("TOPIC_HEALTH_MODE", "optimistic").lower()
+
+# 预建话题池：后台保持 TOPIC_POOL_SIZE 个已创建的空闲话题，新用户首次发消息时
+# 直接取用并改名，省去创建话题的等待；默认 0 关闭（需要机器人有管理话题的权限）
+TOPIC_POOL_SIZE = int(_env("TOPIC_POOL_SIZE", "0"))
+
+# 入站防刷：私聊更新在排队、加用户锁之前按用户令牌桶准入，超限的更新不进入处理。
+# INGRESS_RATE 为已验证用户每秒可持续发送的消息数（一个相册算一条，编辑不计），
+# INGRESS_BURST 为突发上限；超限时回复一次提示。默认 0 关闭，只限制未验证与被封禁用户
+INGRESS_RATE = float(_env("INGRESS_RATE", "0"))
+INGRESS_BURST = int(_env("INGRESS_BURST", "20"))
+# 未通过验证的用户每分钟可尝试的次数（含 /start）与突发上限；0 关闭该限制
+CAPTCHA_ATTEMPTS_PER_MINUTE = float(_env("CAPTCHA_ATTEMPTS_PER_MINUTE", "6"))
+CAPTCHA_ATTEMPT_BURST = int(_env("CAPTCHA_ATTEMPT_BURST", "3"))
+# 被封禁用户最多每隔多少秒收到一次“已被禁止”的提示，其余消息静默丢弃；0 表示从不提示
+BANNED_NOTICE_SECONDS = float(_env("BANNED_NOTICE_SECONDS", "3600"))
+
+# 持久化防抖间隔（秒）：窗口内的多次变更合并为一次写入，0 表示尽快写入
+PERSIST_DEBOUNCE_SECONDS = float(_env("PERSIST_DEBOUNCE_SECONDS", "2"))
 
 # 获取原始环境变量（不设默认值）
-_RAW_VERIFY_QUESTION = os.getenv("VERIFY_QUESTION")
-_RAW_VERIFY_ANSWER = os.getenv("VERIFY_ANSWER")
-_RAW_USE_MATH = os.getenv("USE_MATH_CAPTCHA")
+_RAW_VERIFY_QUESTION = _env("VERIFY_QUESTION")
+_RAW_VERIFY_ANSWER = _env("VERIFY_ANSWER")
+_RAW_USE_MATH = _env("USE_MATH_CAPTCHA")
 
 # 判断是否启用了相应功能
 USE_MATH_CAPTCHA = _RAW_USE_MATH is not None and _RAW_USE_MATH.lower() == "true"
@@ -42,17 +215,74 @@ USE_FIXED_CAPTCHA = _RAW_VERIFY_ANSWER is not None
 VERIFY_QUESTION = _RAW_VERIFY_QUESTION or "请输入访问密码："
 VERIFY_ANSWER = _RAW_VERIFY_ANSWER
 
-if not BOT_TOKEN:
+# 多租户宿主进程本身不连接 Telegram，BOT_TOKEN / GROUP_ID 在各租户配置中
+if not BOT_TOKEN and not TENANTS_FILE:
     raise RuntimeError("请设置 BOT_TOKEN 环境变量")
-if GROUP_ID == 0:
+if GROUP_ID == 0 and not TENANTS_FILE:
     raise RuntimeError("请设置 GROUP_ID 环境变量")
+if TENANTS_FILE and REPLICA_ROLE:
+    raise RuntimeError("多租户模式不能与多副本模式同时使用")
+if STORAGE_BACKEND not in ("json", "sqlite"):
+    raise RuntimeError("STORAGE_BACKEND 只能是 json 或 sqlite")
+if TOPIC_HEALTH_MODE not in ("optimistic", "probe"):
+    raise RuntimeError("TOPIC_HEALTH_MODE 只能是 optimistic 或 probe")
+if TOPIC_POOL_SIZE < 0:
+    raise RuntimeError("TOPIC_POOL_SIZE 不能为负数")
+if EDIT_SYNC_WINDOW_SECONDS < 0:
+    raise RuntimeError("EDIT_SYNC_WINDOW_SECONDS 不能为负数")
+if INGRESS_RATE < 0 or CAPTCHA_ATTEMPTS_PER_MINUTE < 0 or BANNED_NOTICE_SECONDS < 0:
+    raise RuntimeError(
+        "INGRESS_RATE、CAPTCHA_ATTEMPTS_PER_MINUTE 与 BANNED_NOTICE_SECONDS 不能为负数"
+    )
+if INGRESS_BURST < 1 or CAPTCHA_ATTEMPT_BURST < 1:
+    raise RuntimeError("INGRESS_BURST 与 CAPTCHA_ATTEMPT_BURST 至少为 1")
+if LOG_LEVEL not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
+    raise RuntimeError("LOG_LEVEL 只能是 DEBUG、INFO、WARNING、ERROR 或 CRITICAL")
+if LOG_FORMAT not in ("json", "text"):
+    raise RuntimeError("LOG_FORMAT 只能是 json 或 text")
+if API_HTTP2 not in ("auto", "true", "false"):
+    raise RuntimeError("API_HTTP2 只能是 auto、true 或 false")
+if API_POOL_SIZE < 1 or API_UPDATES_POOL_SIZE < 1:
+    raise RuntimeError("API_POOL_SIZE 与 API_UPDATES_POOL_SIZE 至少为 1")
+if REPLICA_ROLE not in ("", "router", "worker"):
+    raise RuntimeError("REPLICA_ROLE 只能是 router 或 worker")
+if REPLICA_ROLE:
+    if STORAGE_BACKEND != "sqlite":
+        raise RuntimeError("多副本模式需要 STORAGE_BACKEND=sqlite（共享数据库）")
+    if not REPLICA_NODES:
+        raise RuntimeError("多副本模式需要设置 REPLICA_NODES")
+    if not REPLICA_SECRET:
+        raise RuntimeError("多副本模式需要设置 REPLICA_SECRET")
+    if REPLICA_ROLE == "worker" and REPLICA_SELF not in REPLICA_NODES:
+        raise RuntimeError("REPLICA_SELF 必须是 REPLICA_NODES 中的一项")
 
 # ---------- 常量 ----------
-THREAD_HEALTH_CACHE_SECONDS = 60
+THREAD_HEALTH_CACHE_SECONDS = 60  # 健康话题的基础 TTL
+THREAD_HEALTH_CACHE_MAX_SECONDS = 3600  # 长期健康话题的 TTL 上限
+THREAD_HEALTH_NEGATIVE_SECONDS = 30  # 确认失效/重定向的结果
+THREAD_HEALTH_TRANSIENT_SECONDS = 5  # 未知错误等可能是临时性的结果
 MATH_CAPTCHA_EXPIRE_SECONDS = 300
 MESSAGE_MAP_TTL_SECONDS = 86400  # 24小时
+MESSAGE_MAP_FLUSH_SECONDS = 1
+MESSAGE_MAP_RETRY_MAX_SECONDS = 60  # 磁盘写入失败后重试间隔的上限
+MESSAGE_MAP_DEGRADE_FAILURES = 5  # 连续失败达到该次数后暂停磁盘回查
+MESSAGE_MAP_PENDING_MAX = 50000  # 写入失败期间待写队列的上限，超出时丢弃最旧的
+MESSAGE_MAP_EXPIRE_INTERVAL_SECONDS = 60
+MESSAGE_MAP_EXPIRE_SLICE_SECONDS = 0.002  # 单片清理最长占用事件循环的时间
 CLEANUP_INTERVAL_SECONDS = 3600  # 1小时
 TOPIC_CREATE_RETRIES = 3
+MEDIA_GROUP_WINDOW_SECONDS = 1.0  # 相册各条消息的最大到达间隔，超过即视为收齐
+SNAPSHOT_OFFLOAD_MIN_ROWS = 20000  # JSON 快照达到该行数时交给进程池编码
+H2_STREAMS_PER_CONNECTION = 100  # HTTP/2 单连接的并发流数（按服务端常见上限估算）
+REPLICA_VNODES = 64  # 一致性哈希中每个节点的虚拟节点数
+REPLICA_BATCH_MAX = 100  # router 单次转发给 worker 的最大更新数
+REPLICA_RETRY_MAX_SECONDS = 10  # 转发失败重试的最大退避
+TOPIC_CLAIM_SECONDS = 60  # 跨副本创建话题的认领有效期
+TOPIC_POOL_TITLE = "⏳ 待分配"  # 预建话题在分配给用户前的标题
+TOPIC_POOL_RETRY_SECONDS = 30  # 预建话题失败后的重试间隔，也是补充任务检查池深度的周期
+TOPIC_POOL_LEASE_SECONDS = 90  # 多副本时负责补充话题池的副本租约有效期
+EXPIRY_TICK_SECONDS = 1.0  # 过期时间轮的刻度（过期时间的精度）
+EXPIRY_WHEEL_SLOTS = 512  # 时间轮槽数；更长的过期时间跨多圈，每圈被检查一次
 
 
 # ---------- 用户会话管理 ----------
@@ -72,109 +302,2927 @@ user_sessions: Dict[int, UserSession] = {}
 # 话题到用户的映射 (用于通过话题ID查找用户)
 thread_to_user: Dict[int, int] = {}
 
-# 消息映射表 (用于编辑同步)
-# Key: (source_chat_id, source_message_id)
-# Value: (target_chat_id, target_message_id, created_ts)
-# 仅存在内存中，重启后失效
-message_map: Dict[Tuple[int, int], Tuple[int, int, float]] = {}
-
 # 数学验证码存储 (用户ID -> 正确答案)
 math_answers: Dict[int, int] = {}
 
-# 话题健康检查缓存，减少频繁探测请求
-thread_health_cache: Dict[int, Dict[str, Any]] = {}
-
 
 def get_session(user_id: int) -> UserSession:
-    """获取或创建用户会话。"""
+    """获取或创建用户会话。
+
+    内存中只有活跃用户的会话：未命中时从存储后端按需加载（多副本模式下
+    用户也可能由其他副本创建，或在节点列表变更后刚被分配到本节点）。
+    """
     session = user_sessions.get(user_id)
     if session is None:
-        session = UserSession(user_id=user_id)
+        row = storage.load_one(user_id)
+        if row is None:
+            session = UserSession(user_id=user_id)
+        else:
+            session = _session_from_row(user_id, row)
+            if session.thread_id is not None:
+                thread_to_user[session.thread_id] = user_id
         user_sessions[user_id] = session
     return session
 
 
-def load_persisted_mapping() -> None:
-    """启动时加载持久化数据，兼容旧数据格式。"""
-    global user_sessions, thread_to_user
+def user_for_thread(thread_id: int) -> Optional[int]:
+    """按话题 ID 查找用户；内存未命中时回查存储后端。"""
+    user_id = thread_to_user.get(thread_id)
+    if user_id is None:
+        user_id = storage.owner_of_thread(thread_id)
+        if user_id is None:
+            return None
+        session = user_sessions.get(user_id)
+        if session is not None and session.thread_id != thread_id:
+            # 该用户已在内存中换了话题（旧话题已失效），存储中的是过期映射
+            return None
+        thread_to_user[thread_id] = user_id
+    return user_id
+
+
+# ---------- 多副本：一致性哈希分区 ----------
+class HashRing:
+    """一致性哈希环：用户 ID 映射到节点，增删节点时只有约 1/N 的用户迁移。"""
+
+    def __init__(self, nodes: List[str], vnodes: int = REPLICA_VNODES) -> None:
+        points = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes)
+        )
+        self._keys = [p[0] for p in points]
+        self._nodes = [p[1] for p in points]
 
-    if not PERSIST_FILE.exists():
-        return
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(blake2b(value.encode(), digest_size=8).digest(), "big")
 
-    try:
-        content = PERSIST_FILE.read_text(encoding="utf-8")
-        if not content.strip():
-            return
+    def node_for(self, key: int) -> str:
+        idx = bisect_right(self._keys, self._hash(str(key)))
+        return self._nodes[idx % len(self._nodes)]
 
-        data = json.loads(content)
 
-        user_to_thread_old = {
-            int(k): int(v) for k, v in data.get("user_to_thread", {}).items()
-        }
-        thread_to_user_old = {
-            int(k): int(v) for k, v in data.get("thread_to_user", {}).items()
-        }
-        user_verified_old = {
-            int(k): v for k, v in data.get("user_verified", {}).items()
+replica_ring = HashRing(REPLICA_NODES) if REPLICA_ROLE else None
+
+
+# ---------- 日志 ----------
+# 多租户时每个租户使用子 logger（pmbot.<租户名>），日志中可区分来源
+logger = logging.getLogger(f"pmbot.{TENANT_NAME}" if TENANT_NAME else "pmbot")
+
+# LogRecord 自带的属性；其余属性来自 extra=，作为结构化字段输出
+_LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON：时间、级别、来源、消息及 extra 传入的字段。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
         }
-        banned_users_old = set(data.get("banned_users", []))
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """原样入队，消息拼接与格式化都留给后台线程（默认实现会在调用线程里格式化）。"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(
+    level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream: Any = None
+) -> logging.handlers.QueueListener:
+    """配置根日志器：记录只放入内存队列，由后台线程格式化并写出，不阻塞事件循环。
+
+    返回已启动的 QueueListener，退出前调用其 stop() 以写完剩余日志。
+    """
+    handler = logging.StreamHandler(stream or sys.stdout)
+    if fmt == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        )
 
-        # 将旧数据转换为新格式
-        for user_id, thread_id in user_to_thread_old.items():
-            session = UserSession(user_id=user_id)
-            session.thread_id = thread_id
-            session.verified = bool(user_verified_old.get(user_id, False))
-            session.banned = user_id in banned_users_old
-            user_sessions[user_id] = session
-
-        # 重建 thread_to_user 映射（优先使用重建结果；thread_to_user_old仅用于兼容）
-        thread_to_user = {}
-        for user_id, session in user_sessions.items():
-            if session.thread_id:
-                thread_to_user[session.thread_id] = user_id
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    # LOG_LEVEL 只作用于本项目日志；第三方库最多输出到 INFO，
+    # httpx 会为每次 Bot API 请求输出一条 INFO 日志，因此只保留 WARNING 以上
+    logger.setLevel(level)
+    root.setLevel(max(logger.level, logging.INFO))
+    logging.getLogger("httpx").setLevel(max(logger.level, logging.WARNING))
+
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+
+# ---------- 指标（Prometheus 文本格式） ----------
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[Any, ...]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
 
-        # 兼容：若旧映射中存在但 session 中缺失（理论上不该发生），补一层
-        for tid, uid in thread_to_user_old.items():
-            if tid not in thread_to_user and uid in user_sessions:
-                thread_to_user[tid] = uid
 
-    except Exception as exc:
-        print(f"读取数据文件失败: {exc}")
-        user_sessions = {}
-        thread_to_user = {}
+class MetricCounter:
+    """单调递增计数器。标签值按位置传入：counter.inc("copyMessage", "ok")。"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...]) -> None:
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: Dict[Tuple[Any, ...], float] = {}
+
+    def inc(self, *label_values: Any, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: Any) -> float:
+        return self._values.get(label_values, 0)
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {value}"
+            for key, value in self._values.items()
+        ]
+
+
+class MetricGauge(MetricCounter):
+    """可增可减的仪表盘，标签用法同 MetricCounter。"""
+
+    kind = "gauge"
+
+    def set(self, value: float, *label_values: Any) -> None:
+        self._values[label_values] = value
+
+    def dec(self, *label_values: Any, amount: float = 1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+
+class MetricHistogram:
+    """固定分桶直方图。observe() 只做一次二分查找和两次加法，适合热路径。"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: Tuple[str, ...],
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # 每个标签组合：[各桶计数（非累积，最后一格为 +Inf）, 总和]
+        self._series: Dict[Tuple[Any, ...], List[Any]] = {}
+
+    def observe(self, value: float, *label_values: Any) -> None:
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *label_values: Any) -> int:
+        series = self._series.get(label_values)
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                labels = _format_labels(self.labels + ("le",), key + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricCallback:
+    """抓取时才读取的指标（如队列深度、缓存大小），热路径上没有任何开销。"""
+
+    def __init__(
+        self, name: str, help_text: str, kind: str, read: Callable[[], float]
+    ) -> None:
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.read = read
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.read()}"]
+
+
+class MetricsRegistry:
+    """进程内指标注册表，render() 输出 Prometheus 文本格式（0.0.4）。"""
+
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+        self._metrics: Dict[str, Any] = {}
+
+    def counter(self, name: str, help_text: str, *labels: str) -> MetricCounter:
+        return self._register(MetricCounter(self.prefix + name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, *labels: str) -> MetricGauge:
+        return self._register(MetricGauge(self.prefix + name, help_text, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        *labels: str,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> MetricHistogram:
+        return self._register(
+            MetricHistogram(self.prefix + name, help_text, labels, buckets)
+        )
+
+    def gauge_callback(
+        self, name: str, help_text: str, read: Callable[[], float]
+    ) -> None:
+        self._register(MetricCallback(self.prefix + name, help_text, "gauge", read))
+
+    def counter_callback(
+        self, name: str, help_text: str, read: Callable[[], float]
+    ) -> None:
+        self._register(MetricCallback(self.prefix + name, help_text, "counter", read))
+
+    def _register(self, metric: Any) -> Any:
+        # 重复注册（如重新 build_application）时以新的为准
+        self._metrics[metric.name] = metric
+        return metric
+
+    def collect(self) -> List[Tuple[str, str, str, List[str]]]:
+        """返回 [(名称, 说明, 类型, 样本行)]；读取失败的指标跳过。"""
+        collected = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception as exc:
+                logger.warning("指标 %s 读取失败: %s", metric.name, exc)
+                continue
+            collected.append((metric.name, metric.help, metric.kind, samples))
+        return collected
+
+    def render(self) -> str:
+        return _render_collected(self.collect())
+
+
+def _render_collected(collected: List[Tuple[str, str, str, List[str]]]) -> str:
+    lines = []
+    for name, help_text, kind, samples in collected:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+def _with_label(sample: str, label: str) -> str:
+    """给一行样本追加一个标签：name{a="b"} 1 -> name{a="b",label} 1。"""
+    series, value = sample.rsplit(" ", 1)
+    if series.endswith("}"):
+        return f"{series[:-1]},{label}}} {value}"
+    return f"{series}{{{label}}} {value}"
+
+
+def render_tenant_metrics(registries: Dict[str, "MetricsRegistry"]) -> str:
+    """合并多个租户的指标注册表，每条样本加上 tenant 标签。"""
+    merged: Dict[str, Tuple[str, str, List[str]]] = {}
+    for tenant, registry in registries.items():
+        label = f"tenant={json.dumps(tenant, ensure_ascii=False)}"
+        for name, help_text, kind, samples in registry.collect():
+            entry = merged.setdefault(name, (help_text, kind, []))
+            entry[2].extend(_with_label(sample, label) for sample in samples)
+    return _render_collected(
+        [(name, h, kind, samples) for name, (h, kind, samples) in merged.items()]
+    )
+
+
+metrics = MetricsRegistry("tgbot_")
+API_REQUESTS = metrics.counter(
+    "api_requests_total",
+    "Bot API 调用次数（result: ok / error / retry_after）",
+    "endpoint",
+    "priority",
+    "result",
+)
+API_LATENCY = metrics.histogram(
+    "api_request_seconds", "Bot API 调用耗时（不含排队）", "endpoint"
+)
+API_QUEUE_WAIT = metrics.histogram(
+    "api_queue_wait_seconds", "Bot API 调用在出站限流队列中的等待时间", "priority"
+)
+USER_LOCK_WAIT = metrics.histogram("user_lock_wait_seconds", "获取用户锁的等待时间")
+PERSIST_FLUSH = metrics.histogram(
+    "persist_flush_seconds", "会话持久化单次写入耗时", "result"
+)
+UPDATE_WAIT = metrics.histogram(
+    "update_queue_wait_seconds", "更新等待同会话前序更新与工作槽的时间"
+)
+UPDATE_LATENCY = metrics.histogram("update_handle_seconds", "单个更新的处理耗时")
+MESSAGE_MAP_EXPIRE_PAUSE = metrics.histogram(
+    "message_map_expire_pause_seconds", "消息映射单片过期清理占用事件循环的时间"
+)
+TOPIC_POOL_DEPTH = metrics.gauge("topic_pool_depth", "预建话题池中的空闲话题数")
+TOPIC_POOL_TAKES = metrics.counter(
+    "topic_pool_takes_total",
+    "新用户取用预建话题的结果（result: hit / empty / stale / error）",
+    "result",
+)
+TOPIC_POOL_REFILLS = metrics.counter(
+    "topic_pool_refills_total", "后台预建话题的结果（result: ok / error）", "result"
+)
+INGRESS_DROPPED = metrics.counter(
+    "ingress_dropped_total",
+    "排队与加用户锁之前丢弃的私聊更新（reason: banned / flood / captcha）",
+    "reason",
+)
+HTTP_POOL_CAPACITY = metrics.gauge(
+    "http_pool_capacity", "连接池可同时进行的请求数（HTTP/2 按连接数×并发流数）", "pool"
+)
+HTTP_IN_FLIGHT = metrics.gauge(
+    "http_requests_in_flight", "正在进行的 HTTP 请求数", "pool"
+)
+HTTP_IN_FLIGHT_PEAK = metrics.gauge(
+    "http_requests_in_flight_peak", "启动以来同时进行的 HTTP 请求数峰值", "pool"
+)
+HTTP_POOL_WAITS = metrics.counter(
+    "http_pool_waits_total", "发起时连接池已满、需要排队等待连接的请求数", "pool"
+)
+HTTP_POOL_TIMEOUTS = metrics.counter(
+    "http_pool_timeouts_total", "等待空闲连接超时（未发出）的请求数", "pool"
+)
+
+
+# ---------- 内置 HTTP 服务（指标端点、副本间转发） ----------
+HTTP_MAX_BODY = 16 * 1024 * 1024
+HTTP_IDLE_SECONDS = 60  # 长连接空闲超时
+
+# (method, path, headers, body) -> (status, body)
+HttpHandler = Callable[[str, str, Dict[str, str], bytes], Awaitable[Tuple[str, bytes]]]
+
+
+async def _read_http_request(
+    reader: asyncio.StreamReader,
+) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    """读取一个 HTTP/1.1 请求；连接关闭或请求行无效时返回 None。"""
+    request_line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_SECONDS)
+    parts = request_line.decode("latin-1").split()
+    if len(parts) < 2:
+        return None
+    headers: Dict[str, str] = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), 5)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > HTTP_MAX_BODY:
+        raise ValueError(f"请求体过大: {length}")
+    body = await asyncio.wait_for(reader.readexactly(length), 30) if length else b""
+    return parts[0], parts[1].split("?")[0], headers, body
+
+
+def _serve_http(
+    handle: HttpHandler,
+) -> Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]]:
+    """把请求处理函数包装成 asyncio.start_server 的连接回调（支持 keep-alive）。"""
+
+    async def on_connection(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request = await _read_http_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload = await handle(method, path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                    "\r\n".encode() + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            ConnectionError,
+            ValueError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    return on_connection
+
+
+async def _handle_metrics(
+    method: str, path: str, headers: Dict[str, str], body: bytes
+) -> Tuple[str, bytes]:
+    """GET /metrics 返回指标，其余路径 404。"""
+    if method == "GET" and path == "/metrics":
+        return "200 OK", metrics.render().encode()
+    return "404 Not Found", b"not found\n"
+
+
+_serve_metrics = _serve_http(_handle_metrics)
+
+
+# ---------- 持久化存储后端 ----------
+# 持久化写入使用的执行器；None 为事件循环默认线程池。
+# 多租户宿主会把它换成所有租户共用的单个写线程，并设置 cpu_pool
+persist_executor: Optional[Executor] = None
+# CPU 密集型工作（大快照 JSON 编码）使用的进程池；None 时在当前线程执行
+cpu_pool: Optional[Executor] = None
+
+
+def new_cpu_pool() -> ProcessPoolExecutor:
+    """创建 CPU 密集型工作的进程池。
+
+    宿主进程里有事件循环、写线程与 HTTP 连接池，fork 出的子进程会继承这些
+    线程持有的锁；改用 forkserver（不支持时用 spawn）启动干净的工作进程。
+    """
+    methods = multiprocessing.get_all_start_methods()
+    method = "forkserver" if "forkserver" in methods else "spawn"
+    return ProcessPoolExecutor(
+        max_workers=CPU_POOL_WORKERS, mp_context=multiprocessing.get_context(method)
+    )
+
+
+async def _in_writer(func: Callable[..., T], *args: Any) -> T:
+    """在持久化写入线程中执行阻塞的写操作。"""
+    return await asyncio.get_running_loop().run_in_executor(
+        persist_executor, func, *args
+    )
 
 
-def persist_mapping() -> None:
-    """保存数据到文件（保持旧格式兼容）。"""
-    data = {
+# 单个会话的持久化行：(thread_id, verified, banned)
+SessionRow = Tuple[Optional[int], bool, bool]
+
+
+def _session_row(session: UserSession) -> SessionRow:
+    return session.thread_id, session.verified, session.banned
+
+
+def _session_from_row(user_id: int, row: SessionRow) -> UserSession:
+    session = UserSession(user_id=user_id)
+    session.thread_id, session.verified, session.banned = row
+    return session
+
+
+class SessionStorage:
+    """会话存储后端接口。
+
+    load() 在启动时同步调用；write() 由 MappingPersister 在工作线程中串行调用，
+    changes 中值为 None 表示删除该用户。
+    """
+
+    def load(self) -> int:
+        """启动时准备存储（迁移、索引），返回已保存的会话数。
+
+        会话不会整体读入内存，之后由 load_one / owner_of_thread 按需读取。"""
+        raise NotImplementedError
+
+    def write(self, changes: Dict[int, Optional[SessionRow]]) -> None:
+        raise NotImplementedError
+
+    def load_one(self, user_id: int) -> Optional[SessionRow]:
+        """读取单个用户的最新持久化状态。"""
+        raise NotImplementedError
+
+    def owner_of_thread(self, thread_id: int) -> Optional[int]:
+        """按话题 ID 查找所属用户。"""
+        raise NotImplementedError
+
+    def memory_bytes(self) -> int:
+        """后端常驻内存中的索引大小（字节），计入 state_memory_bytes。"""
+        return 0
+
+    def pooled_topics(self) -> List[int]:
+        """预建话题池中的空闲话题（按加入顺序）。"""
+        raise NotImplementedError
+
+    def add_pooled_topic(self, thread_id: int) -> None:
+        raise NotImplementedError
+
+    def take_pooled_topic(self) -> Optional[int]:
+        """原子地取出最早加入的空闲话题；池为空时返回 None。"""
+        raise NotImplementedError
+
+    def claim(self, key: str, owner: str, ttl: float) -> bool:
+        """跨进程互斥认领 key，ttl 秒后自动失效；单进程后端总是成功。"""
+        return True
+
+    def release(self, key: str, owner: str) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def _write_file_atomic(path: Path, payload: str) -> None:
+    """写入临时文件并 fsync 后原子替换，崩溃时不会留下半个文件。"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        fp.write(payload)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+    # 同步目录项，确保 rename 本身落盘（部分文件系统不支持，忽略即可）
+    try:
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+# JSON 文件的版本标记：(修改时间 ns, 大小)，用于判断二进制快照是否仍然有效
+FileStamp = Tuple[int, int]
+
+# 旧版 JSON 的词法单元：分节名（含未知字段）、"数字": 值、数组中的数字
+_LEGACY_JSON_SECTION = re.compile(rb'"([A-Za-z_]\w*)"\s*:')
+_LEGACY_JSON_PAIR = re.compile(rb'"(-?\d+)"\s*:\s*(-?\d+|true|false|null)')
+_LEGACY_JSON_NUMBER = re.compile(rb"-?\d+")
+
+
+def _stream_legacy_json(path: Path, chunk_size: int = 1 << 20) -> "SessionTable":
+    """分块流式解析旧版 topic_mapping.json，不构建完整的 JSON 对象树。
+
+    语义与旧的全量加载一致：出现在任一分节中的用户都有会话；thread_to_user 中
+    指向已有用户、且未被其他用户占用的旧话题，仍可按话题找到该用户。
+    """
+    user_to_thread: Dict[int, int] = {}
+    verified: Dict[int, bool] = {}
+    banned: Set[int] = set()
+    legacy_threads: Dict[int, int] = {}
+    section = b""
+    tail = b""
+    with open(path, "rb") as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            data = tail + chunk
+            if chunk:
+                # 词法单元内部不含 , { [，在最后一个分隔符处切开，剩余部分留到下一块
+                cut = max(data.rfind(b","), data.rfind(b"{"), data.rfind(b"[")) + 1
+                data, tail = data[:cut], data[cut:]
+            # 按分节名把本块切成若干段，每段用对应的正则整体提取
+            segments = []
+            pos = 0
+            for match in _LEGACY_JSON_SECTION.finditer(data):
+                segments.append((section, pos, match.start()))
+                section, pos = match.group(1), match.end()
+            segments.append((section, pos, len(data)))
+            for name, begin, end in segments:
+                if name == b"user_to_thread":
+                    pairs = _LEGACY_JSON_PAIR.findall(data, begin, end)
+                    user_to_thread.update(
+                        (int(k), int(v)) for k, v in pairs if v != b"null"
+                    )
+                elif name == b"user_verified":
+                    pairs = _LEGACY_JSON_PAIR.findall(data, begin, end)
+                    verified.update(
+                        (int(k), v not in (b"false", b"null", b"0")) for k, v in pairs
+                    )
+                elif name == b"thread_to_user":
+                    pairs = _LEGACY_JSON_PAIR.findall(data, begin, end)
+                    legacy_threads.update(
+                        (int(k), int(v)) for k, v in pairs if v != b"null"
+                    )
+                elif name == b"banned_users":
+                    banned.update(
+                        map(int, _LEGACY_JSON_NUMBER.findall(data, begin, end))
+                    )
+            if not chunk:
+                break
+
+    users = user_to_thread.keys() | verified.keys() | banned
+    uids = array("q", sorted(users))
+    tids = array("q", [user_to_thread.get(uid, 0) for uid in uids])
+    flags = bytes([verified.get(uid, False) | (uid in banned) << 1 for uid in uids])
+    current = set(user_to_thread.values())
+    extra = {
+        tid: uid
+        for tid, uid in legacy_threads.items()
+        if tid not in current and uid in users
+    }
+    return SessionTable.build(uids, tids, flags, extra)
+
+
+class SessionTable:
+    """已保存会话的紧凑只读表示：按用户 ID 排序的列数组，加上按话题 ID 排序的
+    反向索引。每个用户约 33 字节，查找为二分；可整体存取为二进制快照。"""
+
+    _MAGIC = b"PMBSNAP1"
+    _HEADER = struct.Struct("<8sBqqqq")
+
+    def __init__(
+        self,
+        uids: array,
+        tids: array,
+        flags: bytes,
+        rev_tids: array,
+        rev_uids: array,
+    ) -> None:
+        self.uids = uids
+        self.tids = tids  # 0 表示没有话题
+        self.flags = flags  # bit0 已验证，bit1 已封禁
+        self.rev_tids = rev_tids
+        self.rev_uids = rev_uids
+
+    @classmethod
+    def build(
+        cls,
+        uids: array,
+        tids: array,
+        flags: bytes,
+        extra_threads: Optional[Dict[int, int]] = None,
+    ) -> "SessionTable":
+        """由按用户 ID 排序的列构建；extra_threads 为额外的 {话题: 用户} 反查。"""
+        owners = dict(extra_threads or {})
+        owners.update((tid, uid) for uid, tid in zip(uids, tids) if tid)
+        rev_tids = array("q", sorted(owners))
+        rev_uids = array("q", map(owners.__getitem__, rev_tids))
+        return cls(uids, tids, flags, rev_tids, rev_uids)
+
+    @classmethod
+    def from_rows(cls, rows: Dict[int, SessionRow]) -> "SessionTable":
+        uids = array("q", sorted(rows))
+        tids = array("q", [rows[uid][0] or 0 for uid in uids])
+        flags = bytes([rows[uid][1] | rows[uid][2] << 1 for uid in uids])
+        return cls.build(uids, tids, flags)
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def columns(self) -> Tuple[array, array, bytes]:
+        return self.uids, self.tids, self.flags
+
+    def get(self, user_id: int) -> Optional[SessionRow]:
+        i = bisect_left(self.uids, user_id)
+        if i == len(self.uids) or self.uids[i] != user_id:
+            return None
+        flag = self.flags[i]
+        return self.tids[i] or None, bool(flag & 1), bool(flag & 2)
+
+    def owner_of_thread(self, thread_id: int) -> Optional[int]:
+        i = bisect_left(self.rev_tids, thread_id)
+        if i == len(self.rev_tids) or self.rev_tids[i] != thread_id:
+            return None
+        return self.rev_uids[i]
+
+    def items(self) -> Iterable[Tuple[int, SessionRow]]:
+        for uid, tid, flag in zip(self.uids, self.tids, self.flags):
+            yield uid, (tid or None, bool(flag & 1), bool(flag & 2))
+
+    def nbytes(self) -> int:
+        return (
+            len(self.uids) * 17 + (len(self.rev_tids) * 16) + sys.getsizeof(self.flags)
+        )
+
+    def save(self, path: Path, stamp: FileStamp) -> None:
+        """原子写入二进制快照，stamp 为对应 JSON 文件的版本标记。"""
+        tmp_path = path.with_name(path.name + ".tmp")
+        byteorder = 1 if sys.byteorder == "little" else 0
+        with open(tmp_path, "wb") as fp:
+            fp.write(
+                self._HEADER.pack(
+                    self._MAGIC, byteorder, *stamp, len(self.uids), len(self.rev_tids)
+                )
+            )
+            for column in (self.uids, self.tids, self.flags):
+                fp.write(column)
+            for column in (self.rev_tids, self.rev_uids):
+                fp.write(column)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path: Path, stamp: FileStamp) -> Optional["SessionTable"]:
+        """读取快照；文件缺失、损坏或与 stamp 不符（JSON 已被改写）时返回 None。"""
+        try:
+            with open(path, "rb") as fp:
+                header = fp.read(cls._HEADER.size)
+                magic, byteorder, mtime_ns, size, n, m = cls._HEADER.unpack(header)
+                if (
+                    magic != cls._MAGIC
+                    or byteorder != (1 if sys.byteorder == "little" else 0)
+                    or (mtime_ns, size) != stamp
+                ):
+                    return None
+                columns = []
+                for typecode, count in (
+                    ("q", n),
+                    ("q", n),
+                    ("B", n),
+                    ("q", m),
+                    ("q", m),
+                ):
+                    column = array(typecode)
+                    column.fromfile(fp, count)
+                    columns.append(column)
+        except (OSError, EOFError, struct.error):
+            return None
+        uids, tids, flags, rev_tids, rev_uids = columns
+        return cls(uids, tids, flags.tobytes(), rev_tids, rev_uids)
+
+
+def _encode_snapshot(
+    columns: Tuple[array, array, bytes], overlay: Dict[int, Optional[SessionRow]]
+) -> str:
+    """把全量会话（快照列 + 之后的变更）编码为旧版 JSON 格式（可在进程池中执行）。"""
+    data: Dict[str, Any] = {
         "user_to_thread": {},
         "thread_to_user": {},
         "user_verified": {},
         "banned_users": [],
     }
 
-    for user_id, session in user_sessions.items():
-        if session.thread_id:
-            data["user_to_thread"][str(user_id)] = session.thread_id
-            data["thread_to_user"][str(session.thread_id)] = user_id
-        data["user_verified"][str(user_id)] = session.verified
-        if session.banned:
+    def emit(user_id: int, thread_id: Optional[int], verified: bool, banned: bool):
+        if thread_id:
+            data["user_to_thread"][str(user_id)] = thread_id
+            data["thread_to_user"][str(thread_id)] = user_id
+        data["user_verified"][str(user_id)] = verified
+        if banned:
             data["banned_users"].append(user_id)
 
-    try:
-        PERSIST_FILE.parent.mkdir(parents=True, exist_ok=True)
-        PERSIST_FILE.write_text(
-            json.dumps(data, ensure_ascii=False, indent=2),
-            encoding="utf-8",
+    for user_id, thread_id, flag in zip(*columns):
+        if user_id not in overlay:
+            emit(user_id, thread_id, bool(flag & 1), bool(flag & 2))
+    for user_id, row in overlay.items():
+        if row is not None:
+            emit(user_id, *row)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+# 提交给进程池的编码函数。多租户时各租户模块不能被子进程按名导入，
+# 宿主会把它换成宿主模块中的同名函数
+snapshot_encoder: Callable[..., str] = _encode_snapshot
+
+# load_one 中区分“overlay 未记录”与“已删除（None）”
+_NOT_CHANGED = object()
+
+
+class JsonFileStorage(SessionStorage):
+    """JSON 文件（旧格式）加追加日志。
+
+    topic_mapping.json 是定期压实的全量数据；两次压实之间的变更逐行追加到
+    topic_mapping.log（每行一个会话的最新状态），每次写入只追加本批变更并 fsync，
+    开销与用户总数无关。日志行数超过 max(10000, 全量行数/4) 时压实：写出新的 JSON
+    与快照并清空日志，摊到每次变更上仍是常数开销。
+
+    启动时不创建会话对象：优先读取同目录的二进制快照（topic_mapping.snapshot），
+    快照缺失或 JSON 在其后被改写过时，流式解析 JSON 并重新生成快照；日志非空时
+    （上次未正常停机）重放后立即压实。已保存的数据放在紧凑的 SessionTable 中，
+    日志中的变更记在 overlay 里。正常停机时压实一次，下次启动只需读取快照。
+    """
+
+    COMPACT_MIN_ROWS = 10000
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.snapshot_path = path.with_suffix(".snapshot")
+        self.log_path = path.with_suffix(".log")
+        # 预建话题池单独存一个小文件，取用话题时不必重写整个映射文件
+        self.pool_path = path.with_suffix(".pool.json")
+        self._pool: Optional[List[int]] = None
+        # 话题池操作可能同时在多个执行器线程中进行
+        self._pool_lock = threading.Lock()
+        self._log: Optional[TextIO] = None
+        # (已压实的数据, 之后的变更（None 为删除）, 变更中的话题反查)；
+        # 压实时在旁边建好新表后一次赋值整体替换
+        self._state: Tuple[
+            SessionTable, Dict[int, Optional[SessionRow]], Dict[int, int]
+        ] = (SessionTable.from_rows({}), {}, {})
+
+    def _stamp(self) -> FileStamp:
+        stat = self.path.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self) -> int:
+        table = SessionTable.from_rows({})
+        if self.path.exists() and self.path.stat().st_size > 0:
+            stamp = self._stamp()
+            opened = SessionTable.open(self.snapshot_path, stamp)
+            if opened is None:
+                table = _stream_legacy_json(self.path)
+                try:
+                    table.save(self.snapshot_path, stamp)
+                except OSError as exc:
+                    logger.warning("写入会话快照失败: %s", exc)
+            else:
+                table = opened
+        self._state = (table, {}, {})
+
+        replayed = self._replay_log()
+        if replayed:
+            logger.info("已重放 %d 条未压实的会话变更", replayed)
+            self._compact()
+        return len(self._state[0])
+
+    def _replay_log(self) -> int:
+        try:
+            fp = open(self.log_path, encoding="utf-8")
+        except FileNotFoundError:
+            return 0
+        count = 0
+        with fp:
+            for line in fp:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # 崩溃时最后一行可能只写了一半，之后的内容都不可信
+                    logger.warning("会话变更日志在第 %d 行之后损坏，已忽略", count)
+                    break
+                row = tuple(item[1:]) if len(item) == 4 else None
+                self._apply(int(item[0]), row)
+                count += 1
+        return count
+
+    # 查询在事件循环线程执行、写入在写线程执行：overlay 只增改不删，
+    # 压实时整体换成新对象，因此查询无需加锁
+    def load_one(self, user_id: int) -> Optional[SessionRow]:
+        base, overlay, _ = self._state
+        row = overlay.get(user_id, _NOT_CHANGED)
+        if row is not _NOT_CHANGED:
+            return row
+        return base.get(user_id)
+
+    def owner_of_thread(self, thread_id: int) -> Optional[int]:
+        base, overlay, threads = self._state
+        user_id = threads.get(thread_id)
+        if user_id is not None:
+            return user_id
+        user_id = base.owner_of_thread(thread_id)
+        row = overlay.get(user_id, _NOT_CHANGED)
+        if row is not _NOT_CHANGED and (row is None or row[0] != thread_id):
+            # 该用户在压实之后换了话题或被删除
+            return None
+        return user_id
+
+    def memory_bytes(self) -> int:
+        base, overlay, threads = self._state
+        return base.nbytes() + (len(overlay) + len(threads)) * 150
+
+    def _merged(self) -> Dict[int, SessionRow]:
+        base, overlay, _ = self._state
+        rows = {uid: row for uid, row in base.items() if uid not in overlay}
+        rows.update((uid, row) for uid, row in overlay.items() if row is not None)
+        return rows
+
+    def _apply(self, user_id: int, row: Optional[SessionRow]) -> None:
+        _, overlay, threads = self._state
+        old = self.load_one(user_id)
+        if old is not None and threads.get(old[0]) == user_id:
+            del threads[old[0]]
+        overlay[user_id] = row
+        if row is not None and row[0]:
+            threads[row[0]] = user_id
+
+    def write(self, changes: Dict[int, Optional[SessionRow]]) -> None:
+        lines = []
+        for user_id, row in changes.items():
+            lines.append(json.dumps([user_id] if row is None else [user_id, *row]))
+        self._append_log(lines)
+        for user_id, row in changes.items():
+            self._apply(user_id, row)
+
+        base, overlay, _ = self._state
+        if len(overlay) > max(self.COMPACT_MIN_ROWS, len(base) // 4):
+            self._compact()
+
+    def _append_log(self, lines: List[str]) -> None:
+        if self._log is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._log = open(self.log_path, "a", encoding="utf-8")
+        self._log.write("".join(line + "\n" for line in lines))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def _compact(self) -> None:
+        """把日志中的变更合并进新的 JSON 与快照，然后清空日志。"""
+        base, overlay, _ = self._state
+        if (
+            cpu_pool is not None
+            and len(base) + len(overlay) >= SNAPSHOT_OFFLOAD_MIN_ROWS
+        ):
+            # 大文件在子进程中编码，避免长时间占用 GIL 拖慢事件循环
+            payload = cpu_pool.submit(
+                snapshot_encoder, base.columns(), overlay
+            ).result()
+        else:
+            payload = _encode_snapshot(base.columns(), overlay)
+        _write_file_atomic(self.path, payload)
+
+        table = SessionTable.from_rows(self._merged())
+        try:
+            table.save(self.snapshot_path, self._stamp())
+        except OSError as exc:
+            logger.warning("写入会话快照失败: %s", exc)
+        self._state = (table, {}, {})
+
+        # JSON 已落盘后才清空日志；两者之间崩溃时重放日志是幂等的
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        with open(self.log_path, "w", encoding="utf-8") as fp:
+            os.fsync(fp.fileno())
+
+    def _load_pool(self) -> List[int]:
+        if self._pool is None:
+            try:
+                self._pool = [int(t) for t in json.loads(self.pool_path.read_text())]
+            except FileNotFoundError:
+                self._pool = []
+        return self._pool
+
+    def _write_pool(self, pool: List[int]) -> None:
+        _write_file_atomic(self.pool_path, json.dumps(pool))
+        self._pool = pool
+
+    def pooled_topics(self) -> List[int]:
+        with self._pool_lock:
+            return list(self._load_pool())
+
+    def add_pooled_topic(self, thread_id: int) -> None:
+        with self._pool_lock:
+            self._write_pool(self._load_pool() + [thread_id])
+
+    def take_pooled_topic(self) -> Optional[int]:
+        with self._pool_lock:
+            pool = self._load_pool()
+            if not pool:
+                return None
+            self._write_pool(pool[1:])
+            return pool[0]
+
+    def close(self) -> None:
+        """停机时压实，下次启动只需读取快照。"""
+        try:
+            if self._state[1]:
+                self._compact()
+        except OSError as exc:
+            logger.warning("停机时压实会话数据失败: %s", exc)
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+class SqliteStorage(SessionStorage):
+    """SQLite（WAL 模式）按行存储；封禁、验证等变更只 upsert 对应行，
+    写入开销与用户总数无关。首次启动时自动从旧 JSON 文件一次性迁移。
+    多副本可共享同一个数据库：写入只 upsert / 删除变更的行。"""
+
+    def __init__(self, path: Path, legacy_json: Optional[Path] = None) -> None:
+        self.path = path
+        self.legacy_json = legacy_json
+        self._conn: Optional[sqlite3.Connection] = None
+        # 写入、认领与话题池操作在工作线程，共用写连接需要互斥
+        self._lock = threading.Lock()
+        # 单行查询在事件循环线程（get_session / user_for_thread）：使用单独的只读连接。
+        # WAL 模式下读不等待写，写连接持有事务或等待其他进程的写锁时也不会卡住事件循环
+        self._reader: Optional[sqlite3.Connection] = None
+        self._read_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # 多个进程共享数据库时，写锁冲突等待而不是立即报错
+            conn.execute("PRAGMA busy_timeout=5000")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions ("
+                    " user_id INTEGER PRIMARY KEY,"
+                    " thread_id INTEGER,"
+                    " verified INTEGER NOT NULL DEFAULT 0,"
+                    " banned INTEGER NOT NULL DEFAULT 0)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_sessions_thread"
+                    " ON sessions(thread_id)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS meta ("
+                    " key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS claims ("
+                    " key TEXT PRIMARY KEY, owner TEXT NOT NULL,"
+                    " expires_at REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS topic_pool ("
+                    " thread_id INTEGER PRIMARY KEY, created_at REAL NOT NULL)"
+                )
+            self._conn = conn
+        return self._conn
+
+    def _read_conn(self) -> sqlite3.Connection:
+        """调用方需持有 _read_lock。"""
+        if self._reader is None:
+            if not self.path.exists():
+                # 通常 load() 已建好数据库；只有尚未 load 时才需要借用写连接建表
+                with self._lock:
+                    self._connect()
+            conn = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+            )
+            # 读只会在 WAL 检查点等极短时间内被阻塞，不沿用写连接的 5 秒等待
+            conn.execute("PRAGMA busy_timeout=100")
+            self._reader = conn
+        return self._reader
+
+    def _migrate_legacy_json(self, conn: sqlite3.Connection) -> None:
+        """一次性从旧 topic_mapping.json 迁移，迁移记录写入 meta 表。"""
+        done = conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone()
+        if done or self.legacy_json is None or not self.legacy_json.exists():
+            return
+
+        table = _stream_legacy_json(self.legacy_json)
+        with conn:
+            self._upsert(conn, table.items())
+            conn.execute(
+                "INSERT OR REPLACE INTO meta(key, value) VALUES ('json_migrated', ?)",
+                (str(self.legacy_json),),
+            )
+        logger.info(
+            "已从 %s 迁移 %d 个会话到 %s", self.legacy_json, len(table), self.path
+        )
+
+    def load(self) -> int:
+        # 会话按需通过 load_one / owner_of_thread 读取，启动时只做迁移与计数
+        with self._lock:
+            conn = self._connect()
+            self._migrate_legacy_json(conn)
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    @staticmethod
+    def _upsert(
+        conn: sqlite3.Connection, rows: Iterable[Tuple[int, SessionRow]]
+    ) -> None:
+        conn.executemany(
+            "INSERT INTO sessions(user_id, thread_id, verified, banned)"
+            " VALUES (?, ?, ?, ?)"
+            " ON CONFLICT(user_id) DO UPDATE SET"
+            " thread_id = excluded.thread_id,"
+            " verified = excluded.verified,"
+            " banned = excluded.banned",
+            (
+                (uid, thread_id, int(verified), int(banned))
+                for uid, (thread_id, verified, banned) in rows
+            ),
         )
+
+    def write(self, changes: Dict[int, Optional[SessionRow]]) -> None:
+        upserts = {uid: row for uid, row in changes.items() if row is not None}
+        deletes = [(uid,) for uid, row in changes.items() if row is None]
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                if deletes:
+                    conn.executemany("DELETE FROM sessions WHERE user_id = ?", deletes)
+                self._upsert(conn, upserts.items())
+
+    def load_one(self, user_id: int) -> Optional[SessionRow]:
+        with self._read_lock:
+            row = (
+                self._read_conn()
+                .execute(
+                    "SELECT thread_id, verified, banned FROM sessions"
+                    " WHERE user_id = ?",
+                    (user_id,),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return None
+        return row[0], bool(row[1]), bool(row[2])
+
+    def owner_of_thread(self, thread_id: int) -> Optional[int]:
+        with self._read_lock:
+            row = (
+                self._read_conn()
+                .execute(
+                    "SELECT user_id FROM sessions WHERE thread_id = ? LIMIT 1",
+                    (thread_id,),
+                )
+                .fetchone()
+            )
+        return row[0] if row else None
+
+    def pooled_topics(self) -> List[int]:
+        with self._lock:
+            rows = (
+                self._connect()
+                .execute("SELECT thread_id FROM topic_pool ORDER BY created_at")
+                .fetchall()
+            )
+        return [row[0] for row in rows]
+
+    def add_pooled_topic(self, thread_id: int) -> None:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO topic_pool(thread_id, created_at)"
+                    " VALUES (?, ?)",
+                    (thread_id, time()),
+                )
+
+    def take_pooled_topic(self) -> Optional[int]:
+        with self._lock:
+            conn = self._connect()
+            while True:
+                row = conn.execute(
+                    "SELECT thread_id FROM topic_pool ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                with conn:
+                    deleted = conn.execute(
+                        "DELETE FROM topic_pool WHERE thread_id = ?", row
+                    ).rowcount
+                # 多副本共享数据库时可能被其他进程抢先取走，换下一个
+                if deleted:
+                    return row[0]
+
+    def claim(self, key: str, owner: str, ttl: float) -> bool:
+        now = time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                # 不存在、已过期或本就属于自己时认领成功
+                conn.execute(
+                    "INSERT INTO claims(key, owner, expires_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT(key) DO UPDATE SET"
+                    " owner = excluded.owner, expires_at = excluded.expires_at"
+                    " WHERE claims.expires_at < ? OR claims.owner = excluded.owner",
+                    (key, owner, now + ttl, now),
+                )
+                row = conn.execute(
+                    "SELECT owner FROM claims WHERE key = ?", (key,)
+                ).fetchone()
+        return row is not None and row[0] == owner
+
+    def release(self, key: str, owner: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "DELETE FROM claims WHERE key = ? AND owner = ?", (key, owner)
+                )
+
+    def close(self) -> None:
+        with self._read_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def _create_storage() -> SessionStorage:
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(SQLITE_PATH, legacy_json=PERSIST_FILE)
+    return JsonFileStorage(PERSIST_FILE)
+
+
+class MappingPersister:
+    """防抖、增量、异步的映射持久化引擎。
+
+    - 调用方只标记脏会话，同一防抖窗口内的多次变更合并为一次写入；
+    - 只把脏会话交给存储后端，写入在工作线程中执行，不阻塞事件循环；
+    - 全量重建重写内存中已加载的全部会话（未加载的会话在存储中已是最新）；
+    - 停机时调用 close() 写入剩余变更。
+    """
+
+    def __init__(self, storage: SessionStorage, debounce: float) -> None:
+        self.storage = storage
+        self.debounce = debounce
+        self._dirty: Set[int] = set()
+        self._full_rebuild = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+
+    def mark_dirty(self, user_id: Optional[int] = None) -> None:
+        """标记变更；user_id 为 None 时下次写入全量重建。"""
+        if user_id is None:
+            self._full_rebuild = True
+        else:
+            self._dirty.add(user_id)
+        self._schedule()
+
+    def _pending(self) -> bool:
+        return self._full_rebuild or bool(self._dirty)
+
+    def _schedule(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 没有运行中的事件循环（如启动阶段或脚本调用）：直接同步写入
+            try:
+                self.storage.write(self._collect())
+            except Exception as exc:
+                logger.error("保存数据失败: %s", exc)
+            return
+        self._flush_task = loop.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        while True:
+            await asyncio.sleep(self.debounce)
+            await self.flush()
+            if not self._pending():
+                break
+
+    async def flush(self) -> None:
+        """立即写入所有待持久化的变更。"""
+        async with self._write_lock:
+            if not self._pending():
+                return
+            dirty, full = set(self._dirty), self._full_rebuild
+            changes = self._collect()
+            started = perf_counter()
+            try:
+                await _in_writer(self.storage.write, changes)
+            except Exception as exc:
+                PERSIST_FLUSH.observe(perf_counter() - started, "error")
+                logger.error("保存数据失败: %s", exc)
+                # 写入失败：恢复脏标记，等待下一轮重试
+                self._dirty |= dirty
+                self._full_rebuild = self._full_rebuild or full
+            else:
+                PERSIST_FLUSH.observe(perf_counter() - started, "ok")
+
+    async def close(self) -> None:
+        """停机时调用：取消防抖计时、写入剩余变更并关闭存储。"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        self.storage.close()
+
+    def _collect(self) -> Dict[int, Optional[SessionRow]]:
+        """在事件循环中读取脏会话的当前状态（全量重建时读取全部已加载会话）。"""
+        if self._full_rebuild:
+            changes: Dict[int, Optional[SessionRow]] = {
+                uid: _session_row(s) for uid, s in user_sessions.items()
+            }
+        else:
+            changes = {}
+            for uid in self._dirty:
+                session = user_sessions.get(uid)
+                changes[uid] = None if session is None else _session_row(session)
+        self._dirty.clear()
+        self._full_rebuild = False
+        return changes
+
+
+storage = _create_storage()
+persister = MappingPersister(storage, PERSIST_DEBOUNCE_SECONDS)
+
+
+def load_persisted_mapping() -> int:
+    """启动时准备存储后端（JSON 后端兼容旧数据格式），返回已保存的会话数。
+
+    会话不在启动时整体读入，由 get_session / user_for_thread 按需加载。
+    """
+    global user_sessions, thread_to_user
+
+    user_sessions = {}
+    thread_to_user = {}
+    started = perf_counter()
+    try:
+        count = storage.load()
     except Exception as exc:
-        print(f"保存数据失败: {exc}")
+        logger.error("读取数据文件失败: %s", exc)
+        return 0
+    logger.info("已索引 %d 个会话，耗时 %.2f 秒", count, perf_counter() - started)
+    return count
+
+
+def persist_mapping(user_id: Optional[int] = None) -> None:
+    """标记会话变更并安排防抖写入；不传 user_id 时全量重建。"""
+    persister.mark_dirty(user_id)
+
+
+# ---------- 消息映射（编辑同步） ----------
+def _pack_message_key(chat_id: int, message_id: int) -> int:
+    """把 (chat_id, message_id) 压成一个 int 作为字典键，省去元组开销。"""
+    return (chat_id << 32) | message_id
+
+
+class MessageMapStore:
+    """编辑同步用的消息映射：内存部分是定长环形数组，超出上限时覆盖最旧条目，
+    所有映射同时批量写入 SQLite 磁盘索引，内存未命中（被淘汰或重启后）时回查磁盘。
+
+    内存布局：_index 把压缩后的源消息键映射到单调递增的写入位置 pos，
+    各字段按 pos % max_entries 存放在 array 中。命中时把条目重新追加到队尾
+    （旧位置成为空洞），因此环内按最近使用时间有序，过期清理与容量淘汰
+    都只需从队首推进。
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        db_path: Optional[Path],
+        disk_ttl: float,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.disk_ttl = disk_ttl
+        self._index: Dict[int, int] = {}
+        self._src_chat = array("q")
+        self._src_msg = array("i")
+        self._dst_chat = array("q")
+        self._dst_msg = array("i")
+        self._touched = array("I")  # 最近使用时间（秒）
+        self._head = 0  # 下一个写入位置
+        self._tail = 0  # 最旧的可能有效位置
+        self._pending: List[Tuple[int, int, int, int, float]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        # 连续写入失败次数；达到 MESSAGE_MAP_DEGRADE_FAILURES 时暂停磁盘回查，
+        # 写入仍按退避间隔重试，成功后恢复
+        self._disk_failures = 0
+        self._disk_failed = False
+        # 统计信息
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+        self.expire_pause_max = 0.0
+        self.disk_write_failures = 0
+        self.disk_dropped = 0
+        self._lookup_seconds = 0.0
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def disk_pending(self) -> int:
+        """等待写入磁盘的条数。"""
+        return len(self._pending)
+
+    @property
+    def disk_degraded(self) -> bool:
+        """连续写入失败后是否已暂停磁盘回查。"""
+        return self._disk_failed
+
+    def put(
+        self,
+        source_chat_id: int,
+        source_message_id: int,
+        target_chat_id: int,
+        target_message_id: int,
+    ) -> None:
+        """记录一条映射，并安排批量写入磁盘。"""
+        now = time()
+        self._append(
+            source_chat_id, source_message_id, target_chat_id, target_message_id, now
+        )
+        if self.db_path is not None:
+            self._pending.append(
+                (
+                    source_chat_id,
+                    source_message_id,
+                    target_chat_id,
+                    target_message_id,
+                    now,
+                )
+            )
+            self._schedule_flush()
+
+    def _append(
+        self,
+        source_chat_id: int,
+        source_message_id: int,
+        target_chat_id: int,
+        target_message_id: int,
+        now: float,
+    ) -> None:
+        if self._head - self._tail >= self.max_entries:
+            self._drop_tail()
+
+        pos = self._head
+        slot = pos % self.max_entries
+        values = (
+            (self._src_chat, source_chat_id),
+            (self._src_msg, source_message_id),
+            (self._dst_chat, target_chat_id),
+            (self._dst_msg, target_message_id),
+            (self._touched, int(now)),
+        )
+        if slot == len(self._touched):
+            for column, value in values:
+                column.append(value)
+        else:
+            for column, value in values:
+                column[slot] = value
+
+        self._index[_pack_message_key(source_chat_id, source_message_id)] = pos
+        self._head += 1
+
+    def _tail_key(self) -> Tuple[int, bool]:
+        """返回队首位置的键，以及该位置是否仍是有效条目（而非空洞）。"""
+        slot = self._tail % self.max_entries
+        key = _pack_message_key(self._src_chat[slot], self._src_msg[slot])
+        return key, self._index.get(key) == self._tail
+
+    def _drop_tail(self) -> bool:
+        """移除队首位置，返回是否淘汰了一个有效条目。"""
+        key, live = self._tail_key()
+        if live:
+            del self._index[key]
+            self.evicted += 1
+        self._tail += 1
+        return live
+
+    async def get(
+        self, source_chat_id: int, source_message_id: int
+    ) -> Optional[Tuple[int, int]]:
+        """查找目标消息 (chat_id, message_id)；内存未命中时回查磁盘索引。"""
+        started = perf_counter()
+        try:
+            pos = self._index.get(_pack_message_key(source_chat_id, source_message_id))
+            if pos is not None:
+                slot = pos % self.max_entries
+                target = self._dst_chat[slot], self._dst_msg[slot]
+                self.hits += 1
+                # 重新追加到队尾，旧位置成为空洞
+                self._append(source_chat_id, source_message_id, *target, time())
+                return target
+
+            row = None
+            if self.db_path is not None and not self._disk_failed:
+                # 可能还在待写队列里，先落盘再查；写入失败重试期间不额外触发写入
+                if not self._disk_failures:
+                    await self.flush()
+                row = await asyncio.to_thread(
+                    self._disk_lookup, source_chat_id, source_message_id
+                )
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.disk_hits += 1
+            self._append(source_chat_id, source_message_id, *row, time())
+            return row
+        finally:
+            self._lookup_seconds += perf_counter() - started
+
+    def expire(self, now: float, budget: float) -> Tuple[int, bool]:
+        """从队首推进，清理超过 TTL 未使用的内存条目。
+
+        单次调用最多占用 budget 秒，返回 (清理数量, 是否已清理完)；
+        只会访问已过期的条目和队首第一个未过期条目。
+        """
+        started = perf_counter()
+        removed = 0
+        cutoff = now - self.ttl
+        finished = False
+        while True:
+            if self._tail >= self._head:
+                finished = True
+                break
+            key, live = self._tail_key()
+            if live and self._touched[self._tail % self.max_entries] > cutoff:
+                finished = True
+                break
+            if live:
+                del self._index[key]
+                removed += 1
+            self._tail += 1
+            # 每处理一小批检查一次耗时，避免频繁调用 perf_counter
+            if not self._tail & 0xFF and perf_counter() - started >= budget:
+                break
+
+        pause = perf_counter() - started
+        self.expired += removed
+        self.expire_pause_max = max(self.expire_pause_max, pause)
+        MESSAGE_MAP_EXPIRE_PAUSE.observe(pause)
+        return removed, finished
+
+    def stats(self) -> Dict[str, Any]:
+        """内存占用（估算）与查询统计。"""
+        size = len(self._index)
+        column_bytes = sum(
+            column.buffer_info()[1] * column.itemsize
+            for column in (
+                self._src_chat,
+                self._src_msg,
+                self._dst_chat,
+                self._dst_msg,
+                self._touched,
+            )
+        )
+        # 每个索引条目：键 int 与位置 int 各一个对象
+        index_bytes = sys.getsizeof(self._index) + size * 2 * sys.getsizeof(1 << 40)
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": size,
+            "approx_bytes": column_bytes + index_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "expire_pause_max_ms": self.expire_pause_max * 1000,
+            "avg_lookup_us": (self._lookup_seconds / lookups * 1e6 if lookups else 0.0),
+        }
+
+    # ----- 磁盘索引 -----
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            assert self.db_path is not None
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS message_map ("
+                    " src_chat INTEGER NOT NULL,"
+                    " src_msg INTEGER NOT NULL,"
+                    " dst_chat INTEGER NOT NULL,"
+                    " dst_msg INTEGER NOT NULL,"
+                    " ts REAL NOT NULL,"
+                    " PRIMARY KEY (src_chat, src_msg)) WITHOUT ROWID"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_message_map_ts ON message_map(ts)"
+                )
+            self._conn = conn
+        return self._conn
+
+    def _disk_lookup(
+        self, source_chat_id: int, source_message_id: int
+    ) -> Optional[Tuple[int, int]]:
+        with self._db_lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT dst_chat, dst_msg FROM message_map"
+                    " WHERE src_chat = ? AND src_msg = ?",
+                    (source_chat_id, source_message_id),
+                )
+                .fetchone()
+            )
+        return (int(row[0]), int(row[1])) if row else None
+
+    def _disk_write(self, rows: List[Tuple[int, int, int, int, float]]) -> None:
+        with self._db_lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO message_map"
+                    "(src_chat, src_msg, dst_chat, dst_msg, ts) VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+
+    def _disk_purge(self, cutoff: float) -> int:
+        with self._db_lock:
+            conn = self._connect()
+            with conn:
+                return conn.execute(
+                    "DELETE FROM message_map WHERE ts < ?", (cutoff,)
+                ).rowcount
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    def _retry_delay(self) -> float:
+        if not self._disk_failures:
+            return MESSAGE_MAP_FLUSH_SECONDS
+        return min(
+            MESSAGE_MAP_FLUSH_SECONDS * 2**self._disk_failures,
+            MESSAGE_MAP_RETRY_MAX_SECONDS,
+        )
+
+    async def _delayed_flush(self) -> None:
+        # 写入失败时按指数退避重试，直到待写队列清空
+        while True:
+            await asyncio.sleep(self._retry_delay())
+            await self.flush()
+            if not self._pending or not self._disk_failures:
+                return
+
+    async def flush(self) -> None:
+        """把待写队列批量写入磁盘。
+
+        失败时把这批放回队首（超过 MESSAGE_MAP_PENDING_MAX 时丢弃最旧的），
+        由 _delayed_flush 退避重试；连续失败多次后暂停磁盘回查，写入成功后恢复。
+        """
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            await _in_writer(self._disk_write, rows)
+        except Exception as exc:
+            # 放回队首，保持与之后写入的同键映射的先后顺序
+            self._pending[:0] = rows
+            overflow = len(self._pending) - MESSAGE_MAP_PENDING_MAX
+            if overflow > 0:
+                del self._pending[:overflow]
+                self.disk_dropped += overflow
+            self._disk_failures += 1
+            self.disk_write_failures += 1
+            if self._disk_failures == MESSAGE_MAP_DEGRADE_FAILURES:
+                self._disk_failed = True
+                logger.error(
+                    "消息映射连续 %d 次写入磁盘失败，暂停磁盘回查并继续重试: %s",
+                    self._disk_failures,
+                    exc,
+                )
+            else:
+                logger.warning(
+                    "消息映射写入磁盘失败（第 %d 次），%.1f 秒后重试: %s",
+                    self._disk_failures,
+                    self._retry_delay(),
+                    exc,
+                )
+            return
+        if self._disk_failed:
+            logger.info("消息映射磁盘写入已恢复")
+        self._disk_failures = 0
+        self._disk_failed = False
+
+    async def purge_disk(self, now: float) -> int:
+        """删除磁盘上超过保留期的映射。"""
+        if self.db_path is None or self._disk_failed:
+            return 0
+        try:
+            return await _in_writer(self._disk_purge, now - self.disk_ttl)
+        except Exception as exc:
+            logger.error("清理磁盘消息映射失败: %s", exc)
+            return 0
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self._pending:
+            logger.error("停机时仍有 %d 条消息映射未能写入磁盘", len(self._pending))
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.close()
+                self._conn = None
+
+
+# 消息映射表 (用于编辑同步)
+# Key: (source_chat_id, source_message_id) -> (target_chat_id, target_message_id)
+message_map = MessageMapStore(
+    MESSAGE_MAP_MAX_ENTRIES,
+    MESSAGE_MAP_TTL_SECONDS,
+    MESSAGE_MAP_DB,
+    MESSAGE_MAP_DISK_TTL_SECONDS,
+)
+
+
+# ---------- 话题健康缓存 ----------
+class _HealthEntry:
+    __slots__ = ("checked_at", "ttl", "healthy_since", "status")
+
+    def __init__(
+        self, checked_at: float, ttl: float, healthy_since: float, status: str
+    ) -> None:
+        self.checked_at = checked_at
+        self.ttl = ttl
+        self.healthy_since = healthy_since
+        self.status = status
+
+
+class ThreadHealthCache:
+    """有上限的话题健康缓存，按最近使用淘汰。
+
+    健康结果的 TTL 随话题持续健康的时长增长（健康时长的 1/10，介于基础 TTL
+    与上限之间）；失效、重定向等负面结果单独缓存，TTL 很短，且不会挤占
+    健康话题的容量。
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        base_ttl: float,
+        max_ttl: float,
+        negative_ttl: float,
+        transient_ttl: float,
+    ) -> None:
+        self.max_entries = max_entries
+        self.base_ttl = base_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.transient_ttl = transient_ttl
+        self._healthy: "OrderedDict[int, _HealthEntry]" = OrderedDict()
+        self._negative: "OrderedDict[int, _HealthEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._healthy) + len(self._negative)
+
+    def get(self, thread_id: int) -> Optional[bool]:
+        """返回缓存的健康状态；没有有效缓存时返回 None。"""
+        now = time()
+        for entries, healthy in ((self._negative, False), (self._healthy, True)):
+            entry = entries.get(thread_id)
+            if entry is None:
+                continue
+            if now - entry.checked_at >= entry.ttl:
+                # 健康条目过期后保留 healthy_since，供下次记录时计算 TTL
+                if not healthy:
+                    del entries[thread_id]
+                continue
+            entries.move_to_end(thread_id)
+            self.hits += 1
+            return healthy
+        self.misses += 1
+        return None
+
+    def record(self, thread_id: int, probe_result: Dict[str, Any]) -> bool:
+        """记录一次探测或实际发送得到的健康信号，返回是否健康。"""
+        now = time()
+        status = str(probe_result.get("status"))
+
+        if status == "ok":
+            self._negative.pop(thread_id, None)
+            entry = self._healthy.get(thread_id)
+            if entry is None:
+                entry = _HealthEntry(now, self.base_ttl, now, status)
+                self._healthy[thread_id] = entry
+            entry.checked_at = now
+            entry.ttl = min(
+                self.max_ttl, max(self.base_ttl, (now - entry.healthy_since) / 10)
+            )
+            self._healthy.move_to_end(thread_id)
+            self._evict(self._healthy, self.max_entries)
+            return True
+
+        self._healthy.pop(thread_id, None)
+        ttl = (
+            self.negative_ttl
+            if status in ("missing", "redirected", "missing_thread_id")
+            else self.transient_ttl
+        )
+        self._negative[thread_id] = _HealthEntry(now, ttl, now, status)
+        self._negative.move_to_end(thread_id)
+        self._evict(self._negative, max(1, self.max_entries // 4))
+        return False
+
+    def invalidate(self, thread_id: int) -> None:
+        self._healthy.pop(thread_id, None)
+        self._negative.pop(thread_id, None)
+
+    @staticmethod
+    def _evict(entries: "OrderedDict[int, _HealthEntry]", limit: int) -> None:
+        while len(entries) > limit:
+            entries.popitem(last=False)
+
+
+# 话题健康检查缓存，减少频繁探测请求
+thread_health_cache = ThreadHealthCache(
+    THREAD_HEALTH_CACHE_MAX_ENTRIES,
+    THREAD_HEALTH_CACHE_SECONDS,
+    THREAD_HEALTH_CACHE_MAX_SECONDS,
+    THREAD_HEALTH_NEGATIVE_SECONDS,
+    THREAD_HEALTH_TRANSIENT_SECONDS,
+)
+
+
+# ---------- 出站限流调度 ----------
+# 出站请求优先级（数值越小越优先）
+PRIORITY_USER = 0  # 用户消息、管理员回复、编辑同步
+PRIORITY_SYSTEM = 1  # 欢迎卡片、创建话题
+PRIORITY_PROBE = 2  # 话题探测与测试消息
+_PRIORITY_NAMES = {
+    PRIORITY_USER: "user",
+    PRIORITY_SYSTEM: "system",
+    PRIORITY_PROBE: "probe",
+}
+
+# 计入单聊天限额的接口（发送、复制、转发、编辑消息）
+_MESSAGE_ENDPOINT_PREFIXES = ("send", "copy", "forward", "edit")
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """距离可以取出一个令牌还需等待的秒数。"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float) -> None:
+        """收到 429 后在 retry_after 到期前暂停该桶。"""
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0.0
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "bucket", "future")
+
+    def __init__(
+        self,
+        priority: int,
+        seq: int,
+        bucket: Optional[_TokenBucket],
+        future: asyncio.Future,
+    ) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.bucket = bucket
+        self.future = future
+
+
+class OutboundScheduler(BaseRateLimiter[Dict[str, Any]]):
+    """所有 Bot API 调用的出站调度器（作为 PTB 的 rate_limiter 挂到 Bot 上）。
+
+    - 全局一个令牌桶，每个目标聊天一个令牌桶（群组与私聊限额不同）；
+    - 排队的请求按 (优先级, 到达顺序) 放行，探测与欢迎卡片让位于真实消息；
+    - 429 时按 retry_after 暂停对应的桶并重新排队，不会丢弃消息；
+    - 排队数超过 max_pending 时调用方等待，向处理器施加背压。
+
+    调用方通过 rate_limit_args={"priority": PRIORITY_PROBE} 指定优先级，默认为
+    PRIORITY_USER。
+    """
+
+    MAX_IDLE_BUCKETS = 4096
+
+    def __init__(
+        self,
+        global_rate: float,
+        chat_rate: float,
+        chat_burst: int,
+        group_rate_per_minute: float,
+        group_burst: int,
+        max_pending: int,
+    ) -> None:
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.group_burst = group_burst
+        self._global = _TokenBucket(global_rate, max(1.0, global_rate))
+        self._chats: Dict[Any, _TokenBucket] = {}
+        self._pending = asyncio.Semaphore(max_pending)
+        self._waiting: List[_Waiter] = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        # 统计信息
+        self.sent = 0
+        self.retried = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    async def initialize(self) -> None:
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    def _chat_bucket(
+        self, endpoint: str, data: Dict[str, Any]
+    ) -> Optional[_TokenBucket]:
+        chat_id = data.get("chat_id")
+        if chat_id is None or not endpoint.startswith(_MESSAGE_ENDPOINT_PREFIXES):
+            return None
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_IDLE_BUCKETS:
+                now = monotonic()
+                for key in [k for k, b in self._chats.items() if b.idle(now)]:
+                    del self._chats[key]
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            bucket = _TokenBucket(
+                self.group_rate if is_group else self.chat_rate,
+                self.group_burst if is_group else self.chat_burst,
+            )
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Any:
+        priority = (rate_limit_args or {}).get("priority", PRIORITY_USER)
+        kind = _PRIORITY_NAMES.get(priority, str(priority))
+        self._seq += 1
+        seq = self._seq
+
+        async with self._pending:
+            while True:
+                bucket = self._chat_bucket(endpoint, data)
+                queued_at = perf_counter()
+                await self._admit(priority, seq, bucket)
+                started = perf_counter()
+                API_QUEUE_WAIT.observe(started - queued_at, kind)
+                try:
+                    result = await callback(*args, **kwargs)
+                except RetryAfter as exc:
+                    API_LATENCY.observe(perf_counter() - started, endpoint)
+                    API_REQUESTS.inc(endpoint, kind, "retry_after")
+                    # 按 retry_after 暂停对应聊天（无聊天时暂停全局），保持原有顺序重新排队
+                    retry_after = exc.retry_after
+                    delay = (
+                        retry_after.total_seconds()
+                        if isinstance(retry_after, timedelta)
+                        else float(retry_after)
+                    )
+                    (bucket or self._global).block(monotonic() + delay)
+                    self.retried += 1
+                    continue
+                except Exception:
+                    API_LATENCY.observe(perf_counter() - started, endpoint)
+                    API_REQUESTS.inc(endpoint, kind, "error")
+                    raise
+                API_LATENCY.observe(perf_counter() - started, endpoint)
+                API_REQUESTS.inc(endpoint, kind, "ok")
+                self.sent += 1
+                return result
+
+    async def _admit(
+        self, priority: int, seq: int, bucket: Optional[_TokenBucket]
+    ) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append(_Waiter(priority, seq, bucket, future))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            delay = self._dispatch_ready(monotonic())
+            self._wakeup.clear()
+            if delay is None:
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch_ready(self, now: float) -> Optional[float]:
+        """放行当前所有可以发送的请求，返回距下一个请求可发送的秒数（队列为空时 None）。"""
+        while True:
+            # 清理已被取消的等待者
+            self._waiting = [w for w in self._waiting if not w.future.done()]
+            if not self._waiting:
+                return None
+
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                return global_wait
+
+            best: Optional[_Waiter] = None
+            min_wait = float("inf")
+            for waiter in self._waiting:
+                wait = waiter.bucket.wait_time(now) if waiter.bucket else 0.0
+                if wait > 0:
+                    min_wait = min(min_wait, wait)
+                elif best is None or (waiter.priority, waiter.seq) < (
+                    best.priority,
+                    best.seq,
+                ):
+                    best = waiter
+
+            if best is None:
+                return min_wait
+
+            self._global.take(now)
+            if best.bucket is not None:
+                best.bucket.take(now)
+            self._waiting.remove(best)
+            best.future.set_result(None)
+
+
+# 多副本时全局与群组配额由所有 worker 分摊（单个私聊只会落在一个 worker 上）
+_RATE_SHARE = len(REPLICA_NODES) if REPLICA_ROLE == "worker" else 1
+outbound = OutboundScheduler(
+    SEND_GLOBAL_RATE / _RATE_SHARE,
+    SEND_CHAT_RATE,
+    SEND_CHAT_BURST,
+    SEND_GROUP_RATE_PER_MINUTE / _RATE_SHARE,
+    max(1, SEND_GROUP_BURST // _RATE_SHARE),
+    SEND_QUEUE_MAX,
+)
+
+
+# ---------- Bot API 连接池 ----------
+# 响应较慢的调用（批量复制、创建话题）使用 API_SLOW_READ_TIMEOUT
+_SLOW_ENDPOINTS = frozenset(
+    ("copyMessages", "forwardMessages", "deleteMessages", "createForumTopic")
+)
+
+
+def _http2_enabled() -> bool:
+    if API_HTTP2 == "auto":
+        return importlib.util.find_spec("h2") is not None
+    return API_HTTP2 == "true"
+
+
+class BotApiRequest(HTTPXRequest):
+    """调优过的 HTTPX 请求对象：可配置的连接池与 keep-alive、HTTP/2、
+    按调用类型区分的读取超时，并统计连接池占用，便于按实际负载调整大小。
+
+    调用方显式传入的超时优先；未传入时按接口选择默认值。
+    """
+
+    def __init__(self, pool: str, pool_size: int, http2: bool) -> None:
+        super().__init__(
+            connection_pool_size=pool_size,
+            connect_timeout=API_CONNECT_TIMEOUT,
+            read_timeout=API_READ_TIMEOUT,
+            write_timeout=API_READ_TIMEOUT,
+            pool_timeout=API_POOL_TIMEOUT,
+            media_write_timeout=API_MEDIA_WRITE_TIMEOUT,
+            http_version="2" if http2 else "1.1",
+            httpx_kwargs={
+                "limits": httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                    keepalive_expiry=API_KEEPALIVE_SECONDS,
+                )
+            },
+        )
+        self.pool = pool
+        self.capacity = pool_size * (H2_STREAMS_PER_CONNECTION if http2 else 1)
+        self.in_flight = 0
+        self.peak = 0
+        HTTP_POOL_CAPACITY.set(self.capacity, pool)
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout: Any = BaseRequest.DEFAULT_NONE,
+        write_timeout: Any = BaseRequest.DEFAULT_NONE,
+        connect_timeout: Any = BaseRequest.DEFAULT_NONE,
+        pool_timeout: Any = BaseRequest.DEFAULT_NONE,
+    ) -> Tuple[int, bytes]:
+        if isinstance(read_timeout, type(BaseRequest.DEFAULT_NONE)):
+            if url.rsplit("/", 1)[-1] in _SLOW_ENDPOINTS:
+                read_timeout = API_SLOW_READ_TIMEOUT
+
+        if self.in_flight >= self.capacity:
+            HTTP_POOL_WAITS.inc(self.pool)
+        self.in_flight += 1
+        if self.in_flight > self.peak:
+            self.peak = self.in_flight
+            HTTP_IN_FLIGHT_PEAK.set(self.peak, self.pool)
+        HTTP_IN_FLIGHT.set(self.in_flight, self.pool)
+        try:
+            return await super().do_request(
+                url,
+                method,
+                request_data,
+                read_timeout,
+                write_timeout,
+                connect_timeout,
+                pool_timeout,
+            )
+        except TimedOut as exc:
+            if isinstance(exc.__cause__, httpx.PoolTimeout):
+                HTTP_POOL_TIMEOUTS.inc(self.pool)
+            raise
+        finally:
+            self.in_flight -= 1
+            HTTP_IN_FLIGHT.set(self.in_flight, self.pool)
+
+
+def build_api_requests(
+    pool_size: int = API_POOL_SIZE, updates_pool_size: int = API_UPDATES_POOL_SIZE
+) -> Tuple[BotApiRequest, BotApiRequest]:
+    """创建 (出站调用, getUpdates) 两个独立的连接池。"""
+    http2 = _http2_enabled()
+    return (
+        BotApiRequest("api", pool_size, http2),
+        BotApiRequest("updates", updates_pool_size, http2),
+    )
+
+
+# ---------- 用户锁：避免同一用户并发处理导致状态错乱 ----------
+class _LockSlot:
+    __slots__ = ("lock", "refs")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.refs = 0
+
+
+class _HeldLock:
+    """KeyedLocks.hold() 返回的异步上下文管理器。"""
+
+    __slots__ = ("_registry", "_key", "_slot")
+
+    def __init__(self, registry: "KeyedLocks", key: Hashable) -> None:
+        self._registry = registry
+        self._key = key
+        self._slot: Optional[_LockSlot] = None
+
+    async def __aenter__(self) -> None:
+        self._slot = await self._registry._acquire(self._key)
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        assert self._slot is not None
+        self._registry._release(self._key, self._slot)
+
+
+class KeyedLocks:
+    """按 key 分配的异步锁注册表。
+
+    默认模式下锁按需创建，并对持有者与等待者计数，计数归零时立即回收，
+    内存只与同时活跃的用户数有关；同一 key 的等待者按到达顺序获得锁
+    （asyncio.Lock 为 FIFO），保证同一用户的消息按序处理。
+    stripes > 0 时改用固定数量的锁（按 hash(key) 取模），内存恒定。
+    """
+
+    def __init__(self, stripes: int = 0) -> None:
+        self.stripes = stripes
+        self._slots: Dict[Hashable, _LockSlot] = {}
+        self._striped = [_LockSlot() for _ in range(stripes)]
+
+    def __len__(self) -> int:
+        return len(self._slots) if not self.stripes else self.stripes
+
+    def hold(self, key: Hashable) -> _HeldLock:
+        """用法：async with user_locks.hold(uid): ..."""
+        return _HeldLock(self, key)
+
+    async def _acquire(self, key: Hashable) -> _LockSlot:
+        started = perf_counter()
+        if self.stripes:
+            slot = self._striped[hash(key) % self.stripes]
+            await slot.lock.acquire()
+            USER_LOCK_WAIT.observe(perf_counter() - started)
+            return slot
+
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _LockSlot()
+        slot.refs += 1
+        try:
+            await slot.lock.acquire()
+        except BaseException:
+            self._unref(key, slot)
+            raise
+        USER_LOCK_WAIT.observe(perf_counter() - started)
+        return slot
+
+    def _release(self, key: Hashable, slot: _LockSlot) -> None:
+        slot.lock.release()
+        if not self.stripes:
+            self._unref(key, slot)
+
+    def _unref(self, key: Hashable, slot: _LockSlot) -> None:
+        slot.refs -= 1
+        if slot.refs == 0 and self._slots.get(key) is slot:
+            del self._slots[key]
+
+
+user_locks = KeyedLocks(USER_LOCK_STRIPES)
+
+
+# ---------- 并发去重 ----------
+class SingleFlight:
+    """同一 key 的并发调用只执行一次，其余调用方等待并共享同一结果（或异常）。
+
+    do() 返回 (result, shared)，shared 为 True 表示结果来自其他调用方的执行。
+    """
+
+    def __init__(self) -> None:
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.executed = 0
+        self.shared = 0
+
+    async def do(
+        self, key: Hashable, func: Callable[[], Awaitable[T]]
+    ) -> Tuple[T, bool]:
+        while True:
+            fut = self._inflight.get(key)
+            if fut is None:
+                break
+            try:
+                result = await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if fut.cancelled():
+                    # 执行方被取消：由当前调用方重新执行
+                    continue
+                raise
+            self.shared += 1
+            return result, True
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        self.executed += 1
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as exc:
+            fut.set_exception(exc)
+            fut.exception()  # 标记已读取，无人等待时不打印警告
+            raise
+        else:
+            fut.set_result(result)
+            return result, False
+        finally:
+            self._inflight.pop(key, None)
+
+
+# 话题创建与健康探测的并发去重（key 为 ("create", user_id) / ("probe", thread_id)）
+topic_flights = SingleFlight()
+
+
+# ---------- 定时过期 ----------
+class ExpiryWheel:
+    """哈希时间轮：为大量短期状态统一安排过期，代替每个条目一个 sleep 任务。
+
+    条目按 (命名空间, key) 登记，每个命名空间注册一个过期回调 on_expire(key)。
+    schedule / cancel 都是 O(1)（一次字典写入或删除），重复 schedule 同一 key
+    即重新计时。单个后台任务每个刻度推进一个槽，只检查该槽中的条目；超过一圈的
+    条目留在槽中，每圈检查一次。没有条目时后台任务自行退出。
+    """
+
+    def __init__(
+        self, tick: float = EXPIRY_TICK_SECONDS, slots: int = EXPIRY_WHEEL_SLOTS
+    ) -> None:
+        self.tick = tick
+        self._slots: List[Dict[Tuple[str, Hashable], float]] = [
+            {} for _ in range(slots)
+        ]
+        self._where: Dict[Tuple[str, Hashable], int] = {}
+        self._callbacks: Dict[str, Callable[[Hashable], Any]] = {}
+        self._origin = monotonic()
+        self._cursor = 0  # 下一个待处理的刻度序号
+        self._task: Optional[asyncio.Task] = None
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def register(self, namespace: str, on_expire: Callable[[Hashable], Any]) -> None:
+        self._callbacks[namespace] = on_expire
+
+    def schedule(self, namespace: str, key: Hashable, delay: float) -> None:
+        """delay 秒后对 key 调用该命名空间的回调；已登记的 key 重新计时。"""
+        entry = (namespace, key)
+        slot = self._where.pop(entry, None)
+        if slot is not None:
+            del self._slots[slot][entry]
+        deadline = monotonic() + delay
+        tick_no = max(self._cursor, math.ceil((deadline - self._origin) / self.tick))
+        slot = tick_no % len(self._slots)
+        self._slots[slot][entry] = deadline
+        self._where[entry] = slot
+        self._ensure_running()
+
+    def cancel(self, namespace: str, key: Hashable) -> bool:
+        slot = self._where.pop((namespace, key), None)
+        if slot is None:
+            return False
+        del self._slots[slot][(namespace, key)]
+        return True
+
+    def advance(self, now: Optional[float] = None) -> int:
+        """处理截至 now 的所有刻度，触发到期条目的回调，返回触发数。"""
+        now = monotonic() if now is None else now
+        target = math.floor((now - self._origin) / self.tick)
+        # 落后超过一圈时每个槽只需处理一次
+        self._cursor = max(self._cursor, target - len(self._slots) + 1)
+        fired = 0
+        while self._cursor <= target:
+            slot = self._slots[self._cursor % len(self._slots)]
+            self._cursor += 1
+            if not slot:
+                continue
+            due = [entry for entry, deadline in slot.items() if deadline <= now]
+            for entry in due:
+                del slot[entry]
+                del self._where[entry]
+                namespace, key = entry
+                try:
+                    self._callbacks[namespace](key)
+                except Exception as exc:
+                    logger.error("过期回调失败 (%s): %s", namespace, exc)
+            fired += len(due)
+        self.expired += fired
+        return fired
+
+    def _ensure_running(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 没有事件循环（脚本调用）：由调用方自行 advance()
+            return
+        self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._where:
+            # 睡到下一个待处理刻度的边界，条目最多比过期时间晚一个刻度被清理
+            next_tick = self._origin + self._cursor * self.tick
+            await asyncio.sleep(max(0.0, next_tick - monotonic()))
+            self.advance()
+
+    async def close(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+
+# 验证码答案等短期状态的过期
+expiry = ExpiryWheel()
+
+
+# ---------- 相册（媒体组）聚合 ----------
+class _PendingAlbum:
+    __slots__ = ("messages", "forward", "timer")
+
+    def __init__(self, forward: Callable[[List[Message]], Awaitable[None]]) -> None:
+        self.messages: List[Message] = []
+        self.forward = forward
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MediaGroupBuffer:
+    """把同一 media_group_id 的消息缓冲起来，收齐后一次性转发。
+
+    每收到一条相册消息就把截止时间推后 window 秒；到期后按 message_id 排序，
+    调用登记时传入的 forward(messages)。scope 为会话 key（与更新分发一致），
+    同一会话的后续消息应先 await flush_scope()，以保证相册不被后发消息超越。
+    """
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._pending: Dict[Hashable, Dict[str, _PendingAlbum]] = {}
+        self._running: Dict[Hashable, Set[asyncio.Task]] = {}
+        self.albums = 0
+        self.messages = 0
+
+    def add(
+        self,
+        scope: Hashable,
+        media_group_id: str,
+        message: Message,
+        forward: Callable[[List[Message]], Awaitable[None]],
+    ) -> None:
+        albums = self._pending.setdefault(scope, {})
+        album = albums.get(media_group_id)
+        if album is None:
+            album = albums[media_group_id] = _PendingAlbum(forward)
+        album.messages.append(message)
+        if album.timer is not None:
+            album.timer.cancel()
+        album.timer = asyncio.get_running_loop().call_later(
+            self.window, self._fire, scope, media_group_id
+        )
+
+    def _take(self, scope: Hashable, media_group_id: str) -> Optional[_PendingAlbum]:
+        albums = self._pending.get(scope)
+        if not albums:
+            return None
+        album = albums.pop(media_group_id, None)
+        if not albums:
+            del self._pending[scope]
+        if album is not None and album.timer is not None:
+            album.timer.cancel()
+        return album
+
+    def _fire(self, scope: Hashable, media_group_id: str) -> None:
+        album = self._take(scope, media_group_id)
+        if album is None:
+            return
+        task = asyncio.create_task(self._forward(album))
+        running = self._running.setdefault(scope, set())
+        running.add(task)
+        task.add_done_callback(lambda t: self._forget(scope, t))
+
+    def _forget(self, scope: Hashable, task: asyncio.Task) -> None:
+        running = self._running.get(scope)
+        if running is not None:
+            running.discard(task)
+            if not running:
+                del self._running[scope]
+
+    async def _forward(self, album: _PendingAlbum) -> None:
+        messages = sorted(album.messages, key=lambda m: m.message_id)
+        self.albums += 1
+        self.messages += len(messages)
+        try:
+            await album.forward(messages)
+        except Exception as exc:
+            logger.error("相册转发失败（%d 条）: %s", len(messages), exc)
+
+    async def flush_scope(self, scope: Hashable, keep: Optional[str] = None) -> None:
+        """立即转发该会话中除 keep 以外的待发相册，并等待正在转发的相册完成。"""
+        for media_group_id in list(self._pending.get(scope, ())):
+            if media_group_id != keep:
+                album = self._take(scope, media_group_id)
+                if album is not None:
+                    await self._forward(album)
+        running = self._running.get(scope)
+        if running:
+            await asyncio.wait(list(running))
+
+    async def close(self) -> None:
+        """停机前转发所有待发相册。"""
+        for scope in list(self._pending):
+            await self.flush_scope(scope)
+        for scope in list(self._running):
+            await self.flush_scope(scope)
+
+
+media_groups = MediaGroupBuffer(MEDIA_GROUP_WINDOW_SECONDS)
+
+
+# ---------- 私聊消息合并转发 ----------
+class _Outbox:
+    __slots__ = ("messages", "forward", "task")
+
+    def __init__(self) -> None:
+        self.messages: List[Message] = []
+        self.forward: Optional[Callable[[List[Message]], Awaitable[None]]] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+class ForwardCoalescer:
+    """每个用户一个发件队列，由单个后台任务按序批量转发。
+
+    处理器只负责入队并立即返回；队列的转发任务在首条消息入队（并等待 window 秒）
+    后启动，每次取出最多 max_batch 条调用 forward(messages)，转发期间新到达的
+    消息留在队列中，下一轮一并发出。同一用户始终只有一个转发任务，因此保持原始顺序。
+    """
+
+    def __init__(self, window: float, max_batch: int) -> None:
+        self.window = window
+        self.max_batch = max_batch
+        self._boxes: Dict[Hashable, _Outbox] = {}
+        self.batches = 0
+        self.messages = 0
+
+    def __len__(self) -> int:
+        return len(self._boxes)
+
+    def add(
+        self,
+        key: Hashable,
+        messages: List[Message],
+        forward: Callable[[List[Message]], Awaitable[None]],
+    ) -> None:
+        box = self._boxes.get(key)
+        if box is None:
+            box = self._boxes[key] = _Outbox()
+        box.messages.extend(messages)
+        box.forward = forward
+        if box.task is None:
+            box.task = asyncio.create_task(self._drain(key, box))
+
+    async def _drain(self, key: Hashable, box: _Outbox) -> None:
+        try:
+            if self.window > 0:
+                await asyncio.sleep(self.window)
+            while box.messages:
+                batch = box.messages[: self.max_batch]
+                del box.messages[: len(batch)]
+                self.batches += 1
+                self.messages += len(batch)
+                try:
+                    await box.forward(batch)
+                except Exception as exc:
+                    logger.error("合并转发失败（%d 条）: %s", len(batch), exc)
+        finally:
+            # 队列已空（或任务被取消），检查与删除之间没有 await，不会漏掉新消息
+            if self._boxes.get(key) is box:
+                del self._boxes[key]
+
+    async def close(self) -> None:
+        """停机前等待所有发件队列转发完毕。"""
+        tasks = [box.task for box in self._boxes.values() if box.task is not None]
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+forward_coalescer = ForwardCoalescer(
+    FORWARD_COALESCE_WINDOW_SECONDS, FORWARD_COALESCE_MAX_BATCH
+)
+
+
+# ---------- 编辑同步防抖 ----------
+class _PendingEdit:
+    __slots__ = ("message", "sync")
+
+    def __init__(
+        self, message: Message, sync: Callable[[Message], Awaitable[bool]]
+    ) -> None:
+        self.message = message
+        self.sync = sync
+
+
+class EditDebouncer:
+    """按源消息合并短时间内的连续编辑，只同步最后一次的内容。
+
+    某条消息第一次被编辑后等待 window 秒再调用 sync(message)；窗口内的后续编辑
+    只替换待发内容，被取代的编辑不再发出（计入 coalesced）。目标消息在发出时
+    才查找，此时原消息的转发通常已完成并记录了映射。同一条消息的同步串行执行，
+    较新的内容总是最后写入。sync 返回 True 表示确实发出了一次编辑（计入 sent）。
+    """
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._pending: Dict[Tuple[int, int], _PendingEdit] = {}
+        self._timers: Dict[Tuple[int, int], asyncio.TimerHandle] = {}
+        self._running: Dict[Tuple[int, int], asyncio.Task] = {}
+        self.sent = 0
+        self.coalesced = 0
+
+    def add(self, message: Message, sync: Callable[[Message], Awaitable[bool]]) -> None:
+        key = (message.chat_id, message.message_id)
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = _PendingEdit(message, sync)
+        if key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(
+                self.window, self._fire, key
+            )
+
+    def _fire(self, key: Tuple[int, int]) -> None:
+        self._timers.pop(key, None)
+        edit = self._pending.pop(key, None)
+        if edit is None:
+            return
+        task = asyncio.create_task(self._sync(edit, self._running.get(key)))
+        self._running[key] = task
+        task.add_done_callback(lambda t: self._forget(key, t))
+
+    def _forget(self, key: Tuple[int, int], task: asyncio.Task) -> None:
+        if self._running.get(key) is task:
+            del self._running[key]
+
+    async def _sync(self, edit: _PendingEdit, previous: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await asyncio.wait((previous,))
+        try:
+            if await edit.sync(edit.message):
+                self.sent += 1
+        except Exception as exc:
+            logger.warning("编辑同步失败: %s", exc)
+
+    async def close(self) -> None:
+        """停机前立即同步所有待发编辑，并等待正在进行的同步完成。"""
+        for key in list(self._timers):
+            self._timers[key].cancel()
+            self._fire(key)
+        if self._running:
+            await asyncio.wait(list(self._running.values()))
+
+
+edit_sync = EditDebouncer(EDIT_SYNC_WINDOW_SECONDS)
+
+
+# ---------- 更新分发：会话内有序、会话间并发 ----------
+def _update_order_key(update: object) -> Optional[Hashable]:
+    """返回更新所属的会话 key：私聊按用户，管理群按话题，其余按聊天。
+
+    无法归属会话的更新（如回调之外的系统更新）返回 None，不参与排序。
+    """
+    if not isinstance(update, Update):
+        return None
+    chat = update.effective_chat
+    if chat is None:
+        return None
+    if chat.type == "private":
+        return ("user", chat.id)
+    message = update.effective_message
+    if chat.id == GROUP_ID and message is not None and message.message_thread_id:
+        return ("thread", message.message_thread_id)
+    return ("chat", chat.id)
+
+
+class IngressGuard:
+    """私聊更新的准入检查，在排队与加用户锁之前拦下刷屏流量。
+
+    每次检查只做字典查找与令牌桶计算：
+    - 被封禁用户的更新静默丢弃，每 notice_interval 秒放行一条消息以回复提示；
+    - 未验证用户按 captcha_rate 限制尝试次数（答题、/start 都算一次）；
+    - 已验证用户按 rate / burst 限制消息速率（默认关闭），开始超限时回复一次提示。
+    同一相册的各条消息只计一次（首条被拒则整组拒绝），编辑不计数。
+    封禁状态取自内存中的会话（未加载时由 get_session 从存储后端按需加载，
+    之后的检查都是内存命中）。rate 为 0 的那一类不做限制。
+    """
+
+    MAX_IDLE_BUCKETS = 10000  # 超过后创建新桶时顺带清理已回满的空闲桶
+    FLOOD_NOTICE = "⚠️ 你发送消息过快，部分消息未能转达，请稍后重新发送。"
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        captcha_rate: float,
+        captcha_burst: int,
+        notice_interval: float,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.captcha_rate = captcha_rate
+        self.captcha_burst = captcha_burst
+        self.notice_interval = notice_interval
+        self._buckets: Dict[int, _TokenBucket] = {}
+        self._captcha: Dict[int, _TokenBucket] = {}
+        self._notices: Dict[int, float] = {}  # 被封禁用户 -> 下次可提示的时间
+        # 用户 -> (最近一个计数的相册, 是否放行)
+        self._albums: Dict[int, Tuple[str, bool]] = {}
+        self._throttled: Set[int] = set()  # 已收到超限提示、尚未恢复的用户
+        self._replies: Set[asyncio.Task] = set()
+
+    def admit(self, update: object) -> bool:
+        """返回 False 表示拦下该更新（已计入 INGRESS_DROPPED）。"""
+        if not isinstance(update, Update):
+            return True
+        chat = update.effective_chat
+        user = update.effective_user
+        if chat is None or chat.type != "private" or user is None:
+            return True
+
+        uid = user.id
+        session = get_session(uid)
+        now = monotonic()
+        if session.banned:
+            if self._notice_due(uid, update, now):
+                return True
+            INGRESS_DROPPED.inc("banned")
+            return False
+        if update.message is None:
+            # 编辑等非新消息不计数
+            return True
+        if not session.verified and (USE_MATH_CAPTCHA or USE_FIXED_CAPTCHA):
+            if self._charge(
+                self._captcha, uid, self.captcha_rate, self.captcha_burst, update, now
+            ):
+                return True
+            INGRESS_DROPPED.inc("captcha")
+            return False
+        if self._charge(self._buckets, uid, self.rate, self.burst, update, now):
+            self._throttled.discard(uid)
+            return True
+        INGRESS_DROPPED.inc("flood")
+        if uid not in self._throttled:
+            self._throttled.add(uid)
+            self._reply(update, uid, self.FLOOD_NOTICE)
+        return False
+
+    def _notice_due(self, uid: int, update: Update, now: float) -> bool:
+        # 只有普通消息会得到回复；命令与编辑一律丢弃
+        message = update.message
+        if not self.notice_interval or message is None:
+            return False
+        if message.text and message.text.startswith("/"):
+            return False
+        if now < self._notices.get(uid, 0.0):
+            return False
+        if len(self._notices) >= self.MAX_IDLE_BUCKETS:
+            for key in [k for k, t in self._notices.items() if t <= now]:
+                del self._notices[key]
+        self._notices[uid] = now + self.notice_interval
+        return True
+
+    def _charge(
+        self,
+        buckets: Dict[int, _TokenBucket],
+        uid: int,
+        rate: float,
+        burst: int,
+        update: Update,
+        now: float,
+    ) -> bool:
+        if not rate:
+            return True
+        media_group_id = update.message.media_group_id
+        if media_group_id is not None:
+            last = self._albums.get(uid)
+            if last is not None and last[0] == media_group_id:
+                return last[1]
+        bucket = buckets.get(uid)
+        if bucket is None:
+            if len(buckets) >= self.MAX_IDLE_BUCKETS:
+                for key in [k for k, b in buckets.items() if b.idle(now)]:
+                    del buckets[key]
+                    self._albums.pop(key, None)
+                    self._throttled.discard(key)
+            bucket = buckets[uid] = _TokenBucket(rate, burst)
+        admitted = bucket.wait_time(now) <= 0
+        if admitted:
+            bucket.take(now)
+        if media_group_id is not None:
+            self._albums[uid] = (media_group_id, admitted)
+        return admitted
+
+    def _reply(self, update: Update, uid: int, text: str) -> None:
+        """后台发送提示，不阻塞准入检查。"""
+        task = asyncio.create_task(
+            update.get_bot().send_message(
+                chat_id=uid, text=text, rate_limit_args={"priority": PRIORITY_SYSTEM}
+            )
+        )
+        self._replies.add(task)
+        task.add_done_callback(self._reply_done)
+
+    def _reply_done(self, task: asyncio.Task) -> None:
+        self._replies.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("发送超限提示失败: %s", task.exception())
+
+
+ingress = IngressGuard(
+    INGRESS_RATE,
+    INGRESS_BURST,
+    CAPTCHA_ATTEMPTS_PER_MINUTE / 60,
+    CAPTCHA_ATTEMPT_BURST,
+    BANNED_NOTICE_SECONDS,
+)
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """按会话分片的更新处理器。
+
+    每个会话 key 维护一条隐式 FIFO 队列（链式 Future：新更新等待同 key 的前一条
+    处理完成），队首更新再竞争 workers 个工作槽执行。排队中的更新不占用工作槽，
+    因此某个会话的慢请求只阻塞该会话本身。max_pending 为 PTB 层面的在途上限。
+    传入 guard 时，未通过准入检查的更新在排队之前即被丢弃。
+    """
+
+    def __init__(
+        self, workers: int, max_pending: int, guard: Optional[IngressGuard] = None
+    ) -> None:
+        super().__init__(max(max_pending, workers, 2))
+        self.workers = max(1, workers)
+        self.guard = guard
+        self._slots = asyncio.Semaphore(self.workers)
+        self._tails: Dict[Hashable, asyncio.Future] = {}
+        self.processed = 0
+        self.waited = 0
+
+    @property
+    def queued_keys(self) -> int:
+        """当前有更新在排队或处理中的会话数。"""
+        return len(self._tails)
+
+    async def do_process_update(
+        self, update: object, coroutine: Awaitable[Any]
+    ) -> None:
+        if self.guard is not None and not self.guard.admit(update):
+            if isinstance(coroutine, Coroutine):
+                coroutine.close()
+            return
+        key = _update_order_key(update)
+        arrived = perf_counter()
+        if key is None:
+            async with self._slots:
+                await self._run(coroutine, arrived)
+            return
+
+        previous = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        try:
+            if previous is not None:
+                self.waited += 1
+                # 前一条被取消或出错都不影响后续更新
+                await asyncio.wait((previous,))
+            async with self._slots:
+                await self._run(coroutine, arrived)
+        finally:
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+            if isinstance(coroutine, Coroutine):
+                # 排队期间被取消时协程尚未启动，关闭它以免 "never awaited" 警告
+                coroutine.close()
+
+    async def _run(self, coroutine: Awaitable[Any], arrived: float) -> None:
+        started = perf_counter()
+        UPDATE_WAIT.observe(started - arrived)
+        try:
+            await coroutine
+        finally:
+            UPDATE_LATENCY.observe(perf_counter() - started)
+            self.processed += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 
 # ---------- 辅助函数 ----------
-async def _create_topic_for_user(bot: Any, user_id: int, title: str) -> int:
+async def _create_topic_for_user(
+    bot: Any, user_id: int, title: str, priority: int = PRIORITY_SYSTEM
+) -> int:
     safe_title = title[:40]
-    resp = await bot.create_forum_topic(chat_id=GROUP_ID, name=safe_title)
+    resp = await bot.create_forum_topic(
+        chat_id=GROUP_ID,
+        name=safe_title,
+        rate_limit_args={"priority": priority},
+    )
 
     thread_id = getattr(resp, "message_thread_id", None)
     if thread_id is None and isinstance(resp, dict):
@@ -185,6 +3233,180 @@ async def _create_topic_for_user(bot: Any, user_id: int, title: str) -> int:
     return int(thread_id)
 
 
+class TopicPool:
+    """预建话题池：后台保持 target 个已创建的空闲话题。
+
+    新用户首次发消息时取出一个并用 edit_forum_topic 改成该用户的标题，
+    省去创建话题的等待（随后发出的名片即可用性验证）；取用后唤醒补充任务。
+    补充请求使用最低优先级，不与用户消息争抢出站配额。池中话题保存在存储后端，重启后继续使用；
+    SQLite 后端的取用是原子的，多副本共享同一个池。补充由持有租约（storage.claim）
+    的一个副本负责，其余副本只取用，避免各自补齐导致话题数成倍增加。
+    """
+
+    LEASE_KEY = "topic_pool:refill"
+
+    def __init__(self, target: int) -> None:
+        self.target = target
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._owner = REPLICA_SELF or "local"
+
+    def start(self, bot: Any) -> None:
+        if self.target > 0 and self._task is None:
+            self._task = asyncio.create_task(self._refill(bot))
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await _in_writer(storage.release, self.LEASE_KEY, self._owner)
+
+    async def take(self) -> Optional[int]:
+        if self.target <= 0:
+            return None
+        thread_id = await _in_writer(storage.take_pooled_topic)
+        if thread_id is not None:
+            TOPIC_POOL_DEPTH.dec()
+        self._wakeup.set()
+        return thread_id
+
+    async def give_back(self, thread_id: int) -> None:
+        """把取出后未使用（仍为空闲标题）的话题放回池中。"""
+        await _in_writer(storage.add_pooled_topic, thread_id)
+        TOPIC_POOL_DEPTH.inc()
+
+    async def _provision(self, bot: Any) -> None:
+        thread_id = await _create_topic_for_user(
+            bot, 0, TOPIC_POOL_TITLE, priority=PRIORITY_PROBE
+        )
+        await _in_writer(storage.add_pooled_topic, thread_id)
+
+    async def _idle(self) -> None:
+        """等待本进程取用话题，或到下一个检查周期（其他副本的取用不会唤醒本进程）。"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), TOPIC_POOL_RETRY_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _refill(self, bot: Any) -> None:
+        while True:
+            try:
+                # 先清除唤醒标记再读深度：读取期间发生的取用会重新置位，不会漏掉
+                self._wakeup.clear()
+                if not await _in_writer(
+                    storage.claim,
+                    self.LEASE_KEY,
+                    self._owner,
+                    TOPIC_POOL_LEASE_SECONDS,
+                ):
+                    await asyncio.sleep(TOPIC_POOL_RETRY_SECONDS)
+                    continue
+                # 每轮重新读取池深度：多副本时其他进程也会取用
+                depth = len(await _in_writer(storage.pooled_topics))
+                TOPIC_POOL_DEPTH.set(depth)
+                if depth >= self.target:
+                    await self._idle()
+                    continue
+                # 缺口并发补充，速率由出站调度器控制
+                results = await asyncio.gather(
+                    *(self._provision(bot) for _ in range(self.target - depth)),
+                    return_exceptions=True,
+                )
+            except Exception as exc:
+                results = [exc]
+            errors = [r for r in results if isinstance(r, Exception)]
+            TOPIC_POOL_REFILLS.inc("ok", amount=len(results) - len(errors))
+            if errors:
+                TOPIC_POOL_REFILLS.inc("error", amount=len(errors))
+                logger.warning(
+                    "预建话题失败 %d 个，%d 秒后重试: %s",
+                    len(errors),
+                    TOPIC_POOL_RETRY_SECONDS,
+                    errors[0],
+                )
+                await asyncio.sleep(TOPIC_POOL_RETRY_SECONDS)
+
+
+async def _discard_topic(bot: Any, thread_id: int) -> None:
+    """尽力删除无法交付给用户的话题，避免在管理群中留下孤立话题。"""
+    try:
+        await bot.delete_forum_topic(
+            chat_id=GROUP_ID,
+            message_thread_id=thread_id,
+            rate_limit_args={"priority": PRIORITY_PROBE},
+        )
+    except Exception as exc:
+        if not _is_thread_missing_error(exc):
+            logger.warning("删除无法使用的话题 %s 失败: %s", thread_id, exc)
+
+
+topic_pool = TopicPool(TOPIC_POOL_SIZE)
+
+
+async def _assign_pooled_topic(
+    context: ContextTypes.DEFAULT_TYPE, user: Any, display: str
+) -> Optional[int]:
+    """从预建话题池取一个话题，改名后发送名片；池为空或全部失效时返回 None。"""
+    while True:
+        thread_id = await topic_pool.take()
+        if thread_id is None:
+            TOPIC_POOL_TAKES.inc("empty")
+            return None
+        try:
+            await context.bot.edit_forum_topic(
+                chat_id=GROUP_ID,
+                message_thread_id=thread_id,
+                name=f"user_{user.id}_{display}"[:40],
+                rate_limit_args={"priority": PRIORITY_SYSTEM},
+            )
+        except Exception as exc:
+            if _is_thread_missing_error(exc):
+                # 空闲期间被管理员删除：丢弃该话题，继续取下一个
+                TOPIC_POOL_TAKES.inc("stale")
+                logger.warning("预建话题 %s 已不存在，已丢弃: %s", thread_id, exc)
+                continue
+            # 限流等与话题无关的失败：话题仍是空闲标题，放回池中，本次改为现建话题
+            await topic_pool.give_back(thread_id)
+            logger.warning("预建话题 %s 改名失败，已放回池中: %s", thread_id, exc)
+            return None
+        # 已改成该用户的标题，失败时不能再放回池中：删除，避免遗留孤立话题
+        try:
+            await _bootstrap_with_retries(context, user, thread_id)
+        except TopicUnavailableError as exc:
+            TOPIC_POOL_TAKES.inc("stale")
+            logger.warning("预建话题 %s 不可用，已删除: %s", thread_id, exc)
+            await _discard_topic(context.bot, thread_id)
+            continue
+        except Exception as exc:
+            TOPIC_POOL_TAKES.inc("error")
+            logger.error("预建话题 %s 的名片多次发送失败，已删除: %s", thread_id, exc)
+            await _discard_topic(context.bot, thread_id)
+            raise
+        TOPIC_POOL_TAKES.inc("hit")
+        return thread_id
+
+
+# 表示话题已不存在的错误描述片段
+_THREAD_MISSING_PHRASES = (
+    "thread not found",
+    "topic not found",
+    "message thread not found",
+    "topic deleted",
+    "thread deleted",
+    "forum topic not found",
+    "topic closed permanently",
+)
+
+
+def _is_thread_missing_error(exc: Exception) -> bool:
+    error_desc = str(exc).lower()
+    return any(phrase in error_desc for phrase in _THREAD_MISSING_PHRASES)
+
+
 async def _probe_forum_thread(
     bot: Any,
     expected_thread_id: int,
@@ -200,6 +3422,7 @@ async def _probe_forum_thread(
             message_thread_id=expected_thread_id,
             text="🔍",
             disable_notification=True,
+            rate_limit_args={"priority": PRIORITY_PROBE},
         )
 
         actual_thread_id = getattr(result, "message_thread_id", None)
@@ -207,7 +3430,11 @@ async def _probe_forum_thread(
 
         if probe_message_id:
             try:
-                await bot.delete_message(chat_id=GROUP_ID, message_id=probe_message_id)
+                await bot.delete_message(
+                    chat_id=GROUP_ID,
+                    message_id=probe_message_id,
+                    rate_limit_args={"priority": PRIORITY_PROBE},
+                )
             except Exception:
                 pass
 
@@ -222,18 +3449,7 @@ async def _probe_forum_thread(
     except Exception as exc:
         error_desc = str(exc).lower()
 
-        if any(
-            phrase in error_desc
-            for phrase in (
-                "thread not found",
-                "topic not found",
-                "message thread not found",
-                "topic deleted",
-                "thread deleted",
-                "forum topic not found",
-                "topic closed permanently",
-            )
-        ):
+        if _is_thread_missing_error(exc):
             return {"status": "missing", "description": str(exc)}
 
         if any(
@@ -255,21 +3471,21 @@ async def _verify_topic_health(
     reason: str = "health_check",
 ) -> bool:
     """验证话题健康状态，带缓存机制。"""
-    now = time()
     cached = thread_health_cache.get(thread_id)
+    if cached is not None:
+        return cached
 
-    if cached and now - cached.get("timestamp", 0) < THREAD_HEALTH_CACHE_SECONDS:
-        return bool(cached.get("healthy"))
+    # 同一话题的并发健康检查共享一次探测
+    probe_result, _ = await topic_flights.do(
+        ("probe", thread_id),
+        lambda: _probe_forum_thread(bot, thread_id, user_id, reason),
+    )
+    return _record_thread_health(thread_id, probe_result)
 
-    probe_result = await _probe_forum_thread(bot, thread_id, user_id, reason)
-    is_healthy = probe_result.get("status") == "ok"
 
-    thread_health_cache[thread_id] = {
-        "healthy": is_healthy,
-        "timestamp": now,
-        "probe_result": probe_result,
-    }
-    return is_healthy
+def _record_thread_health(thread_id: int, probe_result: Dict[str, Any]) -> bool:
+    """记录一次探测或实际发送得到的话题健康信号，返回是否健康。"""
+    return thread_health_cache.record(thread_id, probe_result)
 
 
 def _cleanup_dead_thread(session: UserSession) -> None:
@@ -278,22 +3494,30 @@ def _cleanup_dead_thread(session: UserSession) -> None:
         return
 
     old_tid = session.thread_id
-    print(f"⚠️ 用户 {session.user_id} 的话题 {old_tid} 已失效，正在清理...")
+    logger.warning("用户 %s 的话题 %s 已失效，正在清理", session.user_id, old_tid)
 
     thread_to_user.pop(old_tid, None)
-    thread_health_cache.pop(old_tid, None)
+    thread_health_cache.invalidate(old_tid)
     session.thread_id = None
 
 
 async def _ensure_thread_for_user(
     context: ContextTypes.DEFAULT_TYPE,
-    user_id: int,
+    user: Any,
     display: str,
 ) -> Tuple[int, bool]:
-    """确保用户拥有一个有效的话题。返回 (thread_id, is_new_topic)。"""
+    """确保用户拥有一个有效的话题。返回 (thread_id, is_new_topic)。
+
+    新话题中已发送过用户名片（名片兼作话题可用性验证）。
+    """
+    user_id = user.id
     session = get_session(user_id)
 
     if session.thread_id is not None:
+        # 乐观模式不预先探测，由实际转发的结果判断话题是否可用
+        if TOPIC_HEALTH_MODE == "optimistic":
+            return session.thread_id, False
+
         is_healthy = await _verify_topic_health(
             context.bot,
             session.thread_id,
@@ -305,67 +3529,188 @@ async def _ensure_thread_for_user(
 
         _cleanup_dead_thread(session)
 
+    create = _create_thread_claimed if REPLICA_ROLE else _create_thread_for_user
+    thread_id, shared = await topic_flights.do(
+        ("create", user_id),
+        lambda: create(context, user, display),
+    )
+    # 并发调用方共享同一次创建，只有实际执行创建的一方视为新话题
+    return thread_id, not shared
+
+
+class TopicUnavailableError(Exception):
+    """话题本身不可用：已被删除，或消息未落在该话题（被重定向 / 没有话题 ID）。"""
+
+
+async def _bootstrap_topic(
+    context: ContextTypes.DEFAULT_TYPE, user: Any, thread_id: int
+) -> None:
+    """在新话题中发送用户名片，并以发送结果验证话题：名片落在该话题即视为可用。
+
+    话题不可用时记入健康缓存并抛出 TopicUnavailableError；
+    限流、格式错误等与话题无关的失败原样抛出，话题仍可使用。
+    """
+    try:
+        card = await _send_welcome_card(context, user, thread_id)
+    except Exception as exc:
+        if not _is_thread_missing_error(exc):
+            raise
+        _record_thread_health(thread_id, {"status": "missing", "description": str(exc)})
+        raise TopicUnavailableError(str(exc)) from exc
+
+    actual_thread_id = getattr(card, "message_thread_id", None)
+    if actual_thread_id is None:
+        result: Dict[str, Any] = {"status": "missing_thread_id"}
+    elif int(actual_thread_id) != int(thread_id):
+        result = {"status": "redirected", "actual_thread_id": actual_thread_id}
+    else:
+        result = {"status": "ok"}
+    if not _record_thread_health(thread_id, result):
+        raise TopicUnavailableError(
+            f"Topic test failed: expected {thread_id}, got {actual_thread_id}"
+        )
+
+
+async def _bootstrap_with_retries(
+    context: ContextTypes.DEFAULT_TYPE, user: Any, thread_id: int
+) -> None:
+    """发送名片；与话题无关的失败保留话题，按 TOPIC_CREATE_RETRIES 重试名片。
+
+    话题不可用时立即抛出 TopicUnavailableError，重试用尽时抛出最后一次的异常。
+    """
     for attempt in range(TOPIC_CREATE_RETRIES):
         try:
-            thread_id = await _create_topic_for_user(
-                context.bot,
-                user_id,
-                f"user_{user_id}_{display}",
+            await _bootstrap_topic(context, user, thread_id)
+            return
+        except TopicUnavailableError:
+            raise
+        except Exception as exc:
+            logger.warning(
+                "话题 %s 的名片发送失败 (尝试 %d/%d): %s",
+                thread_id,
+                attempt + 1,
+                TOPIC_CREATE_RETRIES,
+                exc,
             )
+            if attempt == TOPIC_CREATE_RETRIES - 1:
+                raise
+            await asyncio.sleep(1)
 
-            await asyncio.sleep(0.5)
 
-            # 立即测试新创建的话题是否可用
-            try:
-                test_msg = await context.bot.send_message(
-                    chat_id=GROUP_ID,
-                    message_thread_id=thread_id,
-                    text="🔍 Test message to verify topic availability",
-                    disable_notification=True,
-                )
+async def _create_thread_for_user(
+    context: ContextTypes.DEFAULT_TYPE,
+    user: Any,
+    display: str,
+) -> int:
+    """为用户分配预建话题，池为空时创建新话题，发送名片并写入映射。
 
-                actual_thread_id = getattr(test_msg, "message_thread_id", None)
-                if actual_thread_id is None or int(actual_thread_id) != int(thread_id):
-                    raise Exception(
-                        f"Topic test failed: expected {thread_id}, got {actual_thread_id}"
-                    )
+    新话题不再单独发送测试消息，名片本身即可用性验证；
+    失败时按 TOPIC_CREATE_RETRIES 重试。
+    """
+    user_id = user.id
+    session = get_session(user_id)
 
-                await context.bot.delete_message(
-                    chat_id=GROUP_ID,
-                    message_id=test_msg.message_id,
-                )
-                print(f"✅ 话题 {thread_id} 创建并验证成功")
+    thread_id = await _assign_pooled_topic(context, user, display)
+    if thread_id is not None:
+        logger.info("用户 %s 分配到预建话题 %s", user_id, thread_id)
+    else:
+        thread_id = await _create_bootstrapped_topic(context, user, display)
 
-            except Exception as exc:
-                print(
-                    f"❌ 新创建的话题 {thread_id} 无法使用 "
-                    f"(尝试 {attempt + 1}/{TOPIC_CREATE_RETRIES}): {exc}"
-                )
-                if attempt < TOPIC_CREATE_RETRIES - 1:
-                    await asyncio.sleep(1)
-                    continue
-                raise
+    session.thread_id = thread_id
+    thread_to_user[thread_id] = user_id
+    persist_mapping(user_id)
+    return thread_id
 
-            session.thread_id = thread_id
-            thread_to_user[thread_id] = user_id
-            persist_mapping()
 
-            thread_health_cache[thread_id] = {
-                "healthy": True,
-                "timestamp": time(),
-                "probe_result": {"status": "ok"},
-            }
-            return thread_id, True
+async def _create_bootstrapped_topic(
+    context: ContextTypes.DEFAULT_TYPE, user: Any, display: str
+) -> int:
+    """创建新话题并发送名片（兼作验证），返回话题 ID。
+
+    只有话题本身不可用时才删除它并重新创建；名片因其他原因发送失败时
+    保留话题重试名片，最终仍失败则删除话题，不在管理群遗留孤立话题。
+    """
+    for attempt in range(TOPIC_CREATE_RETRIES):
+        try:
+            thread_id = await _create_topic_for_user(
+                context.bot,
+                user.id,
+                f"user_{user.id}_{display}",
+            )
+        except Exception as exc:
+            if attempt == TOPIC_CREATE_RETRIES - 1:
+                logger.error("创建话题失败，已达到最大重试次数: %s", exc)
+                raise
+            continue
 
-        except Exception as exc:
+        try:
+            await _bootstrap_with_retries(context, user, thread_id)
+        except TopicUnavailableError as exc:
+            logger.warning(
+                "新创建的话题 %s 无法使用 (尝试 %d/%d): %s",
+                thread_id,
+                attempt + 1,
+                TOPIC_CREATE_RETRIES,
+                exc,
+            )
+            await _discard_topic(context.bot, thread_id)
             if attempt == TOPIC_CREATE_RETRIES - 1:
-                print(f"❌ 创建话题失败，已达到最大重试次数: {exc}")
+                logger.error("创建话题失败，已达到最大重试次数: %s", exc)
                 raise
+            await asyncio.sleep(1)
+            continue
+        except Exception as exc:
+            logger.error("话题 %s 的名片多次发送失败，已删除话题: %s", thread_id, exc)
+            await _discard_topic(context.bot, thread_id)
+            raise
+
+        logger.info("话题 %s 创建并验证成功", thread_id)
+        return thread_id
 
     # 理论上不会走到这里（上面要么 return 要么 raise）
     raise RuntimeError("创建话题失败：未知原因")
 
 
+async def _create_thread_claimed(
+    context: ContextTypes.DEFAULT_TYPE,
+    user: Any,
+    display: str,
+) -> int:
+    """多副本模式：在共享库中认领后再创建话题。
+
+    正常情况下一个用户只由一个 worker 处理；节点列表变更的过渡期内两个副本
+    可能同时收到同一用户的消息，认领保证只有一方创建，另一方等待后沿用其结果。
+    """
+    user_id = user.id
+    key = f"topic:{user_id}"
+    before: Optional[SessionRow] = None
+    contended = False
+    while not await asyncio.to_thread(
+        storage.claim, key, REPLICA_SELF, TOPIC_CLAIM_SECONDS
+    ):
+        if not contended:
+            contended = True
+            before = await asyncio.to_thread(storage.load_one, user_id)
+        await asyncio.sleep(0.5)
+    try:
+        if contended:
+            # 等待期间持有认领的一方写入了新话题，直接沿用
+            row = await asyncio.to_thread(storage.load_one, user_id)
+            old_tid = before[0] if before else None
+            if row is not None and row[0] is not None and row[0] != old_tid:
+                session = get_session(user_id)
+                session.thread_id = row[0]
+                thread_to_user[row[0]] = user_id
+                logger.info("用户 %s 的话题已由其他副本创建: %s", user_id, row[0])
+                return row[0]
+        thread_id = await _create_thread_for_user(context, user, display)
+        # 释放认领前落盘，让其他副本和 router 立即可见
+        await persister.flush()
+        return thread_id
+    finally:
+        await asyncio.to_thread(storage.release, key, REPLICA_SELF)
+
+
 def _display_name_from_update(update: Update) -> str:
     user = update.effective_user
     if not user:
@@ -401,12 +3746,13 @@ def _generate_math_question() -> Tuple[str, int]:
     return f"{dividend} ÷ {divisor} = ?", quotient
 
 
-async def _expire_math_answer(
-    uid: int, delay: int = MATH_CAPTCHA_EXPIRE_SECONDS
-) -> None:
-    """异步延迟清理数学验证码，delay为延迟时间（秒）。"""
-    await asyncio.sleep(delay)
-    math_answers.pop(uid, None)
+def _set_math_answer(uid: int, answer: int) -> None:
+    """记录（或更换）用户的验证码答案，并从此刻起重新计算过期时间。"""
+    math_answers[uid] = answer
+    expiry.schedule("math_answer", uid, MATH_CAPTCHA_EXPIRE_SECONDS)
+
+
+expiry.register("math_answer", lambda uid: math_answers.pop(uid, None))
 
 
 # ---------- 命令处理器 ----------
@@ -441,9 +3787,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     if USE_MATH_CAPTCHA:
         question, answer = _generate_math_question()
-        math_answers[uid] = answer
+        _set_math_answer(uid, answer)
         await update.message.reply_text(f"请回答数学题完成验证：\n{question}")
-        asyncio.create_task(_expire_math_answer(uid))
         return
 
     if USE_FIXED_CAPTCHA:
@@ -453,7 +3798,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # 两者都未启用：自动验证通过
     session.verified = True
     session.verify_time = time()
-    persist_mapping()
+    persist_mapping(uid)
     await update.message.reply_text("你可以直接发送消息，我会帮你转达。")
 
 
@@ -466,7 +3811,7 @@ def _resolve_target_uid(
 
     thread_id = getattr(update.effective_message, "message_thread_id", None)
     if thread_id:
-        return thread_to_user.get(int(thread_id))
+        return user_for_thread(int(thread_id))
 
     return None
 
@@ -486,7 +3831,7 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     session.banned = True
-    persist_mapping()
+    persist_mapping(target_uid)
     await update.message.reply_text(f"🚫 用户 {target_uid} 已被封禁。")
 
 
@@ -505,11 +3850,270 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
 
     session.banned = False
-    persist_mapping()
+    persist_mapping(target_uid)
     await update.message.reply_text(f"✅ 用户 {target_uid} 已解封。")
 
 
 # ---------- 消息处理器 (核心功能) ----------
+async def _send_welcome_card(
+    context: ContextTypes.DEFAULT_TYPE, user: Any, thread_id: int
+) -> Message:
+    """在新话题中发送用户信息卡，返回发出的消息（失败时抛出异常）。"""
+    uid = user.id
+    logger.debug("Sending welcome card for user %s in thread %s", uid, thread_id)
+    safe_name = html.escape(user.full_name or "无名氏")
+    username_text = f"@{user.username}" if user.username else "未设置"
+    mention_link = mention_html(uid, safe_name)
+
+    info_text = (
+        "<b>新用户接入</b>\n"
+        f"ID: <code>{uid}</code>\n"
+        f"名字: {mention_link}\n"
+        f"用户名: {username_text}\n"
+        f"#id{uid}"
+    )
+    return await context.bot.send_message(
+        chat_id=GROUP_ID,
+        message_thread_id=thread_id,
+        text=info_text,
+        parse_mode=ParseMode.HTML,
+        rate_limit_args={"priority": PRIORITY_SYSTEM},
+    )
+
+
+def _map_copied(
+    src_chat_id: int, src_ids: List[int], dst_chat_id: int, dst_ids: List[int]
+) -> None:
+    """记录批量复制的消息映射。
+
+    copy_messages 会跳过无法复制的消息，此时返回的 ID 无法与源消息逐一对应，只能放弃映射。
+    """
+    if len(src_ids) != len(dst_ids):
+        logger.warning(
+            "批量复制 %d 条只成功 %d 条，跳过这批的编辑同步映射",
+            len(src_ids),
+            len(dst_ids),
+        )
+        return
+    for src_msg_id, dst_msg_id in zip(src_ids, dst_ids):
+        message_map.put(src_chat_id, src_msg_id, dst_chat_id, dst_msg_id)
+
+
+async def _copy_to_topic(
+    bot: Any, thread_id: int, user_id: int, message_ids: List[int]
+) -> Tuple[List[int], Optional[int]]:
+    """把用户的消息复制到话题，返回 (新消息 ID 列表, 实际所在话题 ID 或 None)。
+
+    多条消息（相册或合并转发的消息）使用一次 copy_messages，相册在对端仍保持为相册。
+    """
+    if len(message_ids) == 1:
+        sent_msg = await bot.copy_message(
+            chat_id=GROUP_ID,
+            message_thread_id=thread_id,
+            from_chat_id=user_id,
+            message_id=message_ids[0],
+        )
+        return [sent_msg.message_id], getattr(sent_msg, "message_thread_id", None)
+
+    sent = await bot.copy_messages(
+        chat_id=GROUP_ID,
+        message_thread_id=thread_id,
+        from_chat_id=user_id,
+        message_ids=message_ids,
+    )
+    return [m.message_id for m in sent], None
+
+
+async def _forward_to_topic(
+    context: ContextTypes.DEFAULT_TYPE,
+    user: Any,
+    display: str,
+    msg: Message,
+    message_ids: List[int],
+    debug_info: str,
+) -> None:
+    """确保话题可用并把用户消息转发过去，记录消息映射。
+
+    需在持有用户锁时调用（开启合并转发时由该用户的发件队列任务调用）。
+
+    msg 用于向用户回复错误提示；message_ids 为要转发的消息（单条或整个相册）。
+    """
+    uid = user.id
+    session = get_session(uid)
+
+    # 2. 确保话题存在且有效
+    try:
+        thread_id, is_new_topic = await _ensure_thread_for_user(context, user, display)
+        logger.debug(
+            "Got thread_id %s for %s, is_new_topic: %s",
+            thread_id,
+            debug_info,
+            is_new_topic,
+        )
+    except Exception as exc:
+        logger.error("Failed to ensure thread for %s: %s", debug_info, exc)
+        await msg.reply_text(f"系统错误：{exc}")
+        return
+
+    # 3. 转发用户消息（新话题的名片已在创建时发出）
+    logger.debug("About to forward message from %s to thread %s", debug_info, thread_id)
+
+    try:
+        try:
+            sent_ids, actual_thread_id = await _copy_to_topic(
+                context.bot, thread_id, uid, message_ids
+            )
+        except Exception as exc:
+            # 乐观模式：只有实际转发确认话题不存在时，才重建话题并重发
+            if TOPIC_HEALTH_MODE != "optimistic" or not _is_thread_missing_error(exc):
+                raise
+
+            _cleanup_dead_thread(session)
+            persist_mapping(uid)
+
+            thread_id, _ = await _ensure_thread_for_user(context, user, display)
+
+            logger.debug("Re-forwarding message to new thread %s", thread_id)
+            sent_ids, actual_thread_id = await _copy_to_topic(
+                context.bot, thread_id, uid, message_ids
+            )
+
+        logger.debug(
+            "Expected thread_id: %s, actual thread_id: %s", thread_id, actual_thread_id
+        )
+
+        # 关键逻辑：复制成功即认为发送成功；仅当 actual_thread_id 明确且不同才重建
+        if actual_thread_id is not None and int(actual_thread_id) != int(thread_id):
+            logger.warning(
+                "%s 的消息被重定向到话题 %s（预期话题 %s），正在重建",
+                debug_info,
+                actual_thread_id,
+                thread_id,
+            )
+
+            session.thread_id = None
+            thread_to_user.pop(thread_id, None)
+            _record_thread_health(
+                thread_id,
+                {"status": "redirected", "actual_thread_id": actual_thread_id},
+            )
+            persist_mapping(uid)
+            logger.debug(
+                "Cleaned up mappings for %s, old_tid: %s", debug_info, thread_id
+            )
+
+            thread_id, is_new_topic = await _ensure_thread_for_user(
+                context, user, display
+            )
+            logger.debug(
+                "Re-created thread_id %s for %s, is_new_topic: %s",
+                thread_id,
+                debug_info,
+                is_new_topic,
+            )
+
+            logger.debug("Re-forwarding message to new thread %s", thread_id)
+            sent_ids, _ = await _copy_to_topic(context.bot, thread_id, uid, message_ids)
+            logger.debug("Message re-forwarded successfully")
+        else:
+            # 实际转发成功本身就是话题健康的信号
+            _record_thread_health(thread_id, {"status": "ok"})
+
+        _map_copied(uid, message_ids, GROUP_ID, sent_ids)
+        logger.debug("Recorded %d message mapping(s) for %s", len(sent_ids), debug_info)
+
+    except Exception as exc:
+        logger.error("Failed to forward message from %s: %s", debug_info, exc)
+
+        # 乐观模式下只有“话题不存在”才说明话题失效；其他失败（消息无法复制、
+        # 超时、5xx 等）与话题无关，保留映射，下一条消息仍发往原话题
+        topic_gone = TOPIC_HEALTH_MODE != "optimistic" or _is_thread_missing_error(exc)
+        if session.thread_id and topic_gone:
+            old_tid = session.thread_id
+            _cleanup_dead_thread(session)
+            _record_thread_health(
+                old_tid, {"status": "send_failed", "description": str(exc)}
+            )
+            persist_mapping(uid)
+
+        try:
+            await msg.reply_text(f"消息发送失败：{exc}")
+        except Exception:
+            logger.error("Could not notify %s of error: %s", debug_info, exc)
+
+
+async def _forward_batch(
+    context: ContextTypes.DEFAULT_TYPE,
+    user: Any,
+    display: str,
+    messages: List[Message],
+) -> None:
+    """转发一批消息（已收齐的相册或发件队列中的消息）。
+
+    调用方负责保证同一用户的转发串行：持有用户锁，或运行在该用户的发件队列任务中。
+    """
+    uid = user.id
+    if get_session(uid).banned:
+        return
+    debug_info = f"User {uid}, batch of {len(messages)} from {messages[0].message_id}"
+    await _forward_to_topic(
+        context,
+        user,
+        display,
+        messages[-1],
+        [m.message_id for m in messages],
+        debug_info,
+    )
+
+
+def _enqueue_forward(
+    context: ContextTypes.DEFAULT_TYPE,
+    user: Any,
+    display: str,
+    messages: List[Message],
+) -> None:
+    """放入用户发件队列后立即返回。
+
+    发件队列任务是该用户唯一的转发方，因此转发时无需再持有用户锁，
+    处理器也不会因等待上一批转发而阻塞，转发期间到达的消息得以合并。
+    """
+    forward_coalescer.add(
+        user.id,
+        messages,
+        lambda batch: _forward_batch(context, user, display, batch),
+    )
+
+
+async def _forward_album(
+    context: ContextTypes.DEFAULT_TYPE,
+    user: Any,
+    display: str,
+    messages: List[Message],
+) -> None:
+    """转发一个已收齐的相册（由 media_groups 在窗口到期后调用）。"""
+    if FORWARD_COALESCE:
+        _enqueue_forward(context, user, display, messages)
+        return
+    async with user_locks.hold(user.id):
+        await _forward_batch(context, user, display, messages)
+
+
+def _buffer_album_item(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, debug_info: str
+) -> None:
+    """把私聊相册中的一条缓冲起来，收齐后由 _forward_album 一次性转发。"""
+    msg = update.message
+    user = update.effective_user
+    display = _display_name_from_update(update)
+    media_groups.add(
+        ("user", user.id),
+        msg.media_group_id,
+        msg,
+        lambda messages: _forward_album(context, user, display, messages),
+    )
+    logger.debug("Buffered %s into album %s", debug_info, msg.media_group_id)
+
+
 async def handle_private_message(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
@@ -523,16 +4127,34 @@ async def handle_private_message(
     text_content = msg.text or msg.caption or ""
 
     debug_info = f"User {uid}, message_id: {msg.message_id}"
-    print(f"DEBUG: Processing message from {debug_info}")
+    logger.debug("Processing message from %s", debug_info)
+
+    # 先发出该用户之前缓冲的相册，避免被这条消息超越
+    await media_groups.flush_scope(("user", uid), keep=msg.media_group_id)
+
+    # 已验证用户的相册：内存中的会话满足条件时直接缓冲，不为每一条获取用户锁，
+    # 整组只在 _forward_album 中获取一次；其余情况走下方的完整检查
+    if msg.media_group_id:
+        session = user_sessions.get(uid)
+        if (
+            session is not None
+            and session.verified
+            and not session.banned
+            and update.effective_user.username
+        ):
+            session.last_activity = time()
+            _buffer_album_item(update, context, debug_info)
+            return
 
-    async with user_locks[uid]:
-        print(f"DEBUG: Acquired lock for {debug_info}")
+    async with user_locks.hold(uid):
+        logger.debug("Acquired lock for %s", debug_info)
 
         session = get_session(uid)
         session.last_activity = time()
 
         if session.banned:
-            print(f"DEBUG: {debug_info} is banned")
+            # 准入检查只放行间隔到期的那条消息来回复提示，其余已在排队前丢弃
+            logger.debug("%s is banned", debug_info)
             await msg.reply_text("🚫 你已被管理员禁止发送消息。")
             return
 
@@ -541,57 +4163,59 @@ async def handle_private_message(
 
         # 1. 验证流程
         if not session.verified:
-            print(f"DEBUG: {debug_info} needs verification")
+            logger.debug("%s needs verification", debug_info)
 
             if USE_MATH_CAPTCHA:
                 try:
                     user_answer = int(text_content.strip())
                     correct_answer = math_answers.get(uid)
 
-                    print(
-                        "DEBUG: Math verification - user input: "
-                        f"{user_answer}, expected: {correct_answer}"
+                    logger.debug(
+                        "Math verification - user input: %s, expected: %s",
+                        user_answer,
+                        correct_answer,
                     )
 
                     if user_answer == correct_answer:
                         session.verified = True
                         session.verify_time = time()
                         math_answers.pop(uid, None)
-                        persist_mapping()
+                        expiry.cancel("math_answer", uid)
+                        persist_mapping(uid)
                         await msg.reply_text("验证成功！你现在可以发送消息了。")
-                        print(f"DEBUG: {debug_info} verification successful")
+                        logger.debug("%s verification successful", debug_info)
                     else:
                         question, answer = _generate_math_question()
-                        math_answers[uid] = answer
+                        _set_math_answer(uid, answer)
                         await msg.reply_text(f"答案错误，请重新回答：\n{question}")
-                        print(f"DEBUG: {debug_info} gave wrong answer, asking again")
+                        logger.debug("%s gave wrong answer, asking again", debug_info)
 
                 except ValueError:
                     question, answer = _generate_math_question()
-                    math_answers[uid] = answer
+                    _set_math_answer(uid, answer)
                     await msg.reply_text(f"请输入有效数字：\n{question}")
-                    print(f"DEBUG: {debug_info} input invalid, asking again")
+                    logger.debug("%s input invalid, asking again", debug_info)
 
             elif USE_FIXED_CAPTCHA:
                 if text_content.strip() == VERIFY_ANSWER:
                     session.verified = True
                     session.verify_time = time()
-                    persist_mapping()
+                    persist_mapping(uid)
                     await msg.reply_text("验证成功！你现在可以发送消息了。")
-                    print(f"DEBUG: {debug_info} fixed verification successful")
+                    logger.debug("%s fixed verification successful", debug_info)
                 else:
                     await msg.reply_text("请先通过验证：" + VERIFY_QUESTION)
-                    print(f"DEBUG: {debug_info} needs to answer fixed question")
+                    logger.debug("%s needs to answer fixed question", debug_info)
 
             else:
                 session.verified = True
                 session.verify_time = time()
-                persist_mapping()
-                print(f"DEBUG: {debug_info} auto-verified (no captcha)")
+                persist_mapping(uid)
+                logger.debug("%s auto-verified (no captcha)", debug_info)
 
             return
 
-        print(f"DEBUG: {debug_info} already verified, proceeding to send message")
+        logger.debug("%s already verified, proceeding to send message", debug_info)
 
         # 检查用户名
         if not user.username:
@@ -601,118 +4225,21 @@ async def handle_private_message(
             )
             return
 
-        # 2. 确保话题存在且有效
-        try:
-            thread_id, is_new_topic = await _ensure_thread_for_user(
-                context, uid, display
-            )
-            print(
-                f"DEBUG: Got thread_id {thread_id} for {debug_info}, "
-                f"is_new_topic: {is_new_topic}"
-            )
-        except Exception as exc:
-            print(f"ERROR: Failed to ensure thread for {debug_info}: {exc}")
-            await msg.reply_text(f"系统错误：{exc}")
+        # 相册：缓冲到收齐后一次性转发
+        if msg.media_group_id:
+            _buffer_album_item(update, context, debug_info)
             return
 
-        # 3. 新用户发名片
-        if is_new_topic:
-            print(f"DEBUG: Sending welcome card for {debug_info} in thread {thread_id}")
-            safe_name = html.escape(user.full_name or "无名氏")
-            username_text = f"@{user.username}" if user.username else "未设置"
-            mention_link = mention_html(uid, safe_name)
-
-            info_text = (
-                "<b>新用户接入</b>\n"
-                f"ID: <code>{uid}</code>\n"
-                f"名字: {mention_link}\n"
-                f"用户名: {username_text}\n"
-                f"#id{uid}"
-            )
-            try:
-                await context.bot.send_message(
-                    chat_id=GROUP_ID,
-                    message_thread_id=thread_id,
-                    text=info_text,
-                    parse_mode=ParseMode.HTML,
-                )
-                print(
-                    f"DEBUG: Sent welcome card for {debug_info} in thread {thread_id}"
-                )
-            except Exception as exc:
-                print(f"ERROR: Failed to send welcome card for {debug_info}: {exc}")
+        if FORWARD_COALESCE:
+            # 入队后立即返回，转发由该用户的发件队列完成
+            _enqueue_forward(context, user, display, [msg])
+            return
 
-        # 4. 转发用户消息
-        print(
-            f"DEBUG: About to forward message from {debug_info} to thread {thread_id}"
+        await _forward_to_topic(
+            context, user, display, msg, [msg.message_id], debug_info
         )
 
-        try:
-            sent_msg = await context.bot.copy_message(
-                chat_id=GROUP_ID,
-                message_thread_id=thread_id,
-                from_chat_id=uid,
-                message_id=msg.message_id,
-            )
-
-            actual_thread_id = getattr(sent_msg, "message_thread_id", None)
-            print(
-                f"DEBUG: Expected thread_id: {thread_id}, "
-                f"Actual thread_id: {actual_thread_id}"
-            )
-
-            # 关键逻辑：sent_msg 成功即认为发送成功；仅当 actual_thread_id 明确且不同才重建
-            if actual_thread_id is not None and int(actual_thread_id) != int(thread_id):
-                print(
-                    f"⚠️ {debug_info} 的消息被重定向到话题 {actual_thread_id}"
-                    f"（预期话题 {thread_id}），正在重建..."
-                )
-
-                session.thread_id = None
-                thread_to_user.pop(thread_id, None)
-                if thread_id in thread_health_cache:
-                    thread_health_cache[thread_id]["healthy"] = False
-                persist_mapping()
-                print(
-                    f"DEBUG: Cleaned up mappings for {debug_info}, old_tid: {thread_id}"
-                )
-
-                thread_id, is_new_topic = await _ensure_thread_for_user(
-                    context, uid, display
-                )
-                print(
-                    f"DEBUG: Re-created thread_id {thread_id} for {debug_info}, "
-                    f"is_new_topic: {is_new_topic}"
-                )
-
-                print(f"DEBUG: Re-forwarding message to new thread {thread_id}")
-                sent_msg = await context.bot.copy_message(
-                    chat_id=GROUP_ID,
-                    message_thread_id=thread_id,
-                    from_chat_id=uid,
-                    message_id=msg.message_id,
-                )
-                print("DEBUG: Message re-forwarded successfully")
-
-            message_map[(uid, msg.message_id)] = (GROUP_ID, sent_msg.message_id, time())
-            print(
-                f"DEBUG: Recorded message mapping for {debug_info}, msg_id: {msg.message_id}"
-            )
-
-        except Exception as exc:
-            print(f"ERROR: Failed to forward message from {debug_info}: {exc}")
-
-            if session.thread_id:
-                if session.thread_id in thread_health_cache:
-                    thread_health_cache[session.thread_id]["healthy"] = False
-                session.thread_id = None
-
-            try:
-                await msg.reply_text(f"消息发送失败：{exc}")
-            except Exception:
-                print(f"ERROR: Could not notify {debug_info} of error: {exc}")
-
-    print(f"DEBUG: Finished processing message from {debug_info}")
+    logger.debug("Finished processing message from %s", debug_info)
 
 
 async def handle_group_message(
@@ -732,83 +4259,580 @@ async def handle_group_message(
     ):
         return
 
-    target_user_id = thread_to_user.get(int(thread_id))
+    target_user_id = user_for_thread(int(thread_id))
     if not target_user_id:
         return
 
+    scope = ("thread", int(thread_id))
+    if msg.media_group_id:
+        media_groups.add(
+            scope,
+            msg.media_group_id,
+            msg,
+            lambda messages: _forward_group_album(context, target_user_id, messages),
+        )
+        return
+    await media_groups.flush_scope(scope)
+
     try:
         sent_msg = await context.bot.copy_message(
             chat_id=target_user_id,
             from_chat_id=GROUP_ID,
             message_id=msg.message_id,
         )
-        message_map[(GROUP_ID, msg.message_id)] = (
-            target_user_id,
-            sent_msg.message_id,
-            time(),
+        message_map.put(GROUP_ID, msg.message_id, target_user_id, sent_msg.message_id)
+    except Exception as exc:
+        logger.error("Could not send message to user %s: %s", target_user_id, exc)
+
+
+async def _forward_group_album(
+    context: ContextTypes.DEFAULT_TYPE, target_user_id: int, messages: List[Message]
+) -> None:
+    """把管理员在话题中发送的相册一次性转发给用户。"""
+    message_ids = [m.message_id for m in messages]
+    try:
+        sent = await context.bot.copy_messages(
+            chat_id=target_user_id,
+            from_chat_id=GROUP_ID,
+            message_ids=message_ids,
         )
     except Exception as exc:
-        print(f"ERROR: Could not send message to user {target_user_id}: {exc}")
+        logger.error("Could not send album to user %s: %s", target_user_id, exc)
+        return
+    _map_copied(GROUP_ID, message_ids, target_user_id, [m.message_id for m in sent])
 
 
 async def handle_edit_message(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
-    """处理消息编辑同步。"""
+    """处理消息编辑同步：同一条消息的连续编辑合并后只同步最后一次。"""
     edited_msg = update.edited_message
-    if not edited_msg:
+    if not edited_msg or not (edited_msg.text or edited_msg.caption):
         return
+    edit_sync.add(edited_msg, lambda message: _sync_edit(context.bot, message))
+
 
-    source_chat_id = edited_msg.chat_id
-    source_msg_id = edited_msg.message_id
+async def _sync_edit(bot: Any, edited_msg: Message) -> bool:
+    """把一次编辑同步到目标消息，返回是否发出了编辑。
 
-    target = message_map.get((source_chat_id, source_msg_id))
+    目标映射在内存中未命中时由 message_map 回查磁盘索引。
+    """
+    target = await message_map.get(edited_msg.chat_id, edited_msg.message_id)
     if not target:
-        return
+        return False
 
-    target_chat_id, target_msg_id, _ = target
+    target_chat_id, target_msg_id = target
 
     try:
         if edited_msg.text:
-            await context.bot.edit_message_text(
+            await bot.edit_message_text(
                 chat_id=target_chat_id,
                 message_id=target_msg_id,
                 text=edited_msg.text,
                 entities=edited_msg.entities,
             )
-        elif edited_msg.caption:
-            await context.bot.edit_message_caption(
+        else:
+            await bot.edit_message_caption(
                 chat_id=target_chat_id,
                 message_id=target_msg_id,
                 caption=edited_msg.caption,
                 caption_entities=edited_msg.caption_entities,
             )
-    except Exception as exc:
-        print(f"编辑同步失败: {exc}")
+    except BadRequest as exc:
+        if "message is not modified" in str(exc).lower():
+            # 合并后的内容与目标消息相同（如改了又改回），无需同步
+            return False
+        raise
+    return True
 
 
-async def cleanup_message_map(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """清理超过24小时的消息映射记录。"""
+async def expire_message_map(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """分片清理超过24小时未使用的内存映射，每片之间让出事件循环。"""
     now = time()
-    preserved = {
-        key: value
-        for key, value in message_map.items()
-        if now - value[2] <= MESSAGE_MAP_TTL_SECONDS
+    while True:
+        _, finished = message_map.expire(now, MESSAGE_MAP_EXPIRE_SLICE_SECONDS)
+        if finished:
+            break
+        await asyncio.sleep(0)
+
+
+async def cleanup_message_map(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """清理超过保留期的磁盘映射，并输出消息映射统计。"""
+    disk_removed = await message_map.purge_disk(time())
+
+    if disk_removed > 0:
+        logger.info("清理了磁盘上 %d 条过期消息映射", disk_removed)
+
+    stats = message_map.stats()
+    logger.info(
+        "消息映射：内存 %d 条（约 %.1f MB），命中 %d / 磁盘命中 %d / 未命中 %d，"
+        "平均查询 %.1f µs，累计过期 %d / 淘汰 %d 条，单片最长停顿 %.2f ms",
+        stats["entries"],
+        stats["approx_bytes"] / 1024 / 1024,
+        stats["hits"],
+        stats["disk_hits"],
+        stats["misses"],
+        stats["avg_lookup_us"],
+        stats["expired"],
+        stats["evicted"],
+        stats["expire_pause_max_ms"],
+    )
+
+
+# ---------- 多副本：路由与接收 ----------
+REPLICA_FORWARDED = metrics.counter(
+    "replica_forwarded_updates_total", "router 成功转发给各 worker 的更新数", "node"
+)
+REPLICA_FORWARD_FAILURES = metrics.counter(
+    "replica_forward_failures_total",
+    "router 转发失败（连接错误或 5xx，将重试）的次数",
+    "node",
+)
+REPLICA_FORWARD_REJECTED = metrics.counter(
+    "replica_forward_rejected_updates_total",
+    "被 worker 以 4xx 拒绝而丢弃的更新数",
+    "node",
+    "status",
+)
+REPLICA_RECEIVED = metrics.counter(
+    "replica_received_updates_total", "worker 收到的转发更新数", "result"
+)
+
+
+def _replica_route_key(update: Update) -> int:
+    """更新的分区键：与同一用户相关的更新（私聊、其话题内的回复、
+    针对其 ID 的 /ban /unban）都落到同一个 worker。"""
+    chat = update.effective_chat
+    msg = update.effective_message
+    if chat is None:
+        return 0
+    if chat.type == "private":
+        return chat.id
+    if chat.id == GROUP_ID and msg is not None:
+        parts = (msg.text or "").split()
+        if (
+            len(parts) > 1
+            and parts[0].split("@")[0] in ("/ban", "/unban")
+            and parts[1].isdigit()
+        ):
+            return int(parts[1])
+        if msg.message_thread_id:
+            user_id = user_for_thread(int(msg.message_thread_id))
+            return user_id if user_id is not None else msg.message_thread_id
+    return chat.id
+
+
+class ReplicaRouter:
+    """把更新按用户分区转发给各 worker。
+
+    每个节点一个发送队列和一个发送协程，逐批 POST，同一用户的更新到达 worker
+    的顺序与 router 收到的顺序一致；连接错误与 5xx 时指数退避重试整批
+    （worker 按 update_id 去重，重试造成的重复投递不会被处理两次）。
+    4xx（批次格式错误、密钥不匹配）重试也不会成功，记录后丢弃该批，
+    避免一批坏数据或一个配置错误的 worker 永久堵住该分区。
+    """
+
+    def __init__(
+        self, nodes: List[str], secret: str, batch_max: int = REPLICA_BATCH_MAX
+    ) -> None:
+        self.nodes = nodes
+        self.ring = HashRing(nodes)
+        self.secret = secret
+        self.batch_max = batch_max
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues.values())
+
+    def submit(self, update: Update) -> None:
+        node = self.ring.node_for(_replica_route_key(update))
+        self._queues[node].put_nowait(update.to_dict())
+
+    async def start(self) -> None:
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0), headers={"X-Replica-Secret": self.secret}
+        )
+        for node in self.nodes:
+            self._queues[node] = asyncio.Queue()
+            self._tasks.append(asyncio.create_task(self._sender(node)))
+
+    async def stop(self, timeout: float = 10) -> None:
+        """把队列中剩余的更新发完（最多等待 timeout 秒）后关闭。"""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(q.join() for q in self._queues.values())), timeout
+            )
+        except asyncio.TimeoutError:
+            logger.error("停机时仍有 %d 个更新未能转发", self.queue_depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _sender(self, node: str) -> None:
+        pending = self._queues[node]
+        url = f"{node}/updates"
+        while True:
+            batch = [await pending.get()]
+            while len(batch) < self.batch_max and not pending.empty():
+                batch.append(pending.get_nowait())
+            body = json.dumps(batch).encode()
+            delay = 0.5
+            while True:
+                try:
+                    response = await self._client.post(url, content=body)
+                except httpx.TransportError as exc:
+                    error = str(exc) or type(exc).__name__
+                else:
+                    if response.status_code < 500:
+                        break
+                    error = f"HTTP {response.status_code}"
+                REPLICA_FORWARD_FAILURES.inc(node)
+                logger.warning("转发到 %s 失败，%.1f 秒后重试: %s", node, delay, error)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, REPLICA_RETRY_MAX_SECONDS)
+            if response.is_success:
+                REPLICA_FORWARDED.inc(node, amount=len(batch))
+            else:
+                REPLICA_FORWARD_REJECTED.inc(
+                    node, response.status_code, amount=len(batch)
+                )
+                logger.error(
+                    "%s 拒绝了 %d 个更新（HTTP %d），已丢弃该批",
+                    node,
+                    len(batch),
+                    response.status_code,
+                )
+            for _ in batch:
+                pending.task_done()
+
+
+class ReplicaIngress:
+    """worker 端：校验共享密钥后把 router 转发来的更新放入 Application 的更新队列。"""
+
+    def __init__(self, app: Application, secret: str, remember: int = 10000) -> None:
+        self.app = app
+        self.secret = secret.encode()
+        self.remember = remember
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+
+    async def handle(
+        self, method: str, path: str, headers: Dict[str, str], body: bytes
+    ) -> Tuple[str, bytes]:
+        if method != "POST" or path != "/updates":
+            return "404 Not Found", b"not found\n"
+        given = headers.get("x-replica-secret", "").encode()
+        if not secrets.compare_digest(given, self.secret):
+            return "403 Forbidden", b"forbidden\n"
+        # 先整体解析校验，格式不对时整批拒绝，不会只放入一部分
+        try:
+            items = json.loads(body)
+            if not isinstance(items, list) or not all(
+                isinstance(item, dict) and isinstance(item.get("update_id"), int)
+                for item in items
+            ):
+                raise ValueError("更新批次必须是带 update_id 的对象列表")
+            updates = [Update.de_json(item, self.app.bot) for item in items]
+        except (ValueError, TypeError, KeyError) as exc:
+            logger.warning("副本收到格式错误的更新批次: %s", exc)
+            return "400 Bad Request", b"bad request\n"
+
+        for update in updates:
+            if update.update_id in self._seen:
+                REPLICA_RECEIVED.inc("duplicate")
+                continue
+            self._seen[update.update_id] = None
+            if len(self._seen) > self.remember:
+                self._seen.popitem(last=False)
+            await self.app.update_queue.put(update)
+            REPLICA_RECEIVED.inc("accepted")
+        return "200 OK", b"ok\n"
+
+
+async def _run_replica_worker(app: Application) -> None:
+    """worker 进程：不连接 Telegram 的更新接口，只处理 router 转发来的更新。"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    ingress = ReplicaIngress(app, REPLICA_SECRET)
+    async with app:
+        await on_startup(app)
+        await app.start()
+        server = await asyncio.start_server(
+            _serve_http(ingress.handle), REPLICA_LISTEN, REPLICA_PORT
+        )
+        logger.info(
+            "副本 worker %s 已启动，监听 %s:%s",
+            REPLICA_SELF,
+            REPLICA_LISTEN,
+            REPLICA_PORT,
+        )
+        try:
+            await stop_event.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            # 停止前处理完已接收的更新
+            await app.stop()
+            await on_stop(app)
+    await on_shutdown(app)
+
+
+def build_router_application(
+    builder: Optional[ApplicationBuilder] = None,
+) -> Application:
+    """router 进程：只接收 Telegram 更新并按用户转发给 worker，不执行业务处理器。"""
+    if builder is None:
+        request, updates_request = build_api_requests()
+        builder = (
+            ApplicationBuilder()
+            .token(BOT_TOKEN)
+            .request(request)
+            .get_updates_request(updates_request)
+        )
+
+    router = ReplicaRouter(REPLICA_NODES, REPLICA_SECRET)
+
+    async def startup(app: Application) -> None:
+        await on_startup(app)
+        await router.start()
+
+    async def stop(app: Application) -> None:
+        await router.stop()
+
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        router.submit(update)
+
+    app = builder.post_init(startup).post_stop(stop).post_shutdown(on_shutdown).build()
+    metrics.gauge_callback(
+        "replica_router_queue_depth",
+        "router 中等待转发给 worker 的更新数",
+        lambda: router.queue_depth,
+    )
+    app.add_handler(TypeHandler(Update, route))
+    return app
+
+
+_metrics_server: Optional[asyncio.AbstractServer] = None
+
+
+async def on_startup(app: Any) -> None:
+    """启动指标端点（METRICS_PORT 非 0 时）与预建话题池的补充任务。"""
+    global _metrics_server
+    if REPLICA_ROLE != "router":
+        topic_pool.start(app.bot)
+    if METRICS_PORT:
+        _metrics_server = await asyncio.start_server(
+            _serve_metrics, METRICS_LISTEN, METRICS_PORT
+        )
+        logger.info("指标端点: http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+
+
+async def on_stop(app: Any) -> None:
+    """停止接收更新后、关闭 Bot 连接前，转发仍在缓冲中的相册、发件队列与编辑。"""
+    await topic_pool.close()
+    await media_groups.close()
+    await forward_coalescer.close()
+    await edit_sync.close()
+
+
+async def on_shutdown(app: Any) -> None:
+    """停机时写入尚未落盘的持久化变更，并关闭指标端点。"""
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
+    await expiry.close()
+    await persister.close()
+    await message_map.close()
+
+
+def state_memory_bytes() -> Dict[str, int]:
+    """估算本实例常驻状态的内存占用（字节）：条目数乘以单条样本大小，O(1)。"""
+    big_int = sys.getsizeof(1 << 40)
+    sample = UserSession(user_id=1 << 40)
+    per_session = sys.getsizeof(sample) + sys.getsizeof(vars(sample)) + 3 * big_int
+    # 健康缓存条目：__slots__ 对象、三个 float、键，以及有序字典的链表节点
+    per_health = (
+        sys.getsizeof(_HealthEntry(0.0, 0.0, 0.0, "ok"))
+        + 3 * sys.getsizeof(0.0)
+        + big_int
+        + 100
+    )
+    return {
+        "sessions": sys.getsizeof(user_sessions) + len(user_sessions) * per_session,
+        "thread_map": sys.getsizeof(thread_to_user) + len(thread_to_user) * 2 * big_int,
+        "message_map": message_map.stats()["approx_bytes"],
+        "thread_health": len(thread_health_cache) * per_health,
+        "storage_index": storage.memory_bytes(),
     }
 
-    removed_count = len(message_map) - len(preserved)
-    message_map.clear()
-    message_map.update(preserved)
 
-    if removed_count > 0:
-        print(f"🧹 清理了 {removed_count} 条过期消息映射")
+def _register_state_metrics(
+    app: Application, processor: OrderedUpdateProcessor
+) -> None:
+    """注册抓取时读取的状态指标（队列深度、缓存命中等）。"""
+    gauge, counter = metrics.gauge_callback, metrics.counter_callback
+
+    gauge("update_queue_depth", "已接收、尚未分发的更新数", app.update_queue.qsize)
+    gauge(
+        "updates_in_flight",
+        "已分发、尚未处理完的更新数（含等待同会话前序更新的）",
+        lambda: processor.current_concurrent_updates,
+    )
+    gauge(
+        "update_conversations_active",
+        "有更新在排队或处理中的会话数",
+        lambda: processor.queued_keys,
+    )
+    gauge(
+        "outbound_queue_depth",
+        "等待出站限流放行的 Bot API 调用数",
+        lambda: outbound.queue_depth,
+    )
 
+    counter(
+        "thread_health_cache_hits_total",
+        "话题健康缓存命中次数",
+        lambda: thread_health_cache.hits,
+    )
+    counter(
+        "thread_health_cache_misses_total",
+        "话题健康缓存未命中次数",
+        lambda: thread_health_cache.misses,
+    )
+    gauge(
+        "thread_health_cache_hit_ratio",
+        "话题健康缓存累计命中率",
+        lambda: thread_health_cache.hits
+        / max(1, thread_health_cache.hits + thread_health_cache.misses),
+    )
+    gauge(
+        "thread_health_cache_entries",
+        "话题健康缓存条目数",
+        lambda: len(thread_health_cache),
+    )
 
-def main() -> None:
-    load_persisted_mapping()
+    gauge(
+        "message_map_entries",
+        "内存中的消息映射条目数",
+        lambda: message_map.stats()["entries"],
+    )
+    gauge(
+        "message_map_bytes",
+        "内存中消息映射的估算占用（字节）",
+        lambda: message_map.stats()["approx_bytes"],
+    )
+    counter("message_map_hits_total", "消息映射内存命中次数", lambda: message_map.hits)
+    counter(
+        "message_map_disk_hits_total",
+        "消息映射磁盘命中次数",
+        lambda: message_map.disk_hits,
+    )
+    counter(
+        "message_map_misses_total", "消息映射未命中次数", lambda: message_map.misses
+    )
+    counter(
+        "message_map_evicted_total",
+        "超出内存上限被淘汰的消息映射条目数（磁盘中仍可查到）",
+        lambda: message_map.evicted,
+    )
+    counter(
+        "message_map_expired_total",
+        "超过 TTL 被增量清理的消息映射条目数",
+        lambda: message_map.expired,
+    )
+    gauge(
+        "message_map_expire_pause_max_seconds",
+        "消息映射单片过期清理占用事件循环的最长时间",
+        lambda: message_map.expire_pause_max,
+    )
+    counter(
+        "message_map_disk_write_failures_total",
+        "消息映射批量写入磁盘失败的次数（失败的批次会重试）",
+        lambda: message_map.disk_write_failures,
+    )
+    counter(
+        "message_map_disk_dropped_total",
+        "写入失败期间待写队列超出上限而丢弃的消息映射条数",
+        lambda: message_map.disk_dropped,
+    )
+    gauge(
+        "message_map_disk_pending",
+        "等待写入磁盘的消息映射条数",
+        lambda: message_map.disk_pending,
+    )
+    gauge(
+        "message_map_disk_degraded",
+        "连续写入失败后暂停了磁盘回查时为 1",
+        lambda: float(message_map.disk_degraded),
+    )
+
+    gauge("user_sessions", "内存中的用户会话数", lambda: len(user_sessions))
+    gauge(
+        "state_memory_bytes",
+        "会话、话题映射、消息映射与健康缓存的估算内存占用（字节）",
+        lambda: sum(state_memory_bytes().values()),
+    )
+    gauge("user_locks_active", "当前被持有或等待中的用户锁数", lambda: len(user_locks))
+    counter(
+        "topic_flights_shared_total",
+        "被并发去重合并的话题创建/探测次数",
+        lambda: topic_flights.shared,
+    )
+    counter("media_group_albums_total", "整组转发的相册数", lambda: media_groups.albums)
+    counter(
+        "forward_coalesce_batches_total",
+        "合并转发的批次数",
+        lambda: forward_coalescer.batches,
+    )
+    counter(
+        "forward_coalesce_messages_total",
+        "合并转发的消息数",
+        lambda: forward_coalescer.messages,
+    )
+    counter("edit_sync_sent_total", "实际发出的编辑同步次数", lambda: edit_sync.sent)
+    counter(
+        "edit_sync_coalesced_total",
+        "被同一消息的后续编辑取代、未发出的编辑数",
+        lambda: edit_sync.coalesced,
+    )
+
+
+def build_application(builder: Optional[ApplicationBuilder] = None) -> Application:
+    """创建 Application 并注册所有处理器与定时任务。
+
+    builder 可由调用方预先配置（如基准测试注入假的 Bot API 请求对象）。
+    """
+    if builder is None:
+        request, updates_request = build_api_requests()
+        builder = (
+            ApplicationBuilder()
+            .token(BOT_TOKEN)
+            .request(request)
+            .get_updates_request(updates_request)
+        )
 
-    print("Bot is starting...")
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    processor = OrderedUpdateProcessor(CONCURRENT_UPDATES, UPDATE_QUEUE_MAX, ingress)
+    app = (
+        builder.rate_limiter(outbound)
+        .concurrent_updates(processor)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    _register_state_metrics(app, processor)
 
     # 注册命令处理器
     for cmd_name, handler_func in (
@@ -842,14 +4866,208 @@ def main() -> None:
         )
     )
 
-    # 每小时清理一次过期消息映射
+    # 每分钟增量清理内存中的过期消息映射
+    app.job_queue.run_repeating(
+        callback=expire_message_map,
+        interval=MESSAGE_MAP_EXPIRE_INTERVAL_SECONDS,
+        first=MESSAGE_MAP_EXPIRE_INTERVAL_SECONDS,
+    )
+
+    # 每小时清理一次磁盘上的过期消息映射
     app.job_queue.run_repeating(
         callback=cleanup_message_map,
         interval=CLEANUP_INTERVAL_SECONDS,
         first=CLEANUP_INTERVAL_SECONDS,
     )
 
-    print("Polling started.")
+    return app
+
+
+# ---------- 多租户：一个进程托管多个机器人 ----------
+def _load_tenant(name: str, overrides: Dict[str, str]) -> ModuleType:
+    """以租户的配置重新执行本模块，得到一个全局状态完全隔离的实例。
+
+    配置作为 _TENANT_CONFIG 注入新模块，不修改进程的 os.environ，
+    因此加载租户时其他线程读取环境变量不受影响。
+    各租户共享已导入的 telegram 等依赖、事件循环、HTTP 连接池与持久化写线程，
+    会话、缓存、限流与配置互不影响。
+    """
+    data_dir = TENANT_DATA_DIR / name
+    env = {k: v for k, v in _CONFIG.items() if k != "TENANTS_FILE"}
+    env.update(
+        TENANT_NAME=name,
+        PERSIST_FILE=str(data_dir / "topic_mapping.json"),
+        SQLITE_PATH=str(data_dir / "bot.db"),
+        MESSAGE_MAP_DB=str(data_dir / "message_map.db"),
+    )
+    env.update({key: str(value) for key, value in overrides.items()})
+    # 指标由宿主统一提供（带 tenant 标签）
+    env["METRICS_PORT"] = "0"
+
+    module_name = f"bot_tenant_{name}"
+    spec = importlib.util.spec_from_file_location(module_name, __file__)
+    module = importlib.util.module_from_spec(spec)
+    # dataclass 等在定义时会按模块名查找 sys.modules
+    sys.modules[module_name] = module
+    module._TENANT_CONFIG = env
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[module_name]
+        raise
+    if module.REPLICA_ROLE:
+        raise RuntimeError(f"租户 {name}：多租户模式不能与多副本模式同时使用")
+    return module
+
+
+def load_tenants(path: str) -> Dict[str, ModuleType]:
+    """读取 TENANTS_FILE 并加载各租户；配置错误时报出租户名。"""
+    config = json.loads(Path(path).read_text(encoding="utf-8"))
+    if not isinstance(config, dict) or not config:
+        raise RuntimeError("TENANTS_FILE 必须是非空的 JSON 对象：{租户名: {环境变量}}")
+    tenants = {}
+    for name, overrides in config.items():
+        try:
+            tenants[name] = _load_tenant(name, overrides)
+        except RuntimeError as exc:
+            raise RuntimeError(f"租户 {name} 配置错误: {exc}") from exc
+    return tenants
+
+
+async def _start_tenant(
+    tenant: ModuleType, request: BaseRequest, updates_request: BaseRequest
+) -> Application:
+    tenant.load_persisted_mapping()
+    app = tenant.build_application(
+        ApplicationBuilder()
+        .token(tenant.BOT_TOKEN)
+        .request(request)
+        .get_updates_request(updates_request)
+    )
+    await app.initialize()
+    await tenant.on_startup(app)
+    await app.start()
+    if tenant.WEBHOOK_URL:
+        await app.updater.start_webhook(
+            listen=tenant.WEBHOOK_LISTEN,
+            port=tenant.WEBHOOK_PORT,
+            url_path=tenant.WEBHOOK_PATH,
+            webhook_url=f"{tenant.WEBHOOK_URL.rstrip('/')}/{tenant.WEBHOOK_PATH}",
+            secret_token=tenant.WEBHOOK_SECRET,
+            max_connections=tenant.WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        await app.updater.start_polling()
+    return app
+
+
+async def run_tenants(tenants: Dict[str, ModuleType]) -> None:
+    """在同一个事件循环中运行所有租户，直到收到 SIGINT / SIGTERM。"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # 所有租户共用：出站请求连接池、getUpdates 连接池（每个租户一个长轮询连接）、
+    # 单个持久化写线程，以及 CPU 密集型工作的进程池
+    request, updates_request = build_api_requests(
+        API_POOL_SIZE, API_UPDATES_POOL_SIZE * len(tenants)
+    )
+    writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+    pool = new_cpu_pool()
+    for tenant in tenants.values():
+        tenant.persist_executor = writer
+        tenant.cpu_pool = pool
+        tenant.snapshot_encoder = _encode_snapshot
+
+    async def handle_metrics(
+        method: str, path: str, headers: Dict[str, str], body: bytes
+    ) -> Tuple[str, bytes]:
+        if method == "GET" and path == "/metrics":
+            registries = {name: t.metrics for name, t in tenants.items()}
+            # 共享连接池等宿主自身的指标，tenant 标签为空
+            registries[""] = metrics
+            return "200 OK", render_tenant_metrics(registries).encode()
+        return "404 Not Found", b"not found\n"
+
+    server = None
+    if METRICS_PORT:
+        server = await asyncio.start_server(
+            _serve_http(handle_metrics), METRICS_LISTEN, METRICS_PORT
+        )
+
+    apps: Dict[str, Application] = {}
+    try:
+        for name, tenant in tenants.items():
+            apps[name] = await _start_tenant(tenant, request, updates_request)
+            memory = tenant.state_memory_bytes()
+            logger.info(
+                "租户 %s 已启动：状态约 %.1f MB",
+                name,
+                sum(memory.values()) / 1e6,
+                extra={"tenant": name, "memory_bytes": memory},
+            )
+        await stop_event.wait()
+    finally:
+        for name, app in apps.items():
+            if app.updater.running:
+                await app.updater.stop()
+            await app.stop()
+            await tenants[name].on_stop(app)
+        # 共享的请求对象在第一个租户关闭时即关闭，因此先全部停止再统一关闭
+        for name, app in apps.items():
+            await app.shutdown()
+            await tenants[name].on_shutdown(app)
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        writer.shutdown()
+        pool.shutdown()
+
+
+def main() -> None:
+    log_listener = setup_logging()
+    try:
+        _run()
+    finally:
+        log_listener.stop()
+
+
+def _run() -> None:
+    if TENANTS_FILE:
+        tenants = load_tenants(TENANTS_FILE)
+        logger.info("Bot is starting with %d tenants...", len(tenants))
+        asyncio.run(run_tenants(tenants))
+        return
+
+    load_persisted_mapping()
+
+    logger.info("Bot is starting...")
+    if REPLICA_ROLE == "worker":
+        asyncio.run(_run_replica_worker(build_application()))
+        return
+
+    if REPLICA_ROLE == "router":
+        app = build_router_application()
+    else:
+        app = build_application()
+
+    if WEBHOOK_URL:
+        # Webhook 模式：内置 HTTP 服务器接收更新，校验 secret token 后交给同一套处理器
+        logger.info(
+            "Webhook started on %s:%s/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH
+        )
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        return
+
+    logger.info("Polling started.")
     app.run_polling()
 
 